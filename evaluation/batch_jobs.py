@@ -0,0 +1,80 @@
+import os
+import json
+import time
+from tqdm import tqdm
+
+
+def create_batch_request_file(vlm, full_prompts, pil_images, response_schema, filename):
+    """Write one batch request per sample to a JSONL file in the request format of the VLM backend"""
+    request_count = 0
+    with open(filename, "w") as f:
+        for sample_idx, (full_prompt, pil_image) in enumerate(zip(full_prompts, pil_images)):
+            batch_request = vlm.create_batch_request(f"sample-{sample_idx}", full_prompt, pil_image, response_schema)
+            f.write(json.dumps(batch_request) + "\n")
+            request_count += 1
+    return request_count
+
+
+def read_batch_results_file(vlm, filename, request_count):
+    """Read a batch results file and map the responses back to sample indices"""
+    predictions_text = [None] * request_count  # Failed and missing requests stay None
+    successful_requests, failed_requests = 0, 0
+    with open(filename, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            custom_id, prediction = vlm.parse_batch_result(json.loads(line))
+            if prediction is None:
+                failed_requests += 1
+                continue
+            predictions_text[int(custom_id.removeprefix("sample-"))] = prediction
+            successful_requests += 1
+
+    missing_requests = request_count - successful_requests - failed_requests
+    print(f"Batch results: {successful_requests}/{request_count} successful, "
+          f"{failed_requests} failed, {missing_requests} missing")
+    return predictions_text
+
+
+def run_batch_job(vlm, full_prompts, pil_images, response_schema, batch_folder="batch_jobs", executor=None):
+    """Create a batch request file, run it with the backend's batch API (or a local executor) and return the
+    predictions in sample order"""
+    os.makedirs(batch_folder, exist_ok=True)
+    job_name = f"{vlm.model_name.replace('/', '-')}_{time.strftime('%Y%m%d-%H%M%S')}"
+    requests_file = f"{batch_folder}/{job_name}_requests.jsonl"
+    results_file = f"{batch_folder}/{job_name}_results.jsonl"
+
+    request_count = create_batch_request_file(vlm, full_prompts, pil_images, response_schema, requests_file)
+    print(f"Batch request file {requests_file} created with {request_count} requests")
+
+    if executor is None:
+        vlm.run_batch_job(requests_file, results_file)
+    else:
+        executor.run(requests_file, results_file)
+    print(f"Batch results saved to {results_file}")
+
+    return read_batch_results_file(vlm, results_file, request_count)
+
+
+def wait_for_batch_job(get_status, terminal_states, poll_interval=30):
+    """Poll a batch job until it reaches a terminal state and return the final status"""
+    while True:
+        status = get_status()
+        if status in terminal_states:
+            return status
+        print(f"Batch job status: {status}. Checking again in {poll_interval} seconds...")
+        time.sleep(poll_interval)
+
+
+class LocalBatchExecutor:
+    """Stand-in for the provider batch APIs that runs a batch request file request by request against the
+    interactive endpoint of the VLM, e.g. a local vLLM server, and writes a results file in the same format"""
+    def __init__(self, vlm):
+        self.vlm = vlm
+
+    def run(self, requests_file, results_file):
+        with open(requests_file, "r") as f_requests, open(results_file, "w") as f_results:
+            for line in tqdm(f_requests):
+                batch_result = self.vlm.execute_batch_request(json.loads(line))
+                f_results.write(json.dumps(batch_result) + "\n")
+        return results_file
@@ -0,0 +1,210 @@
+import os
+import glob
+import json
+import time
+import pickle
+import argparse
+import numpy as np
+from templates.answer_schema import smoke_detection_schema
+from evaluation.schema_codec import INVALID_GROUND_TRUTH_CODE, compute_confusion_matrices
+from evaluation.response_parser import ResponseParser
+
+MANIFEST_VERSION = 1
+
+
+class BenchmarkStore:
+    """Columnar store of benchmark results. Every model and dataset pair is one uncompressed .npz file with
+    one array per column under `<folder>/<dataset>/<model>.npz`, the metrics of all pairs are indexed in
+    `<folder>/manifest.json` so leaderboards never have to open the per-model files."""
+    def __init__(self, folder="benchmarks"):
+        self.folder = folder
+        self.manifest_file = f"{folder}/manifest.json"
+        self.manifest = self.read_manifest()
+
+    def read_manifest(self):
+        if not os.path.exists(self.manifest_file):
+            return {"version": MANIFEST_VERSION, "entries": {}}
+        with open(self.manifest_file, "r") as f:
+            return json.load(f)
+
+    def write_manifest(self):
+        # Write to a temporary file first so a crash never leaves a broken manifest
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_file, self.manifest_file)
+
+    def write(self, results_rel, vlm_name, dataset_name, predictions_text, ground_truth_dicts, pred_codes=None,
+              gt_codes=None, structured_output_correct=None, confusion_matrices=None):
+        vlm_name_str = vlm_name.replace("/", "-")
+        dataset_name_str = dataset_name.replace("/", "-")
+        parser = ResponseParser(smoke_detection_schema, fields=ground_truth_dicts[0].keys())
+        codec = parser.codec
+        if pred_codes is None or structured_output_correct is None:
+            pred_codes, structured_output_correct, _ = parser.parse_many(predictions_text)
+        if gt_codes is None:
+            gt_codes = codec.encode_many(ground_truth_dicts, invalid_code=INVALID_GROUND_TRUTH_CODE)
+        if confusion_matrices is None:
+            confusion_matrices = compute_confusion_matrices(pred_codes, gt_codes, codec)
+
+        predictions_data, predictions_offsets = pack_strings(predictions_text)
+        ground_truth_data, ground_truth_offsets = pack_strings([json.dumps(gt_dict) for gt_dict in ground_truth_dicts])
+        columns = {
+            "fields": np.array(codec.fields),
+            "pred_codes": pred_codes,
+            "gt_codes": gt_codes,
+            "structured_output_correct": structured_output_correct,
+            "predictions_data": predictions_data,
+            "predictions_offsets": predictions_offsets,
+            # Backends may return no text at all, which is stored as "" and marked here
+            "predictions_null": np.array([prediction is None for prediction in predictions_text], dtype=bool),
+            "ground_truth_data": ground_truth_data,
+            "ground_truth_offsets": ground_truth_offsets,
+        }
+        for field, confusion_matrix in confusion_matrices.items():
+            columns[f"confusion_matrix_{field}"] = confusion_matrix["matrix"]
+
+        os.makedirs(f"{self.folder}/{dataset_name_str}", exist_ok=True)
+        relative_filename = f"{dataset_name_str}/{vlm_name_str}.npz"
+        np.savez(f"{self.folder}/{relative_filename}", **columns)
+
+        self.manifest["entries"][f"{dataset_name_str}/{vlm_name_str}"] = {
+            "model_name": vlm_name_str,
+            "dataset_name": dataset_name_str,
+            "file": relative_filename,
+            "n_samples": len(predictions_text),
+            "results": results_rel,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        self.write_manifest()
+        return f"{self.folder}/{relative_filename}"
+
+    def open(self, dataset_name, vlm_name):
+        key = f"{dataset_name.replace('/', '-')}/{vlm_name.replace('/', '-')}"
+        if key not in self.manifest["entries"]:
+            raise KeyError(f"No results for {vlm_name} on {dataset_name} in {self.manifest_file}")
+        entry = self.manifest["entries"][key]
+        return BenchmarkResult(f"{self.folder}/{entry['file']}", entry)
+
+    def datasets(self):
+        return sorted({entry["dataset_name"] for entry in self.manifest["entries"].values()})
+
+    def leaderboard(self, dataset_name=None, metric="overall_score", columns=None):
+        """Rows of (dataset, model, metric, *columns) sorted by the metric, read from the manifest only"""
+        columns = columns or []
+        rows = []
+        for entry in self.manifest["entries"].values():
+            if dataset_name is not None and entry["dataset_name"] != dataset_name.replace("/", "-"):
+                continue
+            results = entry["results"]
+            rows.append([entry["dataset_name"], entry["model_name"], results.get(metric)] +
+                        [results.get(column) for column in columns])
+        rows.sort(key=lambda row: (row[0], -(row[2] if row[2] is not None else float("-inf"))))
+        return rows
+
+    def print_leaderboard(self, dataset_name=None, metric="overall_score", columns=None):
+        columns = columns or []
+        rows = self.leaderboard(dataset_name, metric=metric, columns=columns)
+        header = ["dataset", "model", metric] + columns
+        widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+        for row in [header] + rows:
+            print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+    def migrate_pickles(self, remove_pickles=False):
+        """One-time migration of the per-model pickle files written by earlier versions into the store"""
+        for pickle_file in sorted(glob.glob(f"{self.folder}/*/*.pkl")):
+            with open(pickle_file, "rb") as f:
+                full_results = pickle.load(f)
+            # Names are taken from the file location, some pickles carry outdated model or dataset names
+            dataset_name = os.path.basename(os.path.dirname(pickle_file))
+            vlm_name = os.path.splitext(os.path.basename(pickle_file))[0]
+            npz_file = self.write(full_results["results"], vlm_name, dataset_name, full_results["predictions_text"],
+                                  full_results["ground_truth_dicts"])
+            print(f"Migrated {pickle_file} to {npz_file}")
+            if remove_pickles:
+                os.remove(pickle_file)
+
+
+class BenchmarkResult:
+    """Lazily loaded results of one model on one dataset, columns are only read from disk on access"""
+    def __init__(self, filename, entry):
+        self.filename = filename
+        self.model_name = entry["model_name"]
+        self.dataset_name = entry["dataset_name"]
+        self.results = entry["results"]
+        self.n_samples = entry["n_samples"]
+        self.npz_file = np.load(filename, allow_pickle=False)
+
+    def column(self, name):
+        return self.npz_file[name]
+
+    @property
+    def fields(self):
+        return [str(field) for field in self.column("fields")]
+
+    @property
+    def pred_codes(self):
+        return self.column("pred_codes")
+
+    @property
+    def gt_codes(self):
+        return self.column("gt_codes")
+
+    @property
+    def structured_output_correct(self):
+        return self.column("structured_output_correct")
+
+    @property
+    def predictions_text(self):
+        predictions_text = unpack_strings(self.column("predictions_data"), self.column("predictions_offsets"))
+        # Files written before the null mask have no None predictions
+        if "predictions_null" in self.npz_file.files:
+            predictions_text = [None if is_null else prediction
+                                for prediction, is_null in zip(predictions_text, self.column("predictions_null"))]
+        return predictions_text
+
+    @property
+    def ground_truth_dicts(self):
+        return [json.loads(gt_json) for gt_json in
+                unpack_strings(self.column("ground_truth_data"), self.column("ground_truth_offsets"))]
+
+    def confusion_matrix(self, field):
+        return self.column(f"confusion_matrix_{field}")
+
+    def close(self):
+        self.npz_file.close()
+
+
+def pack_strings(strings):
+    """Pack strings into one UTF-8 byte array and an offsets array, None is packed as an empty string"""
+    encoded = [(string or "").encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(data, offsets):
+    data = data.tobytes()
+    return [data[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the columnar benchmark store')
+    parser.add_argument('command', choices=["migrate", "leaderboard"], help='Command to run')
+    parser.add_argument('--results_folder', type=str, help='Folder with the benchmark results', default="benchmarks")
+    parser.add_argument('--dataset_name', type=str, help='Only show this dataset', default=None)
+    parser.add_argument('--metric', type=str, help='Metric to sort the leaderboard by', default="overall_score")
+    parser.add_argument('--columns', type=str, nargs="*", help='Additional metrics to show', default=[])
+    parser.add_argument('--remove_pickles', action='store_true', help='Delete the pickle files after migration')
+    args = parser.parse_args()
+
+    store = BenchmarkStore(args.results_folder)
+    if args.command == "migrate":
+        store.migrate_pickles(remove_pickles=args.remove_pickles)
+    else:
+        store.print_leaderboard(args.dataset_name, metric=args.metric, columns=args.columns)
+
+
+if __name__ == "__main__":
+    main()
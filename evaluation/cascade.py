@@ -0,0 +1,216 @@
+import time
+import asyncio
+import argparse
+import threading
+from PIL import Image
+from templates.answer_schema import smoke_detection_schema
+from evaluation.response_parser import ResponseParser, CORRECT_STATUSES
+from evaluation.forestfire_evaluation import eval_structured_data, load_eval_results
+
+# A later stage looks at the image if the previous one saw smoke or fire or was unsure
+DEFAULT_ESCALATE_ON = {
+    "forest_fire_smoke_visible": ["Yes"],
+    "confirm_uncontrolled_forest_fire": ["Yes", "Closer investigation required"],
+}
+
+
+def parse_escalate_on(items) -> dict:
+    """Parse FIELD=VALUE items into the escalation values per field"""
+    escalate_on = {}
+    for item in items:
+        field, separator, value = item.partition("=")
+        if not separator:
+            raise ValueError(f"Invalid escalation condition {item}, use FIELD=VALUE")
+        escalate_on.setdefault(field.strip(), []).append(value.strip())
+    return escalate_on
+
+
+class EscalationRule:
+    """Decides if a response is passed on to the next stage: if any field has one of its escalation values, if
+    the response has no valid value for a field of the rule or if it is no correct structured output"""
+    def __init__(self, escalate_on=None, response_schema=smoke_detection_schema):
+        self.escalate_on = escalate_on if escalate_on is not None else DEFAULT_ESCALATE_ON
+        for field, values in self.escalate_on.items():
+            if field not in response_schema["properties"]:
+                raise ValueError(f"Unknown field {field} in the escalation rule")
+            invalid_values = set(values) - set(response_schema["properties"][field]["enum"])
+            if invalid_values:
+                raise ValueError(f"Invalid values {sorted(invalid_values)} for {field} in the escalation rule")
+        self.response_parser = ResponseParser(response_schema, recover_partial=True)
+
+    def escalate(self, response: str) -> bool:
+        prediction, status = self.response_parser.parse_dict(response)
+        if status not in CORRECT_STATUSES:
+            return True
+        return any(prediction[field] is None or prediction[field] in values
+                   for field, values in self.escalate_on.items())
+
+
+class CascadeVLM:
+    """Cascade of backends with the same interface as a single backend: every image goes to the first stage and
+    only escalated images to the next one, the response of the last stage that saw the image is returned. The
+    image encoder and telemetry of the first stage are used, so the cascade fits into create_predictions.
+
+    `stage_costs` are the costs of one request per stage (e.g. in USD), usage, cost and summed request time of all
+    stages are compared to sending every image to the last stage."""
+    def __init__(self, stages, escalation_rule=None, stage_costs=None):
+        if len(stages) < 2:
+            raise ValueError("A cascade needs at least two stages")
+        if stage_costs is not None and len(stage_costs) != len(stages):
+            raise ValueError("Number of stage costs and stages differ")
+        self.stages = stages
+        self.escalation_rule = escalation_rule if escalation_rule is not None else EscalationRule()
+        self.stage_costs = stage_costs
+        self.model_name = "cascade_" + "__".join(stage.model_name.replace("/", "-") for stage in stages)
+        self.image_encoder = stages[0].image_encoder
+        self.telemetry = stages[0].telemetry
+        self.lock = threading.Lock()
+        self.stage_requests = [0] * len(stages)
+        self.stage_seconds = [0.0] * len(stages)
+
+    def generate_structured_response_from_pil_image(self, full_prompt: str, pil_image: Image.Image,
+                                                    response_schema: dict) -> str:
+        for stage_idx, stage in enumerate(self.stages):
+            start = time.perf_counter()
+            with self.telemetry.span(f"stage_{stage_idx}"):
+                response = stage.generate_structured_response_from_pil_image(full_prompt, pil_image, response_schema)
+            self.record_stage(stage_idx, time.perf_counter() - start)
+            if stage_idx == len(self.stages) - 1 or not self.escalation_rule.escalate(response):
+                return response
+
+    def record_stage(self, stage_idx, seconds):
+        with self.lock:
+            self.stage_requests[stage_idx] += 1
+            self.stage_seconds[stage_idx] += seconds
+
+    def stats(self) -> dict:
+        with self.lock:
+            stage_requests, stage_seconds = list(self.stage_requests), list(self.stage_seconds)
+        return cascade_stats([stage.model_name for stage in self.stages], stage_requests, stage_seconds,
+                             self.stage_costs)
+
+    def print_stats(self):
+        print_cascade_stats(self.stats())
+
+
+class AsyncCascadeVLM(CascadeVLM):
+    """CascadeVLM of async backends"""
+    async def generate_structured_response_from_pil_image(self, full_prompt: str, pil_image: Image.Image,
+                                                          response_schema: dict) -> str:
+        for stage_idx, stage in enumerate(self.stages):
+            start = time.perf_counter()
+            with self.telemetry.span(f"stage_{stage_idx}"):
+                response = await stage.generate_structured_response_from_pil_image(full_prompt, pil_image,
+                                                                                   response_schema)
+            self.record_stage(stage_idx, time.perf_counter() - start)
+            if stage_idx == len(self.stages) - 1 or not self.escalation_rule.escalate(response):
+                return response
+
+    async def aclose(self):
+        await asyncio.gather(*(stage.aclose() for stage in self.stages))
+
+
+def cascade_stats(model_names, stage_requests, stage_seconds=None, stage_costs=None) -> dict:
+    """Usage of every stage and the cost and request time saved compared to sending every image to the last stage.
+    The request time of the last stage per image is estimated from the escalated images. Request times are summed
+    over all requests, with concurrent requests this is not the wall time of the run."""
+    samples = stage_requests[0]
+    stats = {"samples": samples, "stages": []}
+    for stage_idx, model_name in enumerate(model_names):
+        stage_stats = {"model": model_name, "requests": stage_requests[stage_idx],
+                       "share": round(stage_requests[stage_idx] / samples, 4) if samples > 0 else 0.0}
+        if stage_seconds is not None:
+            stage_stats["mean_ms"] = (round(stage_seconds[stage_idx] * 1000 / stage_requests[stage_idx], 1)
+                                      if stage_requests[stage_idx] > 0 else None)
+        stats["stages"].append(stage_stats)
+
+    if stage_costs is not None:
+        cost = sum(requests * stage_cost for requests, stage_cost in zip(stage_requests, stage_costs))
+        baseline_cost = samples * stage_costs[-1]
+        stats["cost"] = round(cost, 6)
+        stats["cost_saved"] = round(baseline_cost - cost, 6)
+        stats["cost_saved_ratio"] = round(1 - cost / baseline_cost, 4) if baseline_cost > 0 else 0.0
+    if stage_seconds is not None and stage_requests[-1] > 0:
+        request_seconds = sum(stage_seconds)
+        baseline_seconds = samples * stage_seconds[-1] / stage_requests[-1]
+        stats["request_seconds"] = round(request_seconds, 3)
+        stats["request_seconds_saved"] = round(baseline_seconds - request_seconds, 3)
+        stats["request_seconds_saved_ratio"] = (round(1 - request_seconds / baseline_seconds, 4)
+                                                if baseline_seconds > 0 else 0.0)
+    return stats
+
+
+def print_cascade_stats(stats):
+    print(f"\nCascade usage ({stats['samples']} images):")
+    for stage_idx, stage_stats in enumerate(stats["stages"]):
+        mean_ms = f", mean {stage_stats['mean_ms']} ms" if stage_stats.get("mean_ms") is not None else ""
+        print(f"Stage {stage_idx} {stage_stats['model']}: {stage_stats['requests']} requests "
+              f"({stage_stats['share'] * 100:.1f}%){mean_ms}")
+    if "cost" in stats:
+        print(f"Cost {stats['cost']}, {stats['cost_saved']} ({stats['cost_saved_ratio'] * 100:.1f}%) saved compared "
+              f"to the last stage only")
+    if "request_seconds" in stats:
+        # Under concurrency the summed time of all requests is not the wall time
+        print(f"Summed request time {stats['request_seconds']} s, {stats['request_seconds_saved']} s "
+              f"({stats['request_seconds_saved_ratio'] * 100:.1f}%) saved compared to the last stage only")
+
+
+def print_accuracy_loss(results_rel, reference_results, reference_name):
+    """Difference of every metric to the results of the reference model, e.g. the last stage alone"""
+    print(f"\nAccuracy compared to {reference_name}:")
+    for key, value in results_rel.items():
+        reference_value = reference_results.get(key)
+        if isinstance(value, float) and isinstance(reference_value, (int, float)):
+            print(f"{key}: {value} ({value - reference_value:+.4f})")
+
+
+def simulate_cascade(stage_predictions, escalation_rule) -> tuple[list[str], list[int]]:
+    """Cascade the stored predictions of the stage models on the same samples, returns the predictions of the
+    cascade and the number of requests per stage"""
+    stage_requests = [0] * len(stage_predictions)
+    predictions_text = []
+    for sample_predictions in zip(*stage_predictions):
+        for stage_idx, response in enumerate(sample_predictions):
+            stage_requests[stage_idx] += 1
+            if stage_idx == len(sample_predictions) - 1 or not escalation_rule.escalate(response):
+                predictions_text.append(response)
+                break
+    return predictions_text, stage_requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a model cascade on stored benchmark results')
+    parser.add_argument('--dataset_name', type=str, help='Dataset name', default="leon-se/ForestFireInsights-Eval")
+    parser.add_argument('--stages', type=str, nargs="+", required=True,
+                        help='Model names of the stages, from the cheapest to the last stage')
+    parser.add_argument('--escalate_on', type=str, nargs="+", default=None,
+                        help='FIELD=VALUE conditions for escalating an image to the next stage')
+    parser.add_argument('--stage_costs', type=float, nargs="+", help='Cost of one request per stage', default=None)
+    parser.add_argument('--results_folder', type=str, help='Folder with the benchmark results', default="benchmarks")
+    args = parser.parse_args()
+
+    escalation_rule = EscalationRule(parse_escalate_on(args.escalate_on) if args.escalate_on else None)
+    stage_predictions = []
+    for model_name in args.stages:
+        _, predictions_text, stage_ground_truth_dicts = load_eval_results(args.dataset_name, model_name,
+                                                                                args.results_folder)
+        if not stage_predictions:
+            ground_truth_dicts = stage_ground_truth_dicts
+        elif stage_ground_truth_dicts != ground_truth_dicts:
+            # Without sample ids, stored predictions can only be cascaded if they are in the same order
+            raise ValueError(f"Stored samples of {model_name} differ from the first stage in order or content")
+        stage_predictions.append(predictions_text)
+
+    # The last stage is scored again, so both use the same response parser
+    reference_results = eval_structured_data(stage_predictions[-1], ground_truth_dicts, args.stages[-1],
+                                             args.dataset_name, write_to_file=False)
+    predictions_text, stage_requests = simulate_cascade(stage_predictions, escalation_rule)
+    cascade_name = "cascade_" + "__".join(model_name.replace("/", "-") for model_name in args.stages)
+    results_rel = eval_structured_data(predictions_text, ground_truth_dicts, cascade_name, args.dataset_name,
+                                       write_to_file=False)
+    print_accuracy_loss(results_rel, reference_results, args.stages[-1])
+    print_cascade_stats(cascade_stats(args.stages, stage_requests, stage_costs=args.stage_costs))
+
+
+if __name__ == "__main__":
+    main()
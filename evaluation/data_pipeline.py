@@ -0,0 +1,253 @@
+import threading
+from collections import deque
+from typing import NamedTuple
+from evaluation.image_encoding import EncodedImage, encode_ahead
+from evaluation.telemetry import Telemetry
+
+# Column with the index of a sample in the unshuffled dataset
+SAMPLE_IDX_COLUMN = "sample_idx"
+
+
+def get_sample_count(eval_ds):
+    """Number of samples of a dataset, for streaming datasets from the split info if available"""
+    try:
+        return len(eval_ds)
+    except TypeError:
+        pass
+    split_infos = eval_ds.info.splits if eval_ds.info is not None else None
+    if split_infos and eval_ds.split is not None and str(eval_ds.split) in split_infos:
+        return split_infos[str(eval_ds.split)].num_examples
+    return None
+
+
+class Shard(NamedTuple):
+    """Shard `index` of `count` holds the samples with sample_idx % count == index. Samples keep their sample_idx
+    of the full dataset, so the shards of several machines can be merged in sample order."""
+    index: int
+    count: int
+
+    def contains(self, sample_idx) -> bool:
+        return sample_idx % self.count == self.index
+
+    def sample_indices(self, sample_count) -> range:
+        return range(self.index, sample_count, self.count)
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+
+def parse_shard(value) -> Shard:
+    """Parse a shard given as i/N"""
+    index, separator, count = value.partition("/")
+    if not separator or not index.isdigit() or not count.isdigit() or not 0 <= int(index) < int(count):
+        raise ValueError(f"Invalid shard {value}, use i/N with 0 <= i < N")
+    return Shard(int(index), int(count))
+
+
+def shuffle_samples(eval_ds, seed, buffer_size=1000):
+    """Shuffle a map-style or streaming dataset. The samples keep their index in the unshuffled dataset in the
+    column "sample_idx", so checkpoints, shards and results do not depend on the seed."""
+    if hasattr(eval_ds, "__getitem__") and hasattr(eval_ds, "__len__"):
+        return eval_ds.add_column(SAMPLE_IDX_COLUMN, list(range(len(eval_ds)))).shuffle(seed=seed)
+    eval_ds = eval_ds.map(lambda sample, sample_idx: {SAMPLE_IDX_COLUMN: sample_idx}, with_indices=True)
+    return eval_ds.shuffle(seed=seed, buffer_size=buffer_size)
+
+
+def iter_samples(eval_ds, skip_indices=(), shard=None):
+    """Yield (sample_idx, sample) pairs of a map-style or streaming dataset, skipping the given indices and, with
+    a `shard`, the samples of other shards. Shuffled datasets yield the sample_idx of the unshuffled dataset."""
+    if hasattr(eval_ds, "__getitem__") and hasattr(eval_ds, "__len__"):
+        if SAMPLE_IDX_COLUMN in (getattr(eval_ds, "column_names", None) or ()):
+            sample_indices = eval_ds[SAMPLE_IDX_COLUMN][:]
+        else:
+            sample_indices = range(len(eval_ds))
+        for position, sample_idx in enumerate(sample_indices):
+            if sample_idx not in skip_indices and (shard is None or shard.contains(sample_idx)):
+                yield sample_idx, eval_ds[position]
+    else:
+        # Streaming datasets have no random access, skipped samples are still read but not decoded
+        for position, sample in enumerate(eval_ds):
+            sample_idx = sample.get(SAMPLE_IDX_COLUMN, position)
+            if sample_idx not in skip_indices and (shard is None or shard.contains(sample_idx)):
+                yield sample_idx, sample
+
+
+def get_sample_size(sample) -> int:
+    image = sample["image"]
+    if isinstance(image, EncodedImage):
+        return len(image.data)
+    if isinstance(image, dict) and image.get("bytes") is not None:
+        return len(image["bytes"])
+    return 0
+
+
+class PrefetchLoader:
+    """Reads samples and encodes their images in a background thread ahead of the requests. At most `prefetch`
+    samples and `max_prefetch_mb` of encoded images are buffered, a single larger sample is still let through.
+    With `encode_workers` > 0 the images are encoded in a process pool, otherwise decode and encode spans of
+    every sample are recorded in `telemetry`.
+
+    `get` is thread-safe, so several consumers (e.g. the workers of create_predictions_async) can share a loader."""
+    def __init__(self, samples, image_encoder, prefetch=32, max_prefetch_mb=256, encode_workers=0, telemetry=None):
+        self.image_encoder = image_encoder
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.prefetch = max(1, prefetch)
+        self.max_prefetch_bytes = int(max_prefetch_mb * 1024 * 1024)
+        self.encode_workers = encode_workers
+
+        self.condition = threading.Condition()
+        self.buffer = deque()
+        self.buffered_bytes = 0
+        self.finished = False
+        self.closed = False
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, args=(samples,), daemon=True)
+        self.thread.start()
+
+    def run(self, samples):
+        try:
+            if self.encode_workers > 0:
+                encoded_samples = encode_ahead(samples, self.image_encoder, encode_workers=self.encode_workers,
+                                               lookahead=2 * self.encode_workers)
+            else:
+                encoded_samples = (self.encode_sample(sample_idx, sample) for sample_idx, sample in samples)
+
+            for sample_idx, sample in encoded_samples:
+                sample_size = get_sample_size(sample)
+                with self.condition:
+                    self.condition.wait_for(lambda: self.closed or not self.buffer or
+                                            (len(self.buffer) < self.prefetch and
+                                             self.buffered_bytes + sample_size <= self.max_prefetch_bytes))
+                    if self.closed:
+                        return
+                    self.buffer.append((sample_idx, sample, sample_size))
+                    self.buffered_bytes += sample_size
+                    self.condition.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def encode_sample(self, sample_idx, sample):
+        with self.telemetry.span("decode", sample_idx=sample_idx):
+            image = self.image_encoder.decode(sample["image"])
+        with self.telemetry.span("encode", sample_idx=sample_idx):
+            image = self.image_encoder.encode(image)
+        return sample_idx, {**sample, "image": image}
+
+    def get(self):
+        """Return the next (sample_idx, sample) pair, or None once all samples are consumed"""
+        with self.condition:
+            with self.telemetry.span("loader_wait"):
+                self.condition.wait_for(lambda: self.buffer or self.finished)
+            if self.buffer:
+                sample_idx, sample, sample_size = self.buffer.popleft()
+                self.buffered_bytes -= sample_size
+                self.condition.notify_all()
+                return sample_idx, sample
+            if self.error is not None:
+                raise self.error
+            return None
+
+    def __iter__(self):
+        while (item := self.get()) is not None:
+            yield item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class SampleFanOut:
+    """Shares the samples of one loader between several consumers, e.g. the models of a sweep, so every image is
+    read and encoded once. Every consumer gets every sample once and in order through its own `view`. Samples are
+    kept until the slowest consumer took them, at most `window` of them, so fast consumers run at most `window`
+    samples ahead of the slowest one."""
+    def __init__(self, loader, consumer_count, window=64):
+        self.loader = loader
+        self.window = max(1, window)
+        self.condition = threading.Condition()
+        self.samples = deque()
+        self.first_position = 0  # Position of samples[0] in the stream
+        self.positions = [0] * consumer_count
+        self.fetching = False
+        self.finished = False
+        self.error = None
+
+    def view(self, consumer_idx):
+        return FanOutView(self, consumer_idx)
+
+    def get(self, consumer_idx):
+        """Return the next (sample_idx, sample) pair of a consumer, or None once all samples are consumed"""
+        while True:
+            with self.condition:
+                # The consumer that is first to need a sample past the held ones fetches it from the loader
+                while True:
+                    if self.positions[consumer_idx] == float("inf"):
+                        return None  # Closed consumer
+                    offset = self.positions[consumer_idx] - self.first_position
+                    if offset < len(self.samples):
+                        self.positions[consumer_idx] += 1
+                        item = self.samples[offset]
+                        self.release_samples()
+                        return item
+                    if self.error is not None:
+                        raise self.error
+                    if self.finished:
+                        return None
+                    if not self.fetching and len(self.samples) < self.window:
+                        self.fetching = True
+                        break
+                    self.condition.wait()
+
+            try:
+                item = self.loader.get()
+            except Exception as e:
+                item, self.error = None, e
+            with self.condition:
+                self.fetching = False
+                if item is None:
+                    self.finished = True
+                else:
+                    self.samples.append(item)
+                self.condition.notify_all()
+
+    def release_samples(self):
+        # Called with the condition held
+        slowest_position = min(self.positions)
+        released = False
+        while self.samples and self.first_position < slowest_position:
+            self.samples.popleft()
+            self.first_position += 1
+            released = True
+        if released:
+            self.condition.notify_all()
+
+    def close_consumer(self, consumer_idx):
+        """A consumer that stopped early no longer holds back the others"""
+        with self.condition:
+            self.positions[consumer_idx] = float("inf")
+            self.release_samples()
+            if all(position == float("inf") for position in self.positions):
+                self.loader.close()
+
+
+class FanOutView:
+    """Loader interface (`get`, `close`) of one consumer of a SampleFanOut"""
+    def __init__(self, fan_out: SampleFanOut, consumer_idx):
+        self.fan_out = fan_out
+        self.consumer_idx = consumer_idx
+
+    def get(self):
+        return self.fan_out.get(self.consumer_idx)
+
+    def __iter__(self):
+        while (item := self.get()) is not None:
+            yield item
+
+    def close(self):
+        self.fan_out.close_consumer(self.consumer_idx)
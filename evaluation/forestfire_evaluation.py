@@ -1,77 +1,53 @@
 import os
+import asyncio
+import itertools
 import pickle
 import json
 import csv
 from tqdm import tqdm
-from sklearn.metrics import confusion_matrix
+import numpy as np
 from templates.answer_schema import smoke_detection_schema
+from evaluation.schema_codec import (INVALID_GROUND_TRUTH_CODE, compute_binary_metrics, 
+                                     compute_confusion_matrices)
+from evaluation.data_pipeline import PrefetchLoader, get_sample_count, iter_samples
+from evaluation.benchmark_store import BenchmarkStore
+from evaluation.response_parser import ResponseParser
 
 def eval_structured_data(predictions_text, ground_truth_dicts, vlm_name, dataset_name, 
-                         write_to_file=True, results_folder='benchmarks', confusion_keys=[]):
+                         write_to_file=True, results_folder='benchmarks', confusion_keys=[], recover_partial=False):
     # Check if predictions and ground truth have the same length
     if len(predictions_text) != len(ground_truth_dicts):
         raise ValueError("Predictions and ground truth have different lengths")
     
-    # Initialize length of results and count of incorrect structured outputs
+    # Encode predictions and ground truth as integer codes of the schema enums
+    parser = ResponseParser(smoke_detection_schema, fields=ground_truth_dicts[0].keys(),
+                            recover_partial=recover_partial)
+    codec = parser.codec
+    pred_codes, structured_output_correct, status_counts = parser.parse_many(predictions_text)
+    gt_codes = codec.encode_many(ground_truth_dicts, invalid_code=INVALID_GROUND_TRUTH_CODE)
     results_len = len(ground_truth_dicts)
-    structured_output_incorrect = 0
 
-    # Initialize results dictionaries
-    results_abs, results_rel = {}, {}
-    for key in ground_truth_dicts[0].keys():
-        results_abs[key] = 0
-        results_rel[key] = 0.0
-
-    # Initialize confusion dictionaries
-    bool_dicts, confusion_evals = {}, {}
-    for confusion_key in confusion_keys:
-        bool_dicts[confusion_key] = {"gt_bools": [], "pred_bools": []}
-
-    for pred_text, gt_dict in zip(predictions_text, ground_truth_dicts):
-        # Remove code block markdown if present
-        pred_text = pred_text.lstrip("```json").rstrip("```")
-        
-        # Check if structured output is correct
-        try:
-            pred_dict = json.loads(pred_text)
-            # Check if prediction is correct
-            for key in gt_dict.keys():
-                if gt_dict[key] == pred_dict[key]:
-                    results_abs[key] += 1
-            # Check confusion keys
-            for confusion_key in confusion_keys:
-                gt_bool = True if gt_dict[confusion_key] == "Yes" else False
-                pred_bool = True if pred_dict[confusion_key] == "Yes" else False
-                bool_dicts[confusion_key]["gt_bools"].append(gt_bool)
-                bool_dicts[confusion_key]["pred_bools"].append(pred_bool)
-        except Exception as e:
-            print(e)
-            structured_output_incorrect += 1
-            continue
-    
-    # Calculate relative results
-    for key in results_abs.keys():
-        results_rel[key] = round(results_abs[key] / results_len, 4)
+    # Calculate relative results, incorrect structured outputs have invalid codes and never match
+    results_abs = np.sum(pred_codes == gt_codes, axis=0)
+    results_rel = {key: round(int(results_abs[col]) / results_len, 4) for col, key in enumerate(codec.fields)}
     
     # Calculate overall accuracy
     results_rel["overall_score"] = round(sum(results_rel.values()) / len(results_rel), 4)
-    results_rel["structured_output_correct_ratio"] = round((results_len - structured_output_incorrect) / results_len, 4)
+    results_rel["structured_output_correct_ratio"] = round(int(structured_output_correct.sum()) / results_len, 4)
 
-    # Calculate confusion metrics
+    # Calculate confusion metrics on the correct structured outputs
     for confusion_key in confusion_keys:
-        cm = confusion_matrix(bool_dicts[confusion_key]["gt_bools"], bool_dicts[confusion_key]["pred_bools"])
-        tn, fp, fn, tp = cm.ravel()
-        accuracy = round((tp + tn) / (tp + tn + fp + fn), 4)
-        precision = round(tp / (tp + fp), 4)
-        recall = round(tp / (tp + fn), 4)
-        f1_score = round(2 * (precision * recall) / (precision + recall), 4)
-        confusion_evals[confusion_key] = {"accuracy": accuracy, "precision": precision, "recall": recall, "f1_score": f1_score}
-        results_rel[f"confusion_{confusion_key}"] = confusion_evals
+        col = codec.field_index(confusion_key)
+        yes_code = codec.value_codes[confusion_key]["Yes"]
+        gt_bools = gt_codes[structured_output_correct, col] == yes_code
+        pred_bools = pred_codes[structured_output_correct, col] == yes_code
+        results_rel[f"confusion_{confusion_key}"] = compute_binary_metrics(gt_bools, pred_bools)
 
     # Print results
     print(f"\n\nResults for {vlm_name} on {dataset_name}:\n")
     for key, value in results_rel.items():
         print(f"{key}: {value}")
+    print("parse_status: " + ", ".join(f"{status} {count}" for status, count in status_counts.most_common()))
 
     # Write results to files
     if write_to_file:
@@ -86,55 +62,66 @@ def eval_structured_data(predictions_text, ground_truth_dicts, vlm_name, dataset
             os.makedirs(benchmark_folder_ds)
 
         write_eval_to_list(results_rel, vlm_name_str, folder=benchmark_folder_ds)
+        confusion_matrices = compute_confusion_matrices(pred_codes, gt_codes, codec)
         write_eval_to_file(results_rel, vlm_name_str, dataset_name_str, predictions_text, ground_truth_dicts, 
-                           folder=benchmark_folder_ds)
+                           results_folder=results_folder, pred_codes=pred_codes, gt_codes=gt_codes, 
+                           structured_output_correct=structured_output_correct, 
+                           confusion_matrices=confusion_matrices)
 
     return results_rel
 
 
 def write_eval_to_list(results_rel, vlm_name, folder):
-    # Open file in append mode
+    row = {"model": vlm_name, **results_rel}
+
+    # Keep the existing header and add new columns at the end, so columns never drift between runs
     filename = f"{folder}/eval_results.csv"
+    rows = []
+    if os.path.exists(filename) and os.path.getsize(filename) > 0:
+        with open(filename, 'r', newline='') as f:
+            reader = csv.DictReader(f)
+            header = list(reader.fieldnames)
+            rows = list(reader)
+    else:
+        header = []
+    new_columns = [key for key in row.keys() if key not in header]
 
-    if not os.path.exists(filename):
+    if not new_columns:
+        with open(filename, 'a', newline='') as f:
+            csv.DictWriter(f, fieldnames=header).writerow(row)
+    else:
+        # Rewrite the file with the extended header
         with open(filename, 'w', newline='') as f:
-            pass
-
-    with open(filename, 'a', newline='') as f:
-        writer = csv.writer(f)
-        
-        # Write header if file is empty
-        f.seek(0, 2)  # Go to end of file
-        if f.tell() == 0:  # If file is empty, write header
-            header = ['model'] + list(results_rel.keys())
-            writer.writerow(header)
-            
-        # Write results
-        row = [vlm_name] + list(results_rel.values())
-        writer.writerow(row)
+            writer = csv.DictWriter(f, fieldnames=header + new_columns)
+            writer.writeheader()
+            writer.writerows(rows + [row])
     
     print(f"\nResults list {filename} updated")
 
 
-def write_eval_to_file(results_rel, vlm_name, dataset_name, predictions_text, ground_truth_dicts, folder):
-    # Save full results to file       
-    full_results = {
-        "model_name": vlm_name,
-        "dataset_name": dataset_name,
-        "results": results_rel,
-        "predictions_text": predictions_text,
-        "ground_truth_dicts": ground_truth_dicts
-        }
-
-    filename = f"{folder}/{vlm_name}.pkl"
-    with open(filename, 'wb') as f:
-        pickle.dump(full_results, f)
+def write_eval_to_file(results_rel, vlm_name, dataset_name, predictions_text, ground_truth_dicts, results_folder,
+                       pred_codes=None, gt_codes=None, structured_output_correct=None, confusion_matrices=None):
+    # Save full results to the columnar benchmark store
+    store = BenchmarkStore(results_folder)
+    filename = store.write(results_rel, vlm_name, dataset_name, predictions_text, ground_truth_dicts, 
+                           pred_codes=pred_codes, gt_codes=gt_codes, 
+                           structured_output_correct=structured_output_correct, 
+                           confusion_matrices=confusion_matrices)
 
     print(f"Full results saved to {filename}")
 
 
 def open_eval_file(filename):
-    """Open evaluation file and return model name, dataset name, results dictionary, predictions text and ground truth dictionaries"""
+    """Open evaluation file (.npz from the benchmark store or legacy .pkl) and return model name, dataset name, 
+    results dictionary, predictions text and ground truth dictionaries"""
+    if filename.endswith(".npz"):
+        results_folder = os.path.dirname(os.path.dirname(filename))
+        dataset_name = os.path.basename(os.path.dirname(filename))
+        vlm_name = os.path.splitext(os.path.basename(filename))[0]
+        result = BenchmarkStore(results_folder).open(dataset_name, vlm_name)
+        return result.model_name, result.dataset_name, result.results, result.predictions_text, \
+            result.ground_truth_dicts
+
     with open(filename, 'rb') as f:
         full_results = pickle.load(f)
         model_name = full_results["model_name"]
@@ -145,38 +132,217 @@ def open_eval_file(filename):
         return model_name, dataset_name, results, predictions_text, ground_truth_dicts
 
 
-def create_predictions(eval_ds, vlm):
-    ground_truth_dicts = []
-    predictions_text = []
+def load_eval_results(dataset_name, vlm_name, results_folder='benchmarks'):
+    """Return the results dictionary, predictions text and ground truth dictionaries of a stored evaluation, from
+    the benchmark store or a legacy .pkl file"""
+    try:
+        result = BenchmarkStore(results_folder).open(dataset_name, vlm_name)
+        return result.results, result.predictions_text, result.ground_truth_dicts
+    except KeyError:
+        pass
+    filename = f"{results_folder}/{dataset_name.replace('/', '-')}/{vlm_name.replace('/', '-')}.pkl"
+    if not os.path.exists(filename):
+        raise FileNotFoundError(f"No stored results for {vlm_name} on {dataset_name} in {results_folder}")
+    _, _, results, predictions_text, ground_truth_dicts = open_eval_file(filename)
+    return results, predictions_text, ground_truth_dicts
+
 
-    print(f"\nDataset size: {len(eval_ds)}\nModel: {vlm.model_name}\n")
+def create_predictions(eval_ds, vlm, prediction_log=None, encode_workers=0, prefetch=32, max_prefetch_mb=256,
+                       early_stopping=None, shard=None):
+    # Start from the checkpointed predictions if there are any
+    predictions_by_idx, ground_truth_by_idx = init_predictions(prediction_log, early_stopping)
+    sample_count = get_sample_count(eval_ds)
+    telemetry = vlm.telemetry
+    # Read and encode samples in the background ahead of the requests
+    loader = PrefetchLoader(iter_samples(eval_ds, skip_indices=set(ground_truth_by_idx), shard=shard), 
+                            vlm.image_encoder, prefetch=prefetch, max_prefetch_mb=max_prefetch_mb, 
+                            encode_workers=encode_workers, telemetry=telemetry)
+    pending_count = get_pending_count(sample_count, ground_truth_by_idx, shard)
+
+    print(f"\nDataset size: {sample_count or 'unknown'}{get_shard_info(shard)}\nModel: {vlm.model_name}\n")
     # Iterate over the dataset
-    for sample in tqdm(eval_ds):
-        image = sample["image"]
-        prompt = sample["prompt"]
-        gt_dict = sample["gt_dict"]
-        response_schema = smoke_detection_schema
-        vlm_prediction = vlm.generate_structured_response_from_pil_image(prompt, image, response_schema)
-        ground_truth_dicts.append(gt_dict)
-        predictions_text.append(vlm_prediction)
+    progress_bar = tqdm(loader, total=pending_count)
+    try:
+        for sample_idx, sample in progress_bar:
+            if early_stopping is not None and early_stopping.reason is not None:
+                break
+            image = sample["image"]
+            prompt = sample["prompt"]
+            gt_dict = sample["gt_dict"]
+            response_schema = smoke_detection_schema
+            with telemetry.request(sample_idx):
+                vlm_prediction = vlm.generate_structured_response_from_pil_image(prompt, image, response_schema)
+                ground_truth_by_idx[sample_idx] = gt_dict
+                predictions_by_idx[sample_idx] = vlm_prediction
+                if prediction_log is not None:
+                    with telemetry.span("checkpoint"):
+                        prediction_log.append(sample_idx, gt_dict, vlm_prediction)
+            if early_stopping is not None:
+                early_stopping.update(vlm_prediction, gt_dict)
+                progress_bar.set_postfix_str(early_stopping.progress(), refresh=False)
+    finally:
+        progress_bar.close()
+        loader.close()
     
-    return predictions_text, ground_truth_dicts
+    return collect_predictions(predictions_by_idx, ground_truth_by_idx, sample_count, 
+                               allow_missing=early_stopping is not None and early_stopping.reason is not None,
+                               shard=shard)
 
 
-def create_predictions_batched(eval_ds, vlm):
-    # Create predictions for the dataset
-    images = []
-    prompts = []
-    ground_truth_dicts = []
+async def create_predictions_async(eval_ds, vlm, concurrency=16, prediction_log=None, encode_workers=0, 
+                                   prefetch=None, max_prefetch_mb=256, early_stopping=None, loader=None,
+                                   progress_position=None, shard=None):
+    """Create predictions with up to `concurrency` requests in flight, results are returned in sample order.
+    Samples are read and encoded by a PrefetchLoader shared by all workers, or by the given `loader` (e.g. a view
+    of a SampleFanOut shared with other models). Once `early_stopping` decides, the workers finish their requests
+    in flight and take no new samples."""
+    predictions_by_idx, ground_truth_by_idx = init_predictions(prediction_log, early_stopping)
+    sample_count = get_sample_count(eval_ds)
+    telemetry = vlm.telemetry
+    checkpointed_indices = set(ground_truth_by_idx)
+    if loader is None:
+        loader = PrefetchLoader(iter_samples(eval_ds, skip_indices=checkpointed_indices, shard=shard), 
+                                vlm.image_encoder, prefetch=prefetch if prefetch is not None else 2 * concurrency, 
+                                max_prefetch_mb=max_prefetch_mb, encode_workers=encode_workers, telemetry=telemetry)
+    pending_count = get_pending_count(sample_count, ground_truth_by_idx, shard)
     response_schema = smoke_detection_schema
 
-    print(f"Dataset size: {len(eval_ds)}\nModel: {vlm.model_name}\n")
-    # Iterate over the dataset
-    for sample in eval_ds:
-        images.append(sample["image"])
-        prompts.append(sample["prompt"])
-        ground_truth_dicts.append(sample["gt_dict"])
+    if progress_position is None:
+        print(f"\nDataset size: {sample_count or 'unknown'}{get_shard_info(shard)}\nModel: {vlm.model_name}\n"
+              f"Concurrency: {concurrency}\n")
+        progress_bar = tqdm(total=pending_count)
+    else:
+        # Several models share the terminal, one line each
+        progress_bar = tqdm(total=pending_count, desc=vlm.model_name, position=progress_position)
+
+    async def worker():
+        # Each worker pulls the next sample, so at most `concurrency` requests are in flight
+        while (early_stopping is None or early_stopping.reason is None) and \
+                (item := await asyncio.to_thread(loader.get)) is not None:
+            sample_idx, sample = item
+            # A shared loader also yields the samples that are checkpointed for this model
+            if sample_idx in checkpointed_indices:
+                continue
+            with telemetry.request(sample_idx):
+                vlm_prediction = await vlm.generate_structured_response_from_pil_image(sample["prompt"], 
+                                                                                       sample["image"], 
+                                                                                       response_schema)
+                ground_truth_by_idx[sample_idx] = sample["gt_dict"]
+                predictions_by_idx[sample_idx] = vlm_prediction
+                if prediction_log is not None:
+                    with telemetry.span("checkpoint"):
+                        prediction_log.append(sample_idx, sample["gt_dict"], vlm_prediction)
+            if early_stopping is not None:
+                early_stopping.update(vlm_prediction, sample["gt_dict"])
+                progress_bar.set_postfix_str(early_stopping.progress(), refresh=False)
+            progress_bar.update(1)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        # A failed worker stops the others, so none of them writes to the checkpoint once the caller closed it
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        progress_bar.close()
+        loader.close()
+
+    return collect_predictions(predictions_by_idx, ground_truth_by_idx, sample_count,
+                               allow_missing=early_stopping is not None and early_stopping.reason is not None,
+                               shard=shard)
 
-    predictions_text = vlm.generate_structured_response_from_pil_image_batch(prompts, images, response_schema)
 
+def create_predictions_batched(eval_ds, vlm, batch_folder="batch_jobs", executor=None, prediction_log=None, 
+                               prefetch=32, max_prefetch_mb=256, shard=None):
+    """Create predictions for the dataset with a single batch job, see evaluation.batch_jobs"""
+    # Create predictions for the samples that are not checkpointed yet
+    predictions_by_idx, ground_truth_by_idx = init_predictions(prediction_log)
+    sample_count = get_sample_count(eval_ds)
+    loader = PrefetchLoader(iter_samples(eval_ds, skip_indices=set(ground_truth_by_idx), shard=shard), 
+                            vlm.image_encoder, prefetch=prefetch, max_prefetch_mb=max_prefetch_mb, 
+                            telemetry=vlm.telemetry)
+    # Without pending samples no batch job is uploaded and submitted
+    first_item = loader.get()
+    if first_item is None:
+        loader.close()
+        print(f"All samples of {vlm.model_name} are checkpointed, no batch job is submitted")
+        return collect_predictions(predictions_by_idx, ground_truth_by_idx, sample_count, shard=shard)
+    batch_indices = []
+    response_schema = smoke_detection_schema
+
+    def record_samples():
+        for sample_idx, sample in itertools.chain([first_item], loader):
+            batch_indices.append(sample_idx)
+            ground_truth_by_idx[sample_idx] = sample["gt_dict"]
+            yield sample
+
+    # The batch request file is written while the samples are streamed, zip keeps both views in lockstep
+    prompt_samples, image_samples = itertools.tee(record_samples())
+    prompts = (sample["prompt"] for sample in prompt_samples)
+    images = (sample["image"] for sample in image_samples)
+
+    print(f"Dataset size: {sample_count or 'unknown'}{get_shard_info(shard)}\nModel: {vlm.model_name}\n")
+    try:
+        with vlm.telemetry.span("batch_job"):
+            batch_predictions = vlm.generate_structured_response_from_pil_image_batch(prompts, images, 
+                                                                                      response_schema, 
+                                                                                      batch_folder=batch_folder, 
+                                                                                      executor=executor)
+    finally:
+        loader.close()
+
+    for sample_idx, vlm_prediction in zip(batch_indices, batch_predictions):
+        # Failed requests count as incorrect structured output and are not checkpointed, so a resume retries them
+        if vlm_prediction is None:
+            predictions_by_idx[sample_idx] = ""
+            continue
+        predictions_by_idx[sample_idx] = vlm_prediction
+        if prediction_log is not None:
+            prediction_log.append(sample_idx, ground_truth_by_idx[sample_idx], vlm_prediction)
+
+    return collect_predictions(predictions_by_idx, ground_truth_by_idx, sample_count, shard=shard)
+
+
+def init_predictions(prediction_log=None, early_stopping=None):
+    """Return predictions and ground truth keyed by sample_idx, prefilled from the prediction log. Checkpointed
+    predictions are also added to the metrics of `early_stopping`."""
+    if prediction_log is None:
+        return {}, {}
+    predictions_by_idx = {sample_idx: record["vlm_prediction"] for sample_idx, record in prediction_log.records.items()}
+    ground_truth_by_idx = {sample_idx: record["gt_dict"] for sample_idx, record in prediction_log.records.items()}
+    if early_stopping is not None:
+        for sample_idx in sorted(ground_truth_by_idx):
+            early_stopping.update(predictions_by_idx[sample_idx], ground_truth_by_idx[sample_idx])
+    return predictions_by_idx, ground_truth_by_idx
+
+
+def collect_predictions(predictions_by_idx, ground_truth_by_idx, sample_count=None, allow_missing=False, shard=None):
+    """Return predictions_text and ground_truth_dicts in sample order, with `allow_missing` only of the samples
+    with predictions (e.g. after early stopping), with a `shard` only of the samples of the shard"""
+    if allow_missing:
+        sample_indices = sorted(ground_truth_by_idx)
+        return ([predictions_by_idx[sample_idx] for sample_idx in sample_indices], 
+                [ground_truth_by_idx[sample_idx] for sample_idx in sample_indices])
+    if sample_count is None:
+        sample_count = max(ground_truth_by_idx.keys(), default=-1) + 1
+    sample_indices = shard.sample_indices(sample_count) if shard is not None else range(sample_count)
+    missing_count = sum(1 for sample_idx in sample_indices if sample_idx not in ground_truth_by_idx)
+    if missing_count > 0:
+        raise ValueError(f"Predictions for {missing_count} of {len(sample_indices)} samples are missing")
+    predictions_text = [predictions_by_idx[sample_idx] for sample_idx in sample_indices]
+    ground_truth_dicts = [ground_truth_by_idx[sample_idx] for sample_idx in sample_indices]
     return predictions_text, ground_truth_dicts
+
+
+def get_pending_count(sample_count, ground_truth_by_idx, shard=None):
+    """Number of samples without checkpointed prediction, None if the dataset size is unknown"""
+    if sample_count is None:
+        return None
+    if shard is not None:
+        return len(shard.sample_indices(sample_count)) - len(ground_truth_by_idx)
+    return sample_count - len(ground_truth_by_idx)
+
+
+def get_shard_info(shard=None):
+    return f" (shard {shard})" if shard is not None else ""
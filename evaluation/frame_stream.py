@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import threading
+from io import BytesIO
+from typing import NamedTuple
+import numpy as np
+from PIL import Image
+
+FRAME_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+
+class Frame(NamedTuple):
+    """A frame of a stream, `image` is a PIL image (video) or the undecoded file bytes (directory)"""
+    frame_idx: int
+    image: Image.Image | bytes
+    captured_at: float
+    name: str | None = None
+
+
+def iter_video_frames(source, realtime=True):
+    """Yield the frames of a video file, stream URL (e.g. RTSP) or camera index with OpenCV. Video files are read
+    at their frame rate with `realtime`, like a live feed, streams and cameras are always read as they arrive."""
+    try:
+        import cv2
+    except ImportError:
+        raise ImportError("Reading videos and streams requires OpenCV, install it with `pip install opencv-python`")
+
+    capture = cv2.VideoCapture(int(source) if str(source).isdigit() else source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source {source}")
+    is_file = os.path.isfile(str(source))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+    start_time = time.monotonic()
+    frame_idx = 0
+    try:
+        while True:
+            ok, pixels = capture.read()
+            if not ok:
+                break
+            if is_file and realtime and fps > 0:
+                delay = start_time + frame_idx / fps - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            # OpenCV frames are BGR
+            yield Frame(frame_idx, Image.fromarray(pixels[:, :, ::-1]), time.time(), f"{source}#{frame_idx}")
+            frame_idx += 1
+    finally:
+        capture.release()
+
+
+def iter_directory_frames(folder, poll_interval=0.5, settle_time=0.2):
+    """Watch a directory and yield new image files in order of their modification time. Files modified within the
+    last `settle_time` seconds are picked up by a later poll, so partially written files are never read."""
+    seen = set()
+    frame_idx = 0
+    while True:
+        now = time.time()
+        new_files = []
+        for entry in os.scandir(folder):
+            if entry.name in seen or not entry.is_file() or not entry.name.lower().endswith(FRAME_EXTENSIONS):
+                continue
+            modified_at = entry.stat().st_mtime
+            if now - modified_at >= settle_time:
+                new_files.append((modified_at, entry.name))
+        for modified_at, name in sorted(new_files):
+            seen.add(name)
+            with open(os.path.join(folder, name), "rb") as f:
+                image_bytes = f.read()
+            yield Frame(frame_idx, image_bytes, modified_at, name)
+            frame_idx += 1
+        time.sleep(poll_interval)
+
+
+def open_frame_source(source, poll_interval=0.5, realtime=True):
+    if os.path.isdir(source):
+        return iter_directory_frames(source, poll_interval=poll_interval)
+    return iter_video_frames(source, realtime=realtime)
+
+
+def dhash(image, hash_size=8) -> int:
+    """Difference hash: signs of the horizontal gradients of a tiny grayscale thumbnail as a 64-bit integer"""
+    if isinstance(image, (bytes, bytearray)):
+        image = Image.open(BytesIO(image))
+        # JPEG frames are decoded at a reduced scale, which is far faster than a full decode
+        image.draft("L", (hash_size * 8, hash_size * 8))
+    pixels = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR),
+                        dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+class DuplicateFilter:
+    """Skips frames whose dHash is within `threshold` bits of the last accepted frame. Frames are compared to the
+    last accepted frame rather than the previous one, so a slow drift of the scene is still picked up."""
+    def __init__(self, threshold=6, hash_size=8):
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.last_hash = None
+
+    def accept(self, frame: Frame) -> bool:
+        frame_hash = dhash(frame.image, self.hash_size)
+        if self.last_hash is not None and (frame_hash ^ self.last_hash).bit_count() <= self.threshold:
+            return False
+        self.last_hash = frame_hash
+        return True
+
+
+class LatestFrameSlot:
+    """Holds only the newest frame. A frame that is not taken before the next one arrives is dropped, so the
+    consumer always analyzes the most recent frame and the detection latency stays bounded."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, frame: Frame):
+        with self.condition:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.condition.notify()
+
+    def get(self) -> Frame | None:
+        """The newest frame, None once the slot is closed and empty"""
+        with self.condition:
+            while self.frame is None and not self.closed:
+                self.condition.wait()
+            frame, self.frame = self.frame, None
+            return frame
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class FrameStream:
+    """Reads frames in a background thread, skips near-duplicates and keeps the newest frame for the consumer"""
+    def __init__(self, frames, duplicate_filter=None):
+        self.frames = frames
+        self.duplicate_filter = duplicate_filter
+        self.slot = LatestFrameSlot()
+        self.stats = {"frames": 0, "duplicates": 0, "analyzed": 0}
+        self.error = None
+        self.thread = threading.Thread(target=self.read_frames, daemon=True)
+        self.thread.start()
+
+    def read_frames(self):
+        try:
+            for frame in self.frames:
+                self.stats["frames"] += 1
+                if self.duplicate_filter is not None and not self.duplicate_filter.accept(frame):
+                    self.stats["duplicates"] += 1
+                    continue
+                self.slot.put(frame)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.slot.close()
+
+    def __iter__(self):
+        while (frame := self.slot.get()) is not None:
+            self.stats["analyzed"] += 1
+            yield frame
+        if self.error is not None:
+            raise self.error
+
+    def summary(self) -> str:
+        return (f"{self.stats['frames']} frames, {self.stats['duplicates']} near-duplicates skipped, "
+                f"{self.slot.dropped} stale frames dropped, {self.stats['analyzed']} analyzed")
+
+
+def analyze_frame_stream(frame_stream: FrameStream, vlm, response_parser, full_prompt, response_schema,
+                         output=sys.stdout):
+    """Analyze the newest frame of the stream until it ends and write one JSON line per analyzed frame. A frame
+    whose request fails (e.g. retries exhausted or an open circuit breaker) gets the status "error" and the
+    stream goes on with the next frame."""
+    for frame in frame_stream:
+        start = time.perf_counter()
+        error = None
+        try:
+            with vlm.telemetry.request(frame.frame_idx):
+                image = vlm.image_encoder.encode(frame.image)
+                response = vlm.generate_structured_response_from_pil_image(full_prompt, image, response_schema)
+                prediction, status = response_parser.parse_dict(response)
+        except Exception as e:
+            prediction, status, error = None, "error", f"{type(e).__name__}: {e}"
+        result = {"frame_idx": frame.frame_idx, "name": frame.name, "captured_at": frame.captured_at,
+                  "inference_ms": round((time.perf_counter() - start) * 1000, 1),
+                  # Time from capture to result, including the wait for the previous frame
+                  "latency_ms": round((time.time() - frame.captured_at) * 1000, 1),
+                  "status": status, "prediction": prediction}
+        if error is not None:
+            result["error"] = error
+        output.write(json.dumps(result) + "\n")
+        output.flush()
@@ -1,14 +1,23 @@
 from google import genai
 from google.genai import types
 from PIL import Image
-import time
 import os
+from evaluation.batch_jobs import run_batch_job, wait_for_batch_job
+from evaluation.image_encoding import EncodedImage, ImageEncoder
+from evaluation.traffic_control import TrafficController, estimate_tokens, estimate_images_tokens
+from evaluation.telemetry import Telemetry
 
 class GoogleAPI:
-    def __init__(self, model_name, temperature=0.0):
+    def __init__(self, model_name, temperature=0.0, response_cache=None, image_encoder=None, traffic_controller=None,
+                 telemetry=None):
         # Setup VLM API
         self.model_name = model_name
         self.temperature = temperature
+        self.response_cache = response_cache
+        self.image_encoder = image_encoder if image_encoder is not None else ImageEncoder()
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.traffic_controller = (traffic_controller if traffic_controller is not None 
+                                   else TrafficController(telemetry=self.telemetry))
         api_key = os.environ["GOOGLE_API_KEY"]
         self.client = genai.Client(api_key=api_key)
         print(f"Connected to {self.model_name}")
@@ -18,13 +27,189 @@ class GoogleAPI:
         config = types.GenerateContentConfig(temperature=self.temperature, response_mime_type="application/json",
                                              response_schema=response_schema)
 
-        while True:
-            try:
-                response = self.client.models.generate_content(model=self.model_name, 
-                                        contents=[pil_image, full_prompt], config=config)
-                break
-            except Exception as e:
-                print(f"Error: {e}. Retrying in 5 seconds...")
-                time.sleep(5)
+        pil_image = self.image_encoder.encode(pil_image)
+        cache_key, cached_response = self.get_cached_response(full_prompt, pil_image, response_schema)
+        if cached_response is not None:
+            return cached_response
 
-        return response.text
+        with self.telemetry.span("serialize"):
+            contents = [self.create_image_part(pil_image), full_prompt]
+
+        def request():
+            with self.telemetry.span("network"):
+                return self.client.models.generate_content(model=self.model_name, contents=contents, config=config)
+
+        response = self.traffic_controller.call(
+            request, estimated_tokens=estimate_tokens(full_prompt, pil_image.size), get_token_usage=get_token_usage
+        )
+        response_text = self.parse_response(response)
+        self.put_cached_response(cache_key, response_text)
+        return response_text
+
+    def generate_structured_response_from_pil_images(self, full_prompt: str, pil_images: list[Image.Image],
+                                                     response_schema: type) -> str:
+        """One request with several numbered images, e.g. for request packing. Responses are not cached, as the
+        answer for an image may depend on the other images of the request."""
+        config = types.GenerateContentConfig(temperature=self.temperature, response_mime_type="application/json",
+                                             response_schema=response_schema)
+        pil_images = [self.image_encoder.encode(pil_image) for pil_image in pil_images]
+        with self.telemetry.span("serialize"):
+            contents = self.create_packed_contents(full_prompt, pil_images)
+
+        def request():
+            with self.telemetry.span("network"):
+                return self.client.models.generate_content(model=self.model_name, contents=contents, config=config)
+
+        response = self.traffic_controller.call(
+            request, estimated_tokens=estimate_images_tokens(full_prompt, pil_images), get_token_usage=get_token_usage
+        )
+        return self.parse_response(response)
+
+    def get_cached_response(self, full_prompt: str, pil_image: EncodedImage, 
+                            response_schema: type) -> tuple[str | None, str | None]:
+        """Return the cache key and the cached response, both are None without a response cache"""
+        if self.response_cache is None:
+            return None, None
+        with self.telemetry.span("cache"):
+            cache_key = self.response_cache.create_key(self, full_prompt, pil_image, response_schema)
+            cached_response = self.response_cache.get(cache_key)
+        if cached_response is not None:
+            self.telemetry.record_cache_hit()
+        return cache_key, cached_response
+
+    def put_cached_response(self, cache_key: str | None, response_text: str):
+        if self.response_cache is not None:
+            with self.telemetry.span("cache"):
+                self.response_cache.put(cache_key, response_text)
+
+    def parse_response(self, response: types.GenerateContentResponse) -> str:
+        with self.telemetry.span("parse"):
+            if response.usage_metadata is not None:
+                self.telemetry.record_tokens(response.usage_metadata.prompt_token_count, 
+                                             response.usage_metadata.candidates_token_count)
+            return response.text
+
+    def create_image_part(self, pil_image: Image.Image | EncodedImage) -> types.Part:
+        encoded_image = self.image_encoder.encode(pil_image)
+        return types.Part.from_bytes(data=encoded_image.data, mime_type=encoded_image.mime_type)
+
+    def create_packed_contents(self, full_prompt: str, pil_images: list) -> list:
+        # Every image is preceded by its number, the answers are given in this order
+        contents = []
+        for image_idx, pil_image in enumerate(pil_images):
+            contents += [f"Image {image_idx + 1}:", self.create_image_part(pil_image)]
+        return contents + [full_prompt]
+
+    def generate_structured_response_from_pil_image_batch(self, full_prompts: list[str], pil_images: list[Image.Image],
+                                                          response_schema: type, batch_folder: str = "batch_jobs",
+                                                          executor=None) -> list[str]:
+        return run_batch_job(self, full_prompts, pil_images, response_schema, batch_folder=batch_folder, 
+                             executor=executor)
+
+    def create_batch_request(self, custom_id: str, full_prompt: str, pil_image: Image.Image, 
+                             response_schema: dict) -> dict:
+        # Request line in the Gemini Batch Mode format, the image is sent inline like in the interactive API
+        encoded_image = self.image_encoder.encode(pil_image)
+        return {
+            "key": custom_id,
+            "request": {
+                "contents": [{
+                    "role": "user",
+                    "parts": [
+                        {"inline_data": {"mime_type": encoded_image.mime_type, "data": encoded_image.to_base64()}},
+                        {"text": full_prompt},
+                    ],
+                }],
+                "generation_config": {
+                    "temperature": self.temperature,
+                    "response_mime_type": "application/json",
+                    "response_json_schema": response_schema,
+                },
+            },
+        }
+
+    def run_batch_job(self, requests_file: str, results_file: str, poll_interval: int = 30):
+        batch_input_file = self.client.files.upload(file=requests_file, 
+                                                    config=types.UploadFileConfig(mime_type="jsonl"))
+        batch_job = self.client.batches.create(model=self.model_name, src=batch_input_file.name)
+        print(f"Batch job {batch_job.name} submitted")
+
+        status = wait_for_batch_job(lambda: self.client.batches.get(name=batch_job.name).state.name,
+                                    terminal_states={"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", 
+                                                     "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"},
+                                    poll_interval=poll_interval)
+        batch_job = self.client.batches.get(name=batch_job.name)
+        if batch_job.dest is None or batch_job.dest.file_name is None:
+            raise RuntimeError(f"Batch job {batch_job.name} ended with status {status} and no output file")
+
+        with open(results_file, "wb") as f:
+            f.write(self.client.files.download(file=batch_job.dest.file_name))
+
+    def execute_batch_request(self, batch_request: dict) -> dict:
+        # Run a single batch request line against the interactive endpoint, used by LocalBatchExecutor
+        try:
+            request = batch_request["request"]
+            response = self.traffic_controller.call(
+                lambda: self.client.models.generate_content(model=self.model_name, contents=request["contents"],
+                                                            config=request["generation_config"]))
+            return {"key": batch_request["key"], "response": response.model_dump(mode="json", exclude_none=True)}
+        except Exception as e:
+            return {"key": batch_request["key"], "error": {"message": str(e)}}
+
+    def parse_batch_result(self, batch_result: dict) -> tuple[str, str | None]:
+        if "error" in batch_result or "response" not in batch_result:
+            return batch_result["key"], None
+        response = types.GenerateContentResponse.model_validate(batch_result["response"])
+        return batch_result["key"], response.text
+
+class AsyncGoogleAPI(GoogleAPI):
+    """GoogleAPI variant using the asyncio interface of the shared genai client for concurrent requests"""
+    async def generate_structured_response_from_pil_image(self, full_prompt: str, pil_image: Image.Image, 
+                                                          response_schema: type) -> str:
+        config = types.GenerateContentConfig(temperature=self.temperature, response_mime_type="application/json",
+                                             response_schema=response_schema)
+
+        pil_image = self.image_encoder.encode(pil_image)
+        cache_key, cached_response = self.get_cached_response(full_prompt, pil_image, response_schema)
+        if cached_response is not None:
+            return cached_response
+
+        with self.telemetry.span("serialize"):
+            contents = [self.create_image_part(pil_image), full_prompt]
+
+        async def request():
+            with self.telemetry.span("network"):
+                return await self.client.aio.models.generate_content(model=self.model_name, contents=contents, 
+                                                                     config=config)
+
+        response = await self.traffic_controller.call_async(
+            request, estimated_tokens=estimate_tokens(full_prompt, pil_image.size), get_token_usage=get_token_usage
+        )
+        response_text = self.parse_response(response)
+        self.put_cached_response(cache_key, response_text)
+        return response_text
+
+    async def generate_structured_response_from_pil_images(self, full_prompt: str, pil_images: list[Image.Image],
+                                                           response_schema: type) -> str:
+        config = types.GenerateContentConfig(temperature=self.temperature, response_mime_type="application/json",
+                                             response_schema=response_schema)
+        pil_images = [self.image_encoder.encode(pil_image) for pil_image in pil_images]
+        with self.telemetry.span("serialize"):
+            contents = self.create_packed_contents(full_prompt, pil_images)
+
+        async def request():
+            with self.telemetry.span("network"):
+                return await self.client.aio.models.generate_content(model=self.model_name, contents=contents, 
+                                                                     config=config)
+
+        response = await self.traffic_controller.call_async(
+            request, estimated_tokens=estimate_images_tokens(full_prompt, pil_images), get_token_usage=get_token_usage
+        )
+        return self.parse_response(response)
+
+    async def aclose(self):
+        await self.client.aio.aclose()
+
+
+def get_token_usage(response) -> int | None:
+    return response.usage_metadata.total_token_count if response.usage_metadata is not None else None
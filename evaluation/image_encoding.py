@@ -0,0 +1,113 @@
+import base64
+import math
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import NamedTuple
+from PIL import Image
+
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+class EncodedImage(NamedTuple):
+    """Image bytes as they are sent to the VLM"""
+    mime_type: str
+    data: bytes
+    size: tuple[int, int]
+
+    def to_base64(self) -> str:
+        return base64.b64encode(self.data).decode("utf-8")
+
+    def to_data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{self.to_base64()}"
+
+
+class ImageEncoder:
+    """Encodes images for upload: optional downscaling to a pixel budget, re-encoding as PNG/JPEG/WebP and
+    pass-through of JPEG source bytes that need no resizing.
+
+    Accepts PIL images, raw encoded bytes and undecoded dataset images ({"bytes": ..., "path": ...}, e.g. from
+    `dataset.cast_column("image", datasets.Image(decode=False))`). Only the latter two can be passed through."""
+    def __init__(self, image_format="PNG", quality=90, max_pixels=None, passthrough=True):
+        image_format = image_format.upper()
+        if image_format not in MIME_TYPES:
+            raise ValueError(f"Unsupported image format {image_format}, use one of {list(MIME_TYPES)}")
+        self.image_format = image_format
+        self.quality = quality
+        self.max_pixels = max_pixels
+        self.passthrough = passthrough
+
+    def __repr__(self):
+        return (f"ImageEncoder(image_format={self.image_format!r}, quality={self.quality}, "
+                f"max_pixels={self.max_pixels}, passthrough={self.passthrough})")
+
+    def encode(self, image) -> EncodedImage:
+        pil_image = self.decode(image)
+        if isinstance(pil_image, EncodedImage):
+            return pil_image
+
+        pil_image = self.resize(pil_image)
+        if self.image_format == "JPEG" and pil_image.mode not in ("RGB", "L"):
+            pil_image = pil_image.convert("RGB")
+        elif self.image_format == "WEBP" and pil_image.mode not in ("RGB", "RGBA"):
+            has_alpha = pil_image.mode in ("LA", "PA") or "transparency" in pil_image.info
+            pil_image = pil_image.convert("RGBA" if has_alpha else "RGB")
+
+        buffered = BytesIO()
+        if self.image_format == "PNG":
+            pil_image.save(buffered, format="PNG")
+        else:
+            pil_image.save(buffered, format=self.image_format, quality=self.quality)
+        return EncodedImage(MIME_TYPES[self.image_format], buffered.getvalue(), pil_image.size)
+
+    def decode(self, image) -> Image.Image | EncodedImage:
+        """Decode the pixels of an image, images that are passed through are returned as EncodedImage instead"""
+        if isinstance(image, EncodedImage):
+            return image
+        source_bytes = get_source_bytes(image)
+        if source_bytes is None:
+            return image
+
+        # Opening only reads the header, so pass-through images are never decoded
+        pil_image = Image.open(BytesIO(source_bytes))
+        if self.passthrough and pil_image.format == "JPEG" and self.fits_pixel_budget(pil_image.size):
+            return EncodedImage("image/jpeg", source_bytes, pil_image.size)
+        pil_image.load()
+        return pil_image
+
+    def fits_pixel_budget(self, size) -> bool:
+        return self.max_pixels is None or size[0] * size[1] <= self.max_pixels
+
+    def resize(self, pil_image: Image.Image) -> Image.Image:
+        if self.fits_pixel_budget(pil_image.size):
+            return pil_image
+        # Keep the aspect ratio and stay within the pixel budget
+        scale = math.sqrt(self.max_pixels / (pil_image.size[0] * pil_image.size[1]))
+        new_size = (max(1, int(pil_image.size[0] * scale)), max(1, int(pil_image.size[1] * scale)))
+        return pil_image.resize(new_size, Image.Resampling.BICUBIC)
+
+
+def get_source_bytes(image) -> bytes | None:
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    if isinstance(image, dict):
+        if image.get("bytes") is not None:
+            return image["bytes"]
+        with open(image["path"], "rb") as f:
+            return f.read()
+    return None
+
+
+def encode_ahead(samples, image_encoder, encode_workers=4, lookahead=32):
+    """Yield (sample_idx, sample) pairs with sample["image"] replaced by an EncodedImage. Images are encoded in a
+    process pool up to `lookahead` samples ahead of the consumer, samples keep their order."""
+    with ProcessPoolExecutor(max_workers=encode_workers) as pool:
+        pending = deque()
+        for sample_idx, sample in samples:
+            pending.append((sample_idx, sample, pool.submit(image_encoder.encode, sample["image"])))
+            if len(pending) >= lookahead:
+                sample_idx, sample, future = pending.popleft()
+                yield sample_idx, {**sample, "image": future.result()}
+        while pending:
+            sample_idx, sample, future = pending.popleft()
+            yield sample_idx, {**sample, "image": future.result()}
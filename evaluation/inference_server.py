@@ -0,0 +1,173 @@
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import threading
+import concurrent.futures
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import UnidentifiedImageError
+from evaluation.response_parser import ResponseParser
+from evaluation.request_packing import PackedVLM
+from evaluation.telemetry import request_context
+
+
+class RequestDeduplicator:
+    """Sends every request to the async backend right away, vLLM batches concurrent requests on the GPU itself.
+    A request with the same image bytes as a request in flight waits for its response instead of sending another
+    VLM request. A VLM request whose clients all left (e.g. timed out) is cancelled, so it frees the backend."""
+    def __init__(self, vlm, full_prompt, response_schema):
+        self.vlm = vlm
+        self.full_prompt = full_prompt
+        self.response_schema = response_schema
+        self.in_flight = {}
+        self.stats = {"requests": 0, "vlm_requests": 0, "deduplicated": 0}
+
+    async def submit(self, image) -> str:
+        """Response text of the VLM for an encoded image"""
+        image_hash = hashlib.sha256(image.data).digest()
+        self.stats["requests"] += 1
+        entry = self.in_flight.get(image_hash)
+        if entry is None:
+            self.stats["vlm_requests"] += 1
+            task = asyncio.create_task(self.vlm.generate_structured_response_from_pil_image(
+                self.full_prompt, image, self.response_schema))
+            entry = {"task": task, "waiters": 0}
+            self.in_flight[image_hash] = entry
+            task.add_done_callback(lambda _: self.release(image_hash, entry))
+        else:
+            self.stats["deduplicated"] += 1
+
+        entry["waiters"] += 1
+        try:
+            return await asyncio.shield(entry["task"])
+        finally:
+            entry["waiters"] -= 1
+            if entry["waiters"] == 0 and not entry["task"].done():
+                entry["task"].cancel()
+
+    def release(self, image_hash, entry):
+        if self.in_flight.get(image_hash) is entry:
+            del self.in_flight[image_hash]
+
+
+class InferenceServer:
+    """Long-running HTTP service around an async backend, so clients skip interpreter startup, imports and the
+    connection setup of every call. The backend runs on an asyncio event loop in a background thread, the HTTP
+    handler threads decode and encode the images and wait for the results. Identical images in flight share one
+    VLM request, with a PackedVLM backend the images of concurrent requests are packed into multi-image requests.
+
+    Endpoints:
+    - POST /v1/detect with the image bytes as body (or JSON {"image": <base64>}), answers with the parsed
+      response schema fields as "prediction", the parse "status" and the "latency_ms"
+    - GET /health with the model name and request stats"""
+    def __init__(self, vlm, full_prompt, response_schema, host="127.0.0.1", port=8090, request_timeout=300):
+        self.vlm = vlm
+        self.response_parser = ResponseParser(response_schema, recover_partial=True)
+        self.request_timeout = request_timeout
+        self.deduplicator = RequestDeduplicator(vlm, full_prompt, response_schema)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        self.httpd = InferenceHTTPServer((host, port), create_request_handler(self))
+
+    def run_coroutine(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def detect(self, image_bytes: bytes) -> dict:
+        start = time.perf_counter()
+        with self.vlm.telemetry.request() as request_record:
+            # Encoding runs in the handler thread, the event loop only dispatches requests
+            with self.vlm.telemetry.span("encode"):
+                image = self.vlm.image_encoder.encode(image_bytes)
+            future = self.run_coroutine(self.submit(image, request_record))
+            try:
+                response = future.result(timeout=self.request_timeout)
+            except concurrent.futures.TimeoutError:
+                # The abandoned request must not keep using the backend
+                future.cancel()
+                raise
+            prediction, status = self.response_parser.parse_dict(response)
+        return {"prediction": prediction, "status": status,
+                "latency_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+    async def submit(self, image, request_record):
+        # The coroutine runs on the event loop thread, which does not share the context of the handler thread
+        with request_context(request_record):
+            return await self.deduplicator.submit(image)
+
+    def health(self) -> dict:
+        health = {"status": "ok", "model": self.vlm.model_name, "stats": dict(self.deduplicator.stats)}
+        if isinstance(self.vlm, PackedVLM):
+            health["packing"] = dict(self.vlm.stats)
+        return health
+
+    def serve_forever(self):
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        self.httpd.server_close()
+        self.run_coroutine(self.vlm.aclose()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class InferenceHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def create_request_handler(server: InferenceServer):
+    class InferenceRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/health":
+                self.send_json(200, server.health())
+            else:
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path.rstrip("/") != "/v1/detect":
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    image_bytes = base64.b64decode(json.loads(body)["image"])
+                else:
+                    image_bytes = body
+                if not image_bytes:
+                    raise ValueError("Empty image")
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {"error": f"Invalid request: {e}"})
+                return
+            try:
+                self.send_json(200, server.detect(image_bytes))
+            except UnidentifiedImageError as e:
+                self.send_json(400, {"error": f"Invalid image: {e}"})
+            except concurrent.futures.TimeoutError:
+                self.send_json(504, {"error": f"No response within {server.request_timeout} s"})
+            except Exception as e:
+                self.send_json(502, {"error": f"{type(e).__name__}: {e}"})
+
+        def send_json(self, status_code, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return InferenceRequestHandler
@@ -0,0 +1,116 @@
+import time
+import threading
+from contextlib import contextmanager
+import httpx
+from evaluation.traffic_control import RETRYABLE, classify_error
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.total_latency = 0.0
+
+
+class LoadBalancer:
+    """Routes requests to the healthy endpoint with the fewest outstanding requests. Endpoints are removed after
+    `failure_threshold` consecutive failed requests or a failed health check on /models, and re-added once a
+    health check succeeds again. Health checks run every `health_check_interval` seconds in a background thread."""
+    def __init__(self, urls, health_check_interval=10, failure_threshold=3, health_check_timeout=5):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.health_check_interval = health_check_interval
+        self.failure_threshold = failure_threshold
+        self.health_check_timeout = health_check_timeout
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.stopped = threading.Event()
+
+        self.check_health()
+        self.thread = threading.Thread(target=self.run_health_checks, daemon=True)
+        self.thread.start()
+
+    @property
+    def healthy_urls(self):
+        return [endpoint.url for endpoint in self.endpoints if endpoint.healthy]
+
+    def acquire(self) -> Endpoint:
+        with self.lock:
+            # Without healthy endpoints all are tried, the retries of the traffic controller then find a recovered one
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.healthy] or self.endpoints
+            # Rotate the start, so ties don't always go to the first endpoint
+            self.next_index = (self.next_index + 1) % len(candidates)
+            candidates = candidates[self.next_index:] + candidates[:self.next_index]
+            endpoint = min(candidates, key=lambda candidate: candidate.outstanding)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, latency: float, error=None):
+        with self.lock:
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+            endpoint.total_latency += latency
+            # Only connection errors and server errors count against an endpoint, not e.g. invalid requests
+            if error is not None and classify_error(error) == RETRYABLE:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.healthy and endpoint.consecutive_failures >= self.failure_threshold:
+                    endpoint.healthy = False
+                    print(f"Removed endpoint {endpoint.url} after {endpoint.consecutive_failures} failed requests")
+            elif error is None:
+                endpoint.consecutive_failures = 0
+
+    @contextmanager
+    def route(self):
+        """Acquire an endpoint for one request and release it with the outcome of the request"""
+        endpoint = self.acquire()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield endpoint
+        except BaseException as e:
+            # A cancelled request (asyncio.CancelledError) only frees its slot, it counts neither for nor against
+            # the endpoint
+            error = e
+            raise
+        finally:
+            self.release(endpoint, time.perf_counter() - start, error=error)
+
+    def check_health(self):
+        for endpoint in self.endpoints:
+            try:
+                healthy = httpx.get(f"{endpoint.url.rstrip('/')}/models",
+                                    timeout=self.health_check_timeout).status_code == 200
+            except httpx.HTTPError:
+                healthy = False
+            with self.lock:
+                if healthy and not endpoint.healthy:
+                    print(f"Re-added endpoint {endpoint.url}")
+                    endpoint.consecutive_failures = 0
+                elif not healthy and endpoint.healthy:
+                    print(f"Removed endpoint {endpoint.url} after a failed health check")
+                endpoint.healthy = healthy
+
+    def run_health_checks(self):
+        while not self.stopped.wait(self.health_check_interval):
+            self.check_health()
+
+    def stats(self) -> list[dict]:
+        with self.lock:
+            return [{"url": endpoint.url, "healthy": endpoint.healthy, "requests": endpoint.requests,
+                     "failures": endpoint.failures, "outstanding": endpoint.outstanding,
+                     "mean_latency_ms": round(endpoint.total_latency * 1000 / endpoint.requests, 1)
+                     if endpoint.requests > 0 else 0.0} for endpoint in self.endpoints]
+
+    def print_stats(self):
+        print("\nEndpoints:")
+        for endpoint_stats in self.stats():
+            print(f"{endpoint_stats['url']}: {'healthy' if endpoint_stats['healthy'] else 'removed'}, "
+                  f"{endpoint_stats['requests']} requests, {endpoint_stats['failures']} failures, "
+                  f"mean latency {endpoint_stats['mean_latency_ms']} ms")
+
+    def close(self):
+        self.stopped.set()
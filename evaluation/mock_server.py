@@ -0,0 +1,206 @@
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from templates.answer_schema import smoke_detection_schema
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # Connection bursts of highly concurrent clients
+
+
+class MockVLMServer:
+    """Local OpenAI-compatible stand-in for a VLM server, answering chat completions with random schema-valid
+    responses after a sampled latency. A share of the requests fails with HTTP 500 (`error_rate`) or is throttled
+    with HTTP 429 and a Retry-After header (`throttle_rate`). With `max_concurrency`, requests beyond it queue like
+    on a saturated GPU. Used to benchmark the client side without a GPU."""
+    def __init__(self, host="127.0.0.1", port=8011, model_name="mock-vlm", latency_ms=200.0,
+                 latency_distribution="lognormal", latency_sigma=0.5, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=1, max_concurrency=None, response_schema=smoke_detection_schema, seed=None):
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {latency_distribution}, use one of {LATENCY_DISTRIBUTIONS}")
+        self.model_name = model_name
+        self.latency_ms = latency_ms
+        self.latency_distribution = latency_distribution
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        # Like the batch capacity of a GPU, further requests queue until a slot is free
+        self.slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self.response_schema = response_schema
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "throttled": 0}
+
+        self.httpd = MockHTTPServer((host, port), create_request_handler(self))
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def sample_latency(self) -> float:
+        """Latency in seconds, `latency_ms` is the mean (the median for lognormal)"""
+        with self.rng_lock:
+            if self.latency_distribution == "fixed":
+                latency_ms = self.latency_ms
+            elif self.latency_distribution == "uniform":
+                latency_ms = self.rng.uniform(0, 2 * self.latency_ms)
+            elif self.latency_distribution == "exponential":
+                latency_ms = self.rng.expovariate(1 / self.latency_ms) if self.latency_ms > 0 else 0.0
+            else:
+                latency_ms = self.rng.lognormvariate(math.log(max(self.latency_ms, 1e-3)), self.latency_sigma)
+        return latency_ms / 1000
+
+    def sample_outcome(self) -> str:
+        with self.rng_lock:
+            draw = self.rng.random()
+        if draw < self.throttle_rate:
+            return "throttled"
+        if draw < self.throttle_rate + self.error_rate:
+            return "error"
+        return "ok"
+
+    def create_response(self, response_schema=None) -> dict:
+        with self.rng_lock:
+            return create_random_response(response_schema or self.response_schema, self.rng)
+
+    def create_chat_completion(self, request_body: dict, request_size: int) -> dict:
+        # Answers follow the schema of the request if it has one, e.g. of packed requests with several images
+        response_format = request_body.get("response_format") or {}
+        content = json.dumps(self.create_response(response_format.get("json_schema", {}).get("schema")))
+        # Rough usage numbers, so token based rate limiting can be exercised
+        prompt_tokens = request_size // 4
+        completion_tokens = len(content) // 4
+        return {
+            "id": f"chatcmpl-mock-{self.stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request_body.get("model") or self.model_name,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def create_request_handler(server: MockVLMServer):
+    class MockRequestHandler(BaseHTTPRequestHandler):
+        # HTTP/1.1 keeps connections alive like a real server, so client connection pooling is measured too
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, Nagle's algorithm would add a delayed ACK to every response
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/v1/models":
+                self.send_json(200, {"object": "list", "data": [{"id": server.model_name, "object": "model",
+                                                                  "owned_by": "mock"}]})
+            else:
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+        def do_POST(self):
+            request_size = int(self.headers.get("Content-Length", 0))
+            request_body = json.loads(self.rfile.read(request_size) or b"{}")
+            if self.path.rstrip("/") != "/v1/chat/completions":
+                self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+
+            server.stats["requests"] += 1
+            if server.slots is not None:
+                with server.slots:
+                    time.sleep(server.sample_latency())
+            else:
+                time.sleep(server.sample_latency())
+            outcome = server.sample_outcome()
+            if outcome == "throttled":
+                server.stats["throttled"] += 1
+                self.send_json(429, {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error"}},
+                               headers={"Retry-After": str(server.retry_after)})
+            elif outcome == "error":
+                server.stats["errors"] += 1
+                self.send_json(500, {"error": {"message": "Internal server error", "type": "server_error"}})
+            else:
+                self.send_json(200, server.create_chat_completion(request_body, request_size))
+
+        def send_json(self, status_code, body, headers=None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockRequestHandler
+
+
+def create_random_response(response_schema: dict, rng: random.Random):
+    """Random response that is valid under the enum fields of the response schema, arrays get minItems items"""
+    if response_schema.get("type") == "array":
+        item_count = response_schema.get("minItems", 1)
+        return [create_random_response(response_schema["items"], rng) for _ in range(item_count)]
+    if "enum" in response_schema:
+        return rng.choice(response_schema["enum"])
+    return {field: create_random_response(response_schema["properties"][field], rng) 
+            for field in response_schema["required"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local OpenAI-compatible mock VLM server')
+    parser.add_argument('--host', type=str, help='Host to bind to', default="127.0.0.1")
+    parser.add_argument('--port', type=int, help='Port to listen on', default=8011)
+    parser.add_argument('--model_name', type=str, help='Model name reported by /v1/models', default="mock-vlm")
+    parser.add_argument('--latency_ms', type=float, help='Mean response latency in ms', default=200)
+    parser.add_argument('--latency_distribution', type=str, choices=LATENCY_DISTRIBUTIONS, default="lognormal",
+                        help='Distribution of the response latency')
+    parser.add_argument('--latency_sigma', type=float, help='Sigma of the lognormal latency distribution',
+                        default=0.5)
+    parser.add_argument('--error_rate', type=float, help='Share of requests failing with HTTP 500', default=0.0)
+    parser.add_argument('--throttle_rate', type=float, help='Share of requests throttled with HTTP 429', default=0.0)
+    parser.add_argument('--max_concurrency', type=int, help='Requests processed at once, others queue', 
+                        default=None)
+    parser.add_argument('--seed', type=int, help='Random seed', default=None)
+    args = parser.parse_args()
+
+    server = MockVLMServer(host=args.host, port=args.port, model_name=args.model_name, latency_ms=args.latency_ms,
+                           latency_distribution=args.latency_distribution, latency_sigma=args.latency_sigma,
+                           error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                           max_concurrency=args.max_concurrency, seed=args.seed)
+    print(f"Mock VLM server listening on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,35 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
+import httpx
 import time
 from PIL import Image
-import base64
-from io import BytesIO
 import os
+from evaluation.batch_jobs import run_batch_job, wait_for_batch_job
+from evaluation.image_encoding import EncodedImage, ImageEncoder
+from evaluation.traffic_control import TrafficController, estimate_tokens, estimate_images_tokens
+from evaluation.telemetry import Telemetry
+from evaluation.load_balancer import LoadBalancer
 
 class OpenAIAPI:
-    def __init__(self, base_url="http://localhost:8000/v1", model_name=None, temperature=0.0):
+    def __init__(self, base_url="http://localhost:8000/v1", model_name=None, temperature=0.0, response_cache=None,
+                 image_encoder=None, traffic_controller=None, telemetry=None, health_check_interval=10):
         # Setup VLM API
         self.model_name = model_name 
         self.temperature = temperature
+        self.response_cache = response_cache
+        self.image_encoder = image_encoder if image_encoder is not None else ImageEncoder()
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.traffic_controller = (traffic_controller if traffic_controller is not None 
+                                   else TrafficController(telemetry=self.telemetry))
         self.connection_timeout = 5  # Time to wait before trying to connect again
-        self.vlm_client = self.connect_to_vlm(base_url)
+        # Several base URLs of servers with the same model are load balanced
+        self.base_urls = list(base_url) if isinstance(base_url, (list, tuple)) else [base_url]
+        self.vlm_clients = {url: self.connect_to_vlm(url) for url in self.base_urls}
+        self.load_balancer = None
+        if len(self.base_urls) > 1:
+            self.load_balancer = LoadBalancer(self.base_urls, health_check_interval=health_check_interval)
+        # Models are listed on a healthy server
+        healthy_urls = self.load_balancer.healthy_urls if self.load_balancer is not None else []
+        self.vlm_client = self.vlm_clients[healthy_urls[0] if healthy_urls else self.base_urls[0]]
 
         if model_name is None:
             self.model_name = self.vlm_client.models.list().data[0].id
@@ -27,7 +45,8 @@ class OpenAIAPI:
                 else:
                     api_key = "empty"
                 print("Connecting to OpenAI API endpoint...")
-                vlm_client = OpenAI(api_key=api_key, base_url=base_url)
+                # Retries are handled by the traffic controller
+                vlm_client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
                 return vlm_client
             except Exception as e:
                 print("No model on this API yet...", e)
@@ -36,11 +55,83 @@ class OpenAIAPI:
     
     def generate_structured_response_from_pil_image(self, full_prompt: str, pil_image: Image.Image, 
                                                     response_schema: dict) -> str:
-        chat_completion_from_base64 = self.vlm_client.chat.completions.create(
-            messages=self.create_vlm_messages(full_prompt, pil_image),
-            model=self.model_name,
-            temperature=self.temperature,
-            response_format={
+        pil_image = self.image_encoder.encode(pil_image)
+        cache_key, cached_response = self.get_cached_response(full_prompt, pil_image, response_schema)
+        if cached_response is not None:
+            return cached_response
+
+        with self.telemetry.span("serialize"):
+            completion_kwargs = self.create_completion_kwargs(full_prompt, pil_image, response_schema)
+
+        def request():
+            with self.telemetry.span("network"):
+                return self.create_chat_completion(completion_kwargs)
+
+        chat_completion_from_base64 = self.traffic_controller.call(
+            request, estimated_tokens=estimate_tokens(full_prompt, pil_image.size), get_token_usage=get_token_usage
+        )
+        response = self.parse_chat_completion(chat_completion_from_base64)
+        self.put_cached_response(cache_key, response)
+        return response
+
+    def generate_structured_response_from_pil_images(self, full_prompt: str, pil_images: list[Image.Image],
+                                                     response_schema: dict) -> str:
+        """One request with several numbered images, e.g. for request packing. Responses are not cached, as the
+        answer for an image may depend on the other images of the request."""
+        pil_images = [self.image_encoder.encode(pil_image) for pil_image in pil_images]
+        with self.telemetry.span("serialize"):
+            completion_kwargs = self.create_completion_kwargs(full_prompt, pil_images, response_schema)
+
+        def request():
+            with self.telemetry.span("network"):
+                return self.create_chat_completion(completion_kwargs)
+
+        chat_completion = self.traffic_controller.call(
+            request, estimated_tokens=estimate_images_tokens(full_prompt, pil_images), get_token_usage=get_token_usage
+        )
+        return self.parse_chat_completion(chat_completion)
+
+    def create_chat_completion(self, completion_kwargs: dict):
+        if self.load_balancer is None:
+            return self.vlm_client.chat.completions.create(**completion_kwargs)
+        with self.load_balancer.route() as endpoint:
+            return self.vlm_clients[endpoint.url].chat.completions.create(**completion_kwargs)
+
+    def get_cached_response(self, full_prompt: str, pil_image: EncodedImage, 
+                            response_schema: dict) -> tuple[str | None, str | None]:
+        """Return the cache key and the cached response, both are None without a response cache"""
+        if self.response_cache is None:
+            return None, None
+        with self.telemetry.span("cache"):
+            cache_key = self.response_cache.create_key(self, full_prompt, pil_image, response_schema)
+            cached_response = self.response_cache.get(cache_key)
+        if cached_response is not None:
+            self.telemetry.record_cache_hit()
+        return cache_key, cached_response
+
+    def put_cached_response(self, cache_key: str | None, response: str):
+        if self.response_cache is not None:
+            with self.telemetry.span("cache"):
+                self.response_cache.put(cache_key, response)
+
+    def parse_chat_completion(self, chat_completion) -> str:
+        with self.telemetry.span("parse"):
+            if chat_completion.usage is not None:
+                self.telemetry.record_tokens(chat_completion.usage.prompt_tokens, 
+                                             chat_completion.usage.completion_tokens)
+            return chat_completion.choices[0].message.content
+
+    def create_completion_kwargs(self, full_prompt: str, pil_image: Image.Image | EncodedImage | list, 
+                                 response_schema: dict) -> dict:
+        if isinstance(pil_image, list):
+            messages = self.create_packed_vlm_messages(full_prompt, pil_image)
+        else:
+            messages = self.create_vlm_messages(full_prompt, pil_image)
+        return {
+            "messages": messages,
+            "model": self.model_name,
+            "temperature": self.temperature,
+            "response_format": {
                 "type": "json_schema",
                 "json_schema": {
                     "name": "response",
@@ -48,11 +139,63 @@ class OpenAIAPI:
                     "schema": response_schema,
                 },
             }
-        )
-        return chat_completion_from_base64.choices[0].message.content
+        }
+
+    def generate_structured_response_from_pil_image_batch(self, full_prompts: list[str], pil_images: list[Image.Image],
+                                                          response_schema: dict, batch_folder: str = "batch_jobs",
+                                                          executor=None) -> list[str]:
+        return run_batch_job(self, full_prompts, pil_images, response_schema, batch_folder=batch_folder, 
+                             executor=executor)
+
+    def create_batch_request(self, custom_id: str, full_prompt: str, pil_image: Image.Image, 
+                             response_schema: dict) -> dict:
+        # Request line in the OpenAI Batch API format
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": self.create_completion_kwargs(full_prompt, pil_image, response_schema),
+        }
+
+    def run_batch_job(self, requests_file: str, results_file: str, poll_interval: int = 30):
+        with open(requests_file, "rb") as f:
+            batch_input_file = self.vlm_client.files.create(file=f, purpose="batch")
+        batch_job = self.vlm_client.batches.create(input_file_id=batch_input_file.id, endpoint="/v1/chat/completions",
+                                                   completion_window="24h")
+        print(f"Batch job {batch_job.id} submitted")
+
+        status = wait_for_batch_job(lambda: self.vlm_client.batches.retrieve(batch_job.id).status,
+                                    terminal_states={"completed", "failed", "expired", "cancelled"},
+                                    poll_interval=poll_interval)
+        batch_job = self.vlm_client.batches.retrieve(batch_job.id)
+        if batch_job.output_file_id is None:
+            raise RuntimeError(f"Batch job {batch_job.id} ended with status {status} and no output file")
 
-    def create_vlm_messages(self, full_prompt: str, pil_image: Image.Image) -> list[dict]:
-        image_url = f"data:image/jpeg;base64,{self.pil_image_to_base64(pil_image)}"
+        # Failed requests are reported in a separate error file with the same line format
+        with open(results_file, "w") as f:
+            f.write(self.vlm_client.files.content(batch_job.output_file_id).text)
+            if batch_job.error_file_id is not None:
+                f.write(self.vlm_client.files.content(batch_job.error_file_id).text)
+
+    def execute_batch_request(self, batch_request: dict) -> dict:
+        # Run a single batch request line against the interactive endpoint, used by LocalBatchExecutor
+        try:
+            chat_completion = self.traffic_controller.call(lambda: self.create_chat_completion(batch_request["body"]))
+            response = {"status_code": 200, "body": chat_completion.model_dump()}
+            error = None
+        except Exception as e:
+            response = None
+            error = {"code": type(e).__name__, "message": str(e)}
+        return {"custom_id": batch_request["custom_id"], "response": response, "error": error}
+
+    def parse_batch_result(self, batch_result: dict) -> tuple[str, str | None]:
+        response = batch_result.get("response")
+        if batch_result.get("error") is not None or response is None or response["status_code"] != 200:
+            return batch_result["custom_id"], None
+        return batch_result["custom_id"], response["body"]["choices"][0]["message"]["content"]
+
+    def create_vlm_messages(self, full_prompt: str, pil_image: Image.Image | EncodedImage) -> list[dict]:
+        image_url = self.image_encoder.encode(pil_image).to_data_url()
         messages=[
                     {
                     "role": "user",
@@ -71,10 +214,87 @@ class OpenAIAPI:
                     }
                 ]
         return messages
+
+    def create_packed_vlm_messages(self, full_prompt: str, pil_images: list) -> list[dict]:
+        # Every image is preceded by its number, the answers are given in this order
+        content = [{"type": "text", "text": full_prompt}]
+        for image_idx, pil_image in enumerate(pil_images):
+            content.append({"type": "text", "text": f"Image {image_idx + 1}:"})
+            image_url = self.image_encoder.encode(pil_image).to_data_url()
+            content.append({"type": "image_url", "image_url": {"url": image_url}})
+        return [{"role": "user", "content": content}]
     
 
     def pil_image_to_base64(self, pil_image: Image.Image) -> str:
-        buffered = BytesIO()
-        pil_image.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
-    
\ No newline at end of file
+        return self.image_encoder.encode(pil_image).to_base64()
+
+
+def get_token_usage(chat_completion) -> int | None:
+    return chat_completion.usage.total_tokens if chat_completion.usage is not None else None
+
+
+class AsyncOpenAIAPI(OpenAIAPI):
+    """OpenAIAPI variant with an asyncio client for concurrent requests on one pooled HTTP connection pool"""
+    def __init__(self, base_url="http://localhost:8000/v1", model_name=None, temperature=0.0, response_cache=None,
+                 image_encoder=None, traffic_controller=None, telemetry=None, health_check_interval=10, 
+                 max_connections=64):
+        # The sync clients are kept for model discovery, requests go through the pooled async clients
+        super().__init__(base_url=base_url, model_name=model_name, temperature=temperature, 
+                         response_cache=response_cache, image_encoder=image_encoder,
+                         traffic_controller=traffic_controller, telemetry=telemetry, 
+                         health_check_interval=health_check_interval)
+        self.async_vlm_clients = {}
+        for url, vlm_client in self.vlm_clients.items():
+            http_client = DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=max_connections,
+                                                                      max_keepalive_connections=max_connections))
+            self.async_vlm_clients[url] = AsyncOpenAI(api_key=vlm_client.api_key, base_url=url, 
+                                                      http_client=http_client, max_retries=0)
+        self.async_vlm_client = self.async_vlm_clients[self.base_urls[0]]
+
+    async def generate_structured_response_from_pil_image(self, full_prompt: str, pil_image: Image.Image, 
+                                                          response_schema: dict) -> str:
+        pil_image = self.image_encoder.encode(pil_image)
+        cache_key, cached_response = self.get_cached_response(full_prompt, pil_image, response_schema)
+        if cached_response is not None:
+            return cached_response
+
+        with self.telemetry.span("serialize"):
+            completion_kwargs = self.create_completion_kwargs(full_prompt, pil_image, response_schema)
+
+        async def request():
+            with self.telemetry.span("network"):
+                return await self.create_chat_completion_async(completion_kwargs)
+
+        chat_completion_from_base64 = await self.traffic_controller.call_async(
+            request, estimated_tokens=estimate_tokens(full_prompt, pil_image.size), get_token_usage=get_token_usage
+        )
+        response = self.parse_chat_completion(chat_completion_from_base64)
+        self.put_cached_response(cache_key, response)
+        return response
+
+    async def generate_structured_response_from_pil_images(self, full_prompt: str, pil_images: list[Image.Image],
+                                                           response_schema: dict) -> str:
+        pil_images = [self.image_encoder.encode(pil_image) for pil_image in pil_images]
+        with self.telemetry.span("serialize"):
+            completion_kwargs = self.create_completion_kwargs(full_prompt, pil_images, response_schema)
+
+        async def request():
+            with self.telemetry.span("network"):
+                return await self.create_chat_completion_async(completion_kwargs)
+
+        chat_completion = await self.traffic_controller.call_async(
+            request, estimated_tokens=estimate_images_tokens(full_prompt, pil_images), get_token_usage=get_token_usage
+        )
+        return self.parse_chat_completion(chat_completion)
+
+    async def create_chat_completion_async(self, completion_kwargs: dict):
+        if self.load_balancer is None:
+            return await self.async_vlm_client.chat.completions.create(**completion_kwargs)
+        with self.load_balancer.route() as endpoint:
+            return await self.async_vlm_clients[endpoint.url].chat.completions.create(**completion_kwargs)
+
+    async def aclose(self):
+        for async_vlm_client in self.async_vlm_clients.values():
+            await async_vlm_client.close()
+        if self.load_balancer is not None:
+            self.load_balancer.close()
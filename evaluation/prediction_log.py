@@ -0,0 +1,73 @@
+import os
+import json
+import threading
+
+
+class PredictionLog:
+    """Append-only JSONL checkpoint of predictions keyed by sample_idx, in the format written by
+    batch_evaluation.ipynb: {"sample_idx": ..., "gt_dict": ..., "vlm_prediction": ...}"""
+    def __init__(self, filename, resume=False, overwrite=False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.records = {}
+
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        if resume and os.path.exists(filename):
+            self.records = self.read_records()
+            print(f"Resuming from {filename} with {len(self.records)} completed samples")
+        else:
+            check_checkpoint(filename, resume=resume, overwrite=overwrite)
+            open(filename, "w").close()  # Start a new log
+
+        self.file = open(filename, "a")
+
+    def read_records(self):
+        return read_prediction_records(self.filename)
+
+    def append(self, sample_idx, gt_dict, vlm_prediction):
+        record = {"sample_idx": sample_idx, "gt_dict": gt_dict, "vlm_prediction": vlm_prediction}
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            self.records[sample_idx] = record
+
+    def close(self):
+        self.file.close()
+
+
+def read_prediction_records(filename) -> dict:
+    """Records of a prediction log keyed by sample_idx"""
+    records = {}
+    with open(filename, "rb") as f:
+        content = f.read()
+
+    # Drop a partially written last line from an interrupted run before appending to the log
+    complete_len = content.rfind(b"\n") + 1
+    if complete_len < len(content):
+        with open(filename, "r+b") as f:
+            f.truncate(complete_len)
+
+    for line in content[:complete_len].splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        records[record["sample_idx"]] = record  # Later entries win for duplicated samples
+    return records
+
+
+def check_checkpoint(filename, resume=False, overwrite=False):
+    """Raise FileExistsError if starting a new log would replace the predictions of an earlier run"""
+    if not resume and not overwrite and os.path.exists(filename) and os.path.getsize(filename) > 0:
+        raise FileExistsError(f"Checkpoint {filename} already has predictions, continue it with --resume "
+                              f"or replace it with --overwrite")
+
+
+def get_checkpoint_filename(results_folder, dataset_name, vlm_name, shard=None):
+    """Default checkpoint location next to the full results of the model, every shard has its own"""
+    vlm_name_str = vlm_name.replace("/", "-")
+    dataset_name_str = dataset_name.replace("/", "-")
+    shard_str = f".shard-{shard.index}-of-{shard.count}" if shard is not None else ""
+    return f"{results_folder}/{dataset_name_str}/{vlm_name_str}_predictions{shard_str}.jsonl"
@@ -0,0 +1,204 @@
+import json
+import time
+import asyncio
+import argparse
+from templates.answer_schema import smoke_detection_schema
+from evaluation.response_parser import ResponseParser, OK, loads, strip_fence, JSON_DECODE_ERRORS
+from evaluation.telemetry import current_request, create_request_record, request_context
+from evaluation.forestfire_evaluation import eval_structured_data, load_eval_results
+
+
+def create_packed_schema(response_schema, image_count) -> dict:
+    """Schema of a packed response: one answer per image in the list "images", wrapped in an object as structured
+    outputs need an object at the top level"""
+    return {
+        "type": "object",
+        "properties": {
+            "images": {"type": "array", "items": response_schema, "minItems": image_count, "maxItems": image_count},
+        },
+        "required": ["images"],
+        "additionalProperties": False,
+    }
+
+
+def create_packed_prompt(full_prompt, image_count) -> str:
+    return (f"You get {image_count} aerial images, numbered from 1 to {image_count}. Analyze every image on its own "
+            f"and give one answer per image in the list \"images\", in the order of the images.\n" + full_prompt)
+
+
+def unpack_response(response, image_count, response_parser) -> list[str | None]:
+    """Per-image responses of a packed response, None for images without a valid answer. If the number of answers
+    differs from the number of images, no answer can be assigned to its image."""
+    try:
+        packed = loads(strip_fence(response or ""))
+    except JSON_DECODE_ERRORS:
+        return [None] * image_count
+    answers = packed.get("images") if isinstance(packed, dict) else None
+    if not isinstance(answers, list) or len(answers) != image_count:
+        return [None] * image_count
+    return [json.dumps(answer) if response_parser.encode(answer, OK)[1] == OK else None for answer in answers]
+
+
+class PackedVLM:
+    """Async backend that packs the images of concurrent requests into requests with up to `pack_size` images, so
+    the prompt and schema are sent once per pack instead of once per image. A pack is sent once it is full or
+    `max_wait_ms` after its first image, so the concurrency should be at least `pack_size`. Images without a valid
+    answer in the packed response (e.g. a wrong number of answers or a broken answer) are requested again on their
+    own. Packed responses are not cached, the single requests of the fallback are. The spans of a packed request
+    are recorded on every request of the pack, its tokens are split between them.
+
+    The model name gets the pack size as suffix, so the results of every pack size are stored separately."""
+    def __init__(self, vlm, pack_size=4, max_wait_ms=50.0, response_schema=smoke_detection_schema):
+        if pack_size < 2:
+            raise ValueError("Packing needs a pack size of at least 2")
+        self.vlm = vlm
+        self.pack_size = pack_size
+        self.max_wait = max_wait_ms / 1000
+        self.model_name = f"{vlm.model_name}_pack{pack_size}"
+        self.image_encoder = vlm.image_encoder
+        self.telemetry = vlm.telemetry
+        self.traffic_controller = vlm.traffic_controller
+        self.response_parser = ResponseParser(response_schema)
+        self.queue = None
+        self.collector_task = None
+        self.tasks = set()
+        self.stats = {"images": 0, "packed_requests": 0, "packed_images": 0, "failed_packs": 0, "fallbacks": 0}
+
+    async def generate_structured_response_from_pil_image(self, full_prompt: str, pil_image,
+                                                          response_schema: dict) -> str:
+        # The queue must be created on the event loop it is used on
+        if self.collector_task is None:
+            self.queue = asyncio.Queue()
+            self.collector_task = asyncio.create_task(self.collect())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((full_prompt, self.image_encoder.encode(pil_image), response_schema, future,
+                              current_request.get()))
+        return await future
+
+    async def collect(self):
+        # The collector is started within the request of the first image, its packs must not inherit it
+        current_request.set(None)
+        while True:
+            requests = [await self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(requests) < self.pack_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Only requests with the same prompt and schema can share a pack
+            packs = {}
+            for request in requests:
+                packs.setdefault((request[0], id(request[2])), []).append(request)
+            for pack in packs.values():
+                task = asyncio.create_task(self.run_pack(pack))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def run_pack(self, pack):
+        full_prompt, _, response_schema, _, _ = pack[0]
+        images = [image for _, image, _, _, _ in pack]
+        request_records = [request_record for _, _, _, _, request_record in pack]
+        self.stats["images"] += len(pack)
+        responses = [None] * len(pack)
+        if len(pack) > 1:
+            self.stats["packed_requests"] += 1
+            self.stats["packed_images"] += len(pack)
+            pack_record = create_request_record()
+            try:
+                with request_context(pack_record):
+                    packed_response = await self.vlm.generate_structured_response_from_pil_images(
+                        create_packed_prompt(full_prompt, len(pack)), images,
+                        create_packed_schema(response_schema, len(pack)))
+                responses = unpack_response(packed_response, len(pack), self.response_parser)
+            except Exception:
+                # E.g. too many images for the context of the model, the images are requested on their own
+                self.stats["failed_packs"] += 1
+            finally:
+                self.telemetry.share_request(pack_record, request_records)
+            self.stats["fallbacks"] += responses.count(None)
+
+        fallback_indices = [request_idx for request_idx, response in enumerate(responses) if response is None]
+        fallback_responses = await asyncio.gather(*(self.run_single(
+            full_prompt, images[request_idx], response_schema, request_records[request_idx])
+            for request_idx in fallback_indices), return_exceptions=True)
+        for request_idx, response in zip(fallback_indices, fallback_responses):
+            responses[request_idx] = response
+        for (_, _, _, future, _), response in zip(pack, responses):
+            if future.cancelled():
+                continue
+            if isinstance(response, BaseException):
+                future.set_exception(response)
+            else:
+                future.set_result(response)
+
+    async def run_single(self, full_prompt, image, response_schema, request_record):
+        with request_context(request_record):
+            return await self.vlm.generate_structured_response_from_pil_image(full_prompt, image, response_schema)
+
+    def print_stats(self):
+        stats = self.stats
+        mean_pack_size = stats["packed_images"] / stats["packed_requests"] if stats["packed_requests"] > 0 else 0.0
+        print(f"\nRequest packing: {stats['images']} images, {stats['packed_requests']} packed requests with "
+              f"{mean_pack_size:.2f} images on average, {stats['failed_packs']} failed packs, {stats['fallbacks']} "
+              f"images requested on their own")
+        prompt_tokens = self.telemetry.counters["prompt_tokens"]
+        if prompt_tokens > 0 and stats["images"] > 0:
+            print(f"Prompt tokens per image: {prompt_tokens / stats['images']:.1f}")
+
+    async def aclose(self):
+        if self.collector_task is not None:
+            self.collector_task.cancel()
+        await self.vlm.aclose()
+
+
+def print_packing_report(rows):
+    header = list(rows[0].keys())
+    table = [header] + [[row[column] for column in header] for row in rows]
+    widths = [max(len(str(value)) for value in column) for column in zip(*table)]
+    for row in table:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the accuracy of stored results with and without packing')
+    parser.add_argument('--dataset_name', type=str, help='Dataset name', default="leon-se/ForestFireInsights-Eval")
+    parser.add_argument('--model_name', type=str, required=True, help='Model name without the pack size suffix')
+    parser.add_argument('--pack_sizes', type=int, nargs="+", required=True, help='Pack sizes to compare')
+    parser.add_argument('--results_folder', type=str, help='Folder with the benchmark results', default="benchmarks")
+    args = parser.parse_args()
+
+    # Results without packing are the reference, all are scored again with the same response parser
+    _, reference_predictions, ground_truth_dicts = load_eval_results(args.dataset_name, args.model_name,
+                                                                     args.results_folder)
+    reference_results = eval_structured_data(reference_predictions, ground_truth_dicts, args.model_name,
+                                             args.dataset_name, write_to_file=False)
+    fields = [key for key, value in reference_results.items()
+              if isinstance(value, float) and key not in ("overall_score", "structured_output_correct_ratio")]
+    rows = [{"pack_size": 1, "overall_score": reference_results["overall_score"], "change": "",
+             "structured_output_correct_ratio": reference_results["structured_output_correct_ratio"],
+             "largest_field_loss": ""}]
+    for pack_size in sorted(args.pack_sizes):
+        vlm_name = f"{args.model_name}_pack{pack_size}"
+        _, predictions_text, pack_ground_truth_dicts = load_eval_results(args.dataset_name, vlm_name,
+                                                                         args.results_folder)
+        if pack_ground_truth_dicts != ground_truth_dicts:
+            raise ValueError(f"Stored samples of {vlm_name} differ from {args.model_name} in order or content")
+        results_rel = eval_structured_data(predictions_text, ground_truth_dicts, vlm_name, args.dataset_name,
+                                           write_to_file=False)
+        worst_field = min(fields, key=lambda field: results_rel[field] - reference_results[field])
+        rows.append({"pack_size": pack_size, "overall_score": results_rel["overall_score"],
+                     "change": f"{results_rel['overall_score'] - reference_results['overall_score']:+.4f}",
+                     "structured_output_correct_ratio": results_rel["structured_output_correct_ratio"],
+                     "largest_field_loss":
+                         f"{worst_field} {results_rel[worst_field] - reference_results[worst_field]:+.4f}"})
+
+    print(f"\nAccuracy of {args.model_name} on {args.dataset_name} by pack size:")
+    print_packing_report(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from PIL import Image
+from evaluation.image_encoding import EncodedImage
+
+
+class ResponseCache:
+    """On-disk SQLite cache of VLM responses, keyed by a hash of model name, prompt, image, response schema and
+    temperature. The least recently used responses are evicted once the cache exceeds max_size_mb."""
+    def __init__(self, filename="cache/vlm_responses.sqlite", max_size_mb=1024):
+        self.filename = filename
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                          "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def create_key(self, vlm, full_prompt: str, pil_image: Image.Image | EncodedImage, response_schema) -> str:
+        key_hash = hashlib.sha256()
+        # Schemas may be dicts or types depending on the backend
+        key_parts = [vlm.model_name, full_prompt, json.dumps(response_schema, sort_keys=True, default=repr),
+                     repr(float(vlm.temperature))]
+        for key_part in key_parts:
+            key_hash.update(key_part.encode("utf-8"))
+            key_hash.update(b"\0")
+        key_hash.update(get_image_digest(pil_image))
+        return key_hash.hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str):
+        if response is None:
+            return
+        size = len(key) + len(response.encode("utf-8"))
+        with self.lock:
+            old_row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                              (key, response, size, time.time()))
+            self.size += size - (old_row[0] if old_row is not None else 0)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        # Keep the most recently used responses that fit into the size limit
+        self.conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM (SELECT key, SUM(size) OVER "
+                          "(ORDER BY last_access DESC, key) AS cumulative_size FROM responses) "
+                          "WHERE cumulative_size > ?)", (self.max_size,))
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 4) if requests > 0 else 0.0,
+                "entries": entries, "size_mb": round(self.size / 1024 / 1024, 2)}
+
+    def print_stats(self):
+        stats = self.stats()
+        print(f"Response cache {self.filename}: {stats['hits']} hits, {stats['misses']} misses "
+              f"(hit rate {stats['hit_rate']}), {stats['entries']} entries, {stats['size_mb']} MB")
+
+    def close(self):
+        self.conn.close()
+
+
+def get_image_digest(pil_image: Image.Image | EncodedImage) -> bytes:
+    image_hash = hashlib.sha256()
+    # Encoded images are hashed by the bytes that are sent to the VLM
+    if isinstance(pil_image, EncodedImage):
+        image_hash.update(pil_image.mime_type.encode("utf-8"))
+        image_hash.update(pil_image.data)
+        return image_hash.digest()
+    image_hash.update(f"{pil_image.mode}:{pil_image.size}".encode("utf-8"))
+    image_hash.update(pil_image.tobytes())
+    return image_hash.digest()
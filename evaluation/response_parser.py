@@ -0,0 +1,121 @@
+import re
+import json
+from collections import Counter
+import numpy as np
+from evaluation.schema_codec import SchemaCodec, INVALID_PREDICTION_CODE
+
+try:
+    import orjson
+    loads = orjson.loads
+    JSON_DECODE_ERRORS = (orjson.JSONDecodeError, TypeError)
+except ImportError:
+    loads = json.loads
+    JSON_DECODE_ERRORS = (json.JSONDecodeError, TypeError)
+
+# Parse statuses, the first three are correct structured outputs
+OK = "ok"
+EXTRACTED = "extracted"  # JSON object inside a markdown fence or other text
+INVALID_VALUES = "invalid_values"  # All fields present, but some values are not in the enum
+MISSING_FIELDS = "missing_fields"
+NOT_AN_OBJECT = "not_an_object"
+TRUNCATED = "truncated"
+INVALID_JSON = "invalid_json"
+EMPTY = "empty"
+CORRECT_STATUSES = (OK, EXTRACTED, INVALID_VALUES)
+
+FENCE_PATTERN = re.compile(r"^\s*```[a-zA-Z]*[ \t]*\n?(.*?)\n?```\s*$", re.DOTALL)
+
+
+class ResponseParser:
+    """Parser for VLM responses compiled from a response schema, shared by scoring and live inference.
+    Responses are parsed with orjson (json if orjson is not installed) and enum values are mapped directly to
+    the integer codes of SchemaCodec. Markdown fences and text around the JSON object are removed only if the
+    fast path fails. With `recover_partial`, the valid fields of truncated or otherwise broken responses are
+    recovered, their status stays a failure."""
+    def __init__(self, response_schema, fields=None, recover_partial=False):
+        self.codec = SchemaCodec(response_schema, fields=fields)
+        self.recover_partial = recover_partial
+        self.field_codes = [(field, self.codec.value_codes[field]) for field in self.codec.fields]
+        self.field_index = {field: col for col, field in enumerate(self.codec.fields)}
+        # "field": "value" pairs, also the complete ones in front of a truncation
+        field_names = "|".join(re.escape(field) for field in self.codec.fields)
+        self.field_pattern = re.compile(rf'"({field_names})"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+    def parse(self, text: str) -> tuple[list[int], str]:
+        """Return the codes of all fields and the parse status of a response"""
+        try:
+            return self.encode(loads(text), OK)
+        except JSON_DECODE_ERRORS:
+            pass
+
+        if text is None or not text.strip():
+            return [INVALID_PREDICTION_CODE] * len(self.field_codes), EMPTY
+        json_text = self.extract_json(text)
+        if json_text is not None:
+            try:
+                return self.encode(loads(json_text), EXTRACTED)
+            except JSON_DECODE_ERRORS:
+                pass
+
+        # Opened but never closed objects are most likely cut off at the token limit
+        stripped_text = (json_text or strip_fence(text)).strip()
+        status = TRUNCATED if stripped_text.startswith("{") and not stripped_text.endswith("}") else INVALID_JSON
+        return self.recover_fields(text), status
+
+    def encode(self, values_dict, status) -> tuple[list[int], str]:
+        if not isinstance(values_dict, dict):
+            return [INVALID_PREDICTION_CODE] * len(self.field_codes), NOT_AN_OBJECT
+        codes = [value_codes.get(value, INVALID_PREDICTION_CODE) if isinstance(value := values_dict.get(field), str)
+                 else INVALID_PREDICTION_CODE for field, value_codes in self.field_codes]
+        if any(field not in values_dict for field, _ in self.field_codes):
+            if not self.recover_partial:
+                codes = [INVALID_PREDICTION_CODE] * len(self.field_codes)
+            return codes, MISSING_FIELDS
+        if INVALID_PREDICTION_CODE in codes:
+            return codes, INVALID_VALUES
+        return codes, status
+
+    def extract_json(self, text: str) -> str | None:
+        """The JSON object of a fenced response or of a response with text around it"""
+        text = strip_fence(text)
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end < start:
+            return None
+        return text[start:end + 1]
+
+    def recover_fields(self, text: str) -> list[int]:
+        codes = [INVALID_PREDICTION_CODE] * len(self.field_codes)
+        if not self.recover_partial:
+            return codes
+        for field, value in self.field_pattern.findall(text):
+            codes[self.field_index[field]] = self.codec.value_codes[field].get(value, INVALID_PREDICTION_CODE)
+        return codes
+
+    def parse_dict(self, text: str) -> tuple[dict, str]:
+        """Parse a response into a dict of the valid fields (others are None) and the parse status"""
+        codes, status = self.parse(text)
+        return self.codec.decode(codes), status
+
+    def parse_many(self, predictions_text) -> tuple[np.ndarray, np.ndarray, Counter]:
+        """Parse and encode prediction texts, returns the codes, a mask of correct structured outputs and the
+        number of responses per parse status"""
+        pred_codes = np.full((len(predictions_text), len(self.field_codes)), INVALID_PREDICTION_CODE, dtype=np.int8)
+        structured_output_correct = np.zeros(len(predictions_text), dtype=bool)
+        status_counts = Counter()
+        for row, pred_text in enumerate(predictions_text):
+            codes, status = self.parse(pred_text)
+            pred_codes[row] = codes
+            structured_output_correct[row] = status in CORRECT_STATUSES
+            status_counts[status] += 1
+        return pred_codes, structured_output_correct, status_counts
+
+
+def strip_fence(text: str) -> str:
+    match = FENCE_PATTERN.match(text)
+    if match is not None:
+        return match.group(1)
+    # A fence that was opened but not closed, e.g. in a truncated response
+    stripped_text = text.lstrip()
+    if stripped_text.startswith("```"):
+        return stripped_text.split("\n", 1)[1] if "\n" in stripped_text else ""
+    return text
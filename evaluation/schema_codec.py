@@ -0,0 +1,57 @@
+import numpy as np
+
+INVALID_PREDICTION_CODE = -1  # Missing key or value outside of the enum
+INVALID_GROUND_TRUTH_CODE = -2  # Never equal to a prediction code
+
+
+class SchemaCodec:
+    """Integer codes for the enum fields of a response schema, codes are the positions in the enum lists"""
+    def __init__(self, response_schema, fields=None):
+        self.fields = list(fields) if fields is not None else list(response_schema["required"])
+        self.enum_values = {field: list(response_schema["properties"][field]["enum"]) for field in self.fields}
+        self.value_codes = {field: {value: code for code, value in enumerate(values)}
+                            for field, values in self.enum_values.items()}
+
+    def encode(self, values_dict: dict, invalid_code=INVALID_PREDICTION_CODE) -> list[int]:
+        """Encode a response dict, raises KeyError if a field is missing and TypeError if it is not a dict"""
+        return [self.value_codes[field].get(values_dict[field], invalid_code) for field in self.fields]
+
+    def encode_many(self, values_dicts, invalid_code=INVALID_PREDICTION_CODE) -> np.ndarray:
+        codes = np.full((len(values_dicts), len(self.fields)), invalid_code, dtype=np.int8)
+        for row, values_dict in enumerate(values_dicts):
+            codes[row] = self.encode(values_dict, invalid_code)
+        return codes
+
+    def decode(self, codes) -> dict:
+        return {field: self.enum_values[field][code] if code >= 0 else None for field, code in zip(self.fields, codes)}
+
+    def field_index(self, field: str) -> int:
+        return self.fields.index(field)
+
+
+def compute_confusion_matrices(pred_codes: np.ndarray, gt_codes: np.ndarray, codec: SchemaCodec) -> dict:
+    """Multi-class confusion matrices for all fields. Rows are ground truth values, columns are predicted values
+    with an additional last column for invalid predictions."""
+    confusion_matrices = {}
+    for col, field in enumerate(codec.fields):
+        n_values = len(codec.enum_values[field])
+        gt_col, pred_col = gt_codes[:, col].astype(np.int64), pred_codes[:, col].astype(np.int64)
+        valid_gt = gt_col >= 0
+        pred_col = np.where(pred_col >= 0, pred_col, n_values)  # Invalid predictions go to the last column
+        flat_counts = np.bincount(gt_col[valid_gt] * (n_values + 1) + pred_col[valid_gt],
+                                  minlength=n_values * (n_values + 1))
+        confusion_matrices[field] = {"labels": codec.enum_values[field],
+                                     "matrix": flat_counts.reshape(n_values, n_values + 1)}
+    return confusion_matrices
+
+
+def compute_binary_metrics(gt_bools: np.ndarray, pred_bools: np.ndarray) -> dict:
+    tp = int(np.sum(gt_bools & pred_bools))
+    tn = int(np.sum(~gt_bools & ~pred_bools))
+    fp = int(np.sum(~gt_bools & pred_bools))
+    fn = int(np.sum(gt_bools & ~pred_bools))
+    accuracy = round((tp + tn) / (tp + tn + fp + fn), 4) if tp + tn + fp + fn > 0 else 0.0
+    precision = round(tp / (tp + fp), 4) if tp + fp > 0 else 0.0
+    recall = round(tp / (tp + fn), 4) if tp + fn > 0 else 0.0
+    f1_score = round(2 * (precision * recall) / (precision + recall), 4) if precision + recall > 0 else 0.0
+    return {"accuracy": accuracy, "precision": precision, "recall": recall, "f1_score": f1_score}
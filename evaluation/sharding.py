@@ -0,0 +1,67 @@
+import os
+import argparse
+from evaluation.data_pipeline import Shard
+from evaluation.prediction_log import PredictionLog, get_checkpoint_filename, read_prediction_records
+from evaluation.forestfire_evaluation import collect_predictions, eval_structured_data
+
+
+def merge_shards(checkpoint_files, sample_count=None) -> tuple[list[str], list[dict]]:
+    """Combine the prediction logs of all shards, given in shard order, into predictions_text and
+    ground_truth_dicts in sample order. Without `sample_count` the dataset size is taken from the highest
+    sample_idx, so missing samples at the end of the dataset are only found with `sample_count`."""
+    shard_count = len(checkpoint_files)
+    predictions_by_idx, ground_truth_by_idx = {}, {}
+    for shard_idx, checkpoint_file in enumerate(checkpoint_files):
+        if not os.path.exists(checkpoint_file):
+            raise FileNotFoundError(f"No predictions of shard {shard_idx}/{shard_count} at {checkpoint_file}")
+        shard = Shard(shard_idx, shard_count)
+        for sample_idx, record in read_prediction_records(checkpoint_file).items():
+            if not shard.contains(sample_idx):
+                raise ValueError(f"Sample {sample_idx} in {checkpoint_file} is not part of shard {shard}, "
+                                 f"the shards were created with a different shard count or order")
+            predictions_by_idx[sample_idx] = record["vlm_prediction"]
+            ground_truth_by_idx[sample_idx] = record["gt_dict"]
+    return collect_predictions(predictions_by_idx, ground_truth_by_idx, sample_count)
+
+
+def write_merged_checkpoint(checkpoint_file, predictions_text, ground_truth_dicts):
+    """Write the merged predictions as the checkpoint of a single-node run"""
+    # The merged checkpoint is derived from the shards, so a new merge replaces it
+    prediction_log = PredictionLog(checkpoint_file, overwrite=True)
+    for sample_idx, (vlm_prediction, gt_dict) in enumerate(zip(predictions_text, ground_truth_dicts)):
+        prediction_log.append(sample_idx, gt_dict, vlm_prediction)
+    prediction_log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the predictions of the shards of an evaluation')
+    parser.add_argument('--dataset_name', type=str, help='Dataset name', default="leon-se/ForestFireInsights-Eval")
+    parser.add_argument('--model_name', type=str, required=True, help='Model name the shards were evaluated with')
+    parser.add_argument('--shard_count', type=int, required=True, help='Number of shards N of --shard i/N')
+    parser.add_argument('--checkpoint_files', type=str, nargs="+", default=None,
+                        help='Prediction logs of the shards in shard order (default: next to the results)')
+    parser.add_argument('--sample_count', type=int, default=None,
+                        help='Number of samples in the dataset split, to also find missing samples at its end')
+    parser.add_argument('--results_folder', type=str, help='Folder to save results', default="benchmarks")
+    parser.add_argument('--recover_partial', action='store_true',
+                        help='Score the valid fields of truncated or broken responses instead of none')
+    args = parser.parse_args()
+
+    checkpoint_files = args.checkpoint_files or [
+        get_checkpoint_filename(args.results_folder, args.dataset_name, args.model_name, Shard(shard_idx,
+                                                                                               args.shard_count))
+        for shard_idx in range(args.shard_count)]
+    if len(checkpoint_files) != args.shard_count:
+        parser.error(f"Got {len(checkpoint_files)} checkpoint files for {args.shard_count} shards")
+
+    predictions_text, ground_truth_dicts = merge_shards(checkpoint_files, sample_count=args.sample_count)
+    print(f"Merged {args.shard_count} shards with {len(predictions_text)} samples")
+    write_merged_checkpoint(get_checkpoint_filename(args.results_folder, args.dataset_name, args.model_name),
+                            predictions_text, ground_truth_dicts)
+    eval_structured_data(predictions_text, ground_truth_dicts, args.model_name, args.dataset_name,
+                         write_to_file=True, results_folder=args.results_folder,
+                         recover_partial=args.recover_partial)
+
+
+if __name__ == "__main__":
+    main()
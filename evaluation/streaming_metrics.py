@@ -0,0 +1,141 @@
+import math
+import threading
+import numpy as np
+from templates.answer_schema import smoke_detection_schema
+from evaluation.response_parser import ResponseParser, CORRECT_STATUSES
+from evaluation.schema_codec import INVALID_GROUND_TRUTH_CODE
+
+Z_SCORES = {0.9: 1.6449, 0.95: 1.96, 0.99: 2.5758}
+
+
+def wilson_interval(successes, n, z=1.96) -> tuple[float, float]:
+    """Wilson score interval of a proportion, also well-behaved for few samples and proportions near 0 or 1"""
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    denominator = 1 + z ** 2 / n
+    center = (p + z ** 2 / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / denominator
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+class MetricAccumulator:
+    """Per-field accuracy and confusion counts that are updated in O(1) per prediction, with the same parsing and
+    scoring as eval_structured_data. Field accuracies get Wilson intervals. The overall score is the mean of the
+    per-sample share of correct fields, its interval is the normal approximation from the running mean and
+    variance, as the fields of one sample are correlated.
+
+    Without `fields`, the fields of the first ground truth are scored, like in eval_structured_data."""
+    def __init__(self, fields=None, response_schema=smoke_detection_schema, confidence=0.95, recover_partial=False):
+        if confidence not in Z_SCORES:
+            raise ValueError(f"Unsupported confidence {confidence}, use one of {list(Z_SCORES)}")
+        self.z = Z_SCORES[confidence]
+        self.response_schema = response_schema
+        self.recover_partial = recover_partial
+        self.lock = threading.Lock()
+        self.n = 0
+        self.structured_output_correct = 0
+        self.score_sum = 0.0
+        self.score_sum_squares = 0.0
+        self.parser = None
+        if fields is not None:
+            self.init_fields(fields)
+
+    def init_fields(self, fields):
+        self.parser = ResponseParser(self.response_schema, fields=fields, recover_partial=self.recover_partial)
+        self.codec = self.parser.codec
+        self.correct_counts = np.zeros(len(self.codec.fields), dtype=np.int64)
+        # Rows are ground truth values, the last column counts invalid predictions
+        self.confusion_counts = {field: np.zeros((len(values), len(values) + 1), dtype=np.int64)
+                                 for field, values in self.codec.enum_values.items()}
+
+    def update(self, prediction_text, gt_dict):
+        with self.lock:
+            if self.parser is None:
+                self.init_fields(gt_dict.keys())
+        pred_codes, status = self.parser.parse(prediction_text)
+        gt_codes = self.codec.encode(gt_dict, invalid_code=INVALID_GROUND_TRUTH_CODE)
+        correct = [pred_code == gt_code for pred_code, gt_code in zip(pred_codes, gt_codes)]
+        score = sum(correct) / len(correct)
+        with self.lock:
+            self.n += 1
+            self.structured_output_correct += status in CORRECT_STATUSES
+            self.correct_counts += correct
+            self.score_sum += score
+            self.score_sum_squares += score ** 2
+            for field, pred_code, gt_code in zip(self.codec.fields, pred_codes, gt_codes):
+                if gt_code >= 0:
+                    n_values = len(self.codec.enum_values[field])
+                    self.confusion_counts[field][gt_code, pred_code if pred_code >= 0 else n_values] += 1
+
+    def overall_interval(self) -> tuple[float, float, float]:
+        """Overall score with the lower and upper bound of its confidence interval"""
+        with self.lock:
+            n, score_sum, score_sum_squares = self.n, self.score_sum, self.score_sum_squares
+        if n < 2:
+            return (score_sum / n if n else 0.0), 0.0, 1.0
+        mean = score_sum / n
+        variance = max(0.0, (score_sum_squares - n * mean ** 2) / (n - 1))
+        margin = self.z * math.sqrt(variance / n)
+        return mean, max(0.0, mean - margin), min(1.0, mean + margin)
+
+    def summary(self) -> dict:
+        """Accuracies with (lower, upper) intervals per field and overall, like the results of eval_structured_data"""
+        with self.lock:
+            if self.parser is None:
+                return {"n_samples": 0}
+            n, correct_counts = self.n, self.correct_counts.copy()
+            structured_output_correct = self.structured_output_correct
+        results = {}
+        for col, field in enumerate(self.codec.fields):
+            results[field] = {"accuracy": round(int(correct_counts[col]) / n, 4) if n else 0.0,
+                              "interval": tuple(round(bound, 4) for bound in
+                                                wilson_interval(int(correct_counts[col]), n, self.z))}
+        score, lower, upper = self.overall_interval()
+        results["overall_score"] = {"accuracy": round(score, 4), "interval": (round(lower, 4), round(upper, 4))}
+        results["structured_output_correct_ratio"] = round(structured_output_correct / n, 4) if n else 0.0
+        results["n_samples"] = n
+        return results
+
+
+class EarlyStopping:
+    """Stops an evaluation once the confidence interval of the overall score is narrower than `max_ci_width`, or
+    once its upper bound is below `reference_score` (e.g. the stored score of a reference model), so the model is
+    worse with the chosen confidence. No decision is taken before `min_samples` predictions.
+
+    The intervals assume the samples arrive in random order, sorted datasets should be shuffled first."""
+    def __init__(self, accumulator: MetricAccumulator, max_ci_width=None, reference_score=None, reference_name=None,
+                 min_samples=50):
+        self.accumulator = accumulator
+        self.max_ci_width = max_ci_width
+        self.reference_score = reference_score
+        self.reference_name = reference_name
+        self.min_samples = min_samples
+        self.reason = None
+        self.stopped_after = None  # Number of samples at the decision
+
+    def update(self, prediction_text, gt_dict) -> bool:
+        """Add a prediction, returns True once the evaluation can stop"""
+        self.accumulator.update(prediction_text, gt_dict)
+        if self.reason is None:
+            self.reason = self.check()
+            if self.reason is not None:
+                self.stopped_after = self.accumulator.n
+        return self.reason is not None
+
+    def check(self) -> str | None:
+        if self.accumulator.n < self.min_samples:
+            return None
+        score, lower, upper = self.accumulator.overall_interval()
+        if self.max_ci_width is not None and upper - lower < self.max_ci_width:
+            return (f"Confidence interval [{lower:.4f}, {upper:.4f}] of the overall score is narrower than "
+                    f"{self.max_ci_width} after {self.accumulator.n} samples")
+        if self.reference_score is not None and upper < self.reference_score:
+            return (f"Overall score {score:.4f} [{lower:.4f}, {upper:.4f}] is below the score {self.reference_score} "
+                    f"of {self.reference_name or 'the reference'} after {self.accumulator.n} samples")
+        return None
+
+    def progress(self) -> str:
+        """Short live status for the progress bar"""
+        score, lower, upper = self.accumulator.overall_interval()
+        return f"score {score:.3f} [{lower:.3f}, {upper:.3f}]"
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+import numpy as np
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def create_request_record(sample_idx=None, spans=None) -> dict:
+    return {"sample_idx": sample_idx, "timestamp": time.time(), "spans": spans or {}, "attempts": 0,
+            "cache_hit": False, "prompt_tokens": None, "completion_tokens": None}
+
+
+@contextmanager
+def request_context(request_record):
+    """Attribute spans and counts to `request_record`, e.g. in a task that runs on behalf of another request. Tasks
+    copy the context when they are created, so the record is set inside the task."""
+    token = current_request.set(request_record)
+    try:
+        yield request_record
+    finally:
+        current_request.reset(token)
+
+
+class Telemetry:
+    """Per-request timing of the pipeline stages (decode, encode, serialize, network, parse, ...), token usage,
+    attempts and cache hits. Spans inside `request()` are attributed to that request, also across asyncio tasks.
+    Spans of samples prepared ahead of their request (e.g. by the PrefetchLoader) are passed with `sample_idx`.
+
+    Finished requests are written to a JSONL trace, aggregates to a Prometheus text file (every
+    `metrics_interval` seconds and on close) and as a summary table."""
+    def __init__(self, trace_file=None, metrics_file=None, metrics_interval=15):
+        self.trace_file = trace_file
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.lock = threading.Lock()
+        self.stage_durations = {}
+        self.pending_spans = {}
+        self.counters = {"requests": 0, "attempts": 0, "retries": 0, "cache_hits": 0, "prompt_tokens": 0,
+                         "completion_tokens": 0}
+        self.start_time = time.perf_counter()
+        self.last_metrics_write = time.monotonic()
+
+        self.trace = None
+        if trace_file is not None:
+            folder = os.path.dirname(trace_file)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self.trace = open(trace_file, "a")
+
+    @contextmanager
+    def span(self, name, sample_idx=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, time.perf_counter() - start, sample_idx)
+
+    def record_span(self, name, seconds, sample_idx=None):
+        request_record = current_request.get()
+        with self.lock:
+            self.stage_durations.setdefault(name, []).append(seconds)
+            # Every network span is one attempt, retried requests have several
+            if name == "network":
+                self.counters["attempts"] += 1
+                if request_record is not None:
+                    request_record["attempts"] += 1
+            if request_record is not None:
+                spans = request_record["spans"]
+            elif sample_idx is not None:
+                spans = self.pending_spans.setdefault(sample_idx, {})
+            else:
+                return
+            spans[name] = spans.get(name, 0.0) + seconds
+
+    @contextmanager
+    def request(self, sample_idx=None):
+        """Collect all spans and counts until the end of the block into one trace record"""
+        with self.lock:
+            spans = self.pending_spans.pop(sample_idx, {})
+        request_record = create_request_record(sample_idx, spans)
+        start = time.perf_counter()
+        try:
+            with request_context(request_record):
+                yield request_record
+        finally:
+            self.finish_request(request_record, time.perf_counter() - start)
+
+    def finish_request(self, request_record, seconds):
+        with self.lock:
+            self.stage_durations.setdefault("request", []).append(seconds)
+            self.counters["requests"] += 1
+            if self.trace is not None:
+                trace_record = {**request_record, "duration_ms": round(seconds * 1000, 3),
+                                "spans": {name: round(value * 1000, 3) for name, value in
+                                          request_record["spans"].items()}}
+                self.trace.write(json.dumps(trace_record) + "\n")
+            write_metrics = (self.metrics_file is not None and
+                             time.monotonic() - self.last_metrics_write >= self.metrics_interval)
+        if write_metrics:
+            self.write_metrics()
+
+    def share_request(self, shared_record, request_records):
+        """Attribute a request made for several requests (e.g. a packed request) to each of them. Every request gets
+        its spans and attempts, as it waited for all of them, the tokens are split between the requests."""
+        request_records = [request_record for request_record in request_records if request_record is not None]
+        with self.lock:
+            for request_idx, request_record in enumerate(request_records):
+                for name, seconds in shared_record["spans"].items():
+                    request_record["spans"][name] = request_record["spans"].get(name, 0.0) + seconds
+                request_record["attempts"] += shared_record["attempts"]
+                for key in ("prompt_tokens", "completion_tokens"):
+                    if shared_record[key] is not None:
+                        share, remainder = divmod(shared_record[key], len(request_records))
+                        request_record[key] = ((request_record[key] or 0) + share +
+                                               (1 if request_idx < remainder else 0))
+
+    def record_retry(self):
+        # Counted by the traffic controller, a request can have several attempts without retries (e.g. a cascade)
+        with self.lock:
+            self.counters["retries"] += 1
+
+    def record_cache_hit(self):
+        request_record = current_request.get()
+        if request_record is not None:
+            request_record["cache_hit"] = True
+        with self.lock:
+            self.counters["cache_hits"] += 1
+
+    def record_tokens(self, prompt_tokens, completion_tokens):
+        request_record = current_request.get()
+        if request_record is not None:
+            request_record["prompt_tokens"] = prompt_tokens
+            request_record["completion_tokens"] = completion_tokens
+        with self.lock:
+            self.counters["prompt_tokens"] += prompt_tokens or 0
+            self.counters["completion_tokens"] += completion_tokens or 0
+
+    def summary(self) -> list[dict]:
+        """Count, total and latency percentiles per stage, in order of total time"""
+        with self.lock:
+            stage_durations = {name: np.array(durations) for name, durations in self.stage_durations.items()}
+        rows = []
+        for name, durations in stage_durations.items():
+            rows.append({"stage": name, "count": len(durations), "total_s": round(float(durations.sum()), 3),
+                         "mean_ms": round(float(durations.mean()) * 1000, 2),
+                         "p50_ms": round(float(np.percentile(durations, 50)) * 1000, 2),
+                         "p95_ms": round(float(np.percentile(durations, 95)) * 1000, 2),
+                         "p99_ms": round(float(np.percentile(durations, 99)) * 1000, 2)})
+        rows.sort(key=lambda row: -row["total_s"])
+        return rows
+
+    def print_summary(self):
+        rows = self.summary()
+        if not rows:
+            return
+        header = list(rows[0].keys())
+        table = [header] + [[row[column] for column in header] for row in rows]
+        widths = [max(len(str(value)) for value in column) for column in zip(*table)]
+        print(f"\nTiming summary ({time.perf_counter() - self.start_time:.1f} s wall time):")
+        for row in table:
+            print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+        counters = self.counters
+        print(f"{counters['requests']} requests, {counters['cache_hits']} cache hits, {counters['retries']} retries, "
+              f"{counters['prompt_tokens']} prompt tokens, {counters['completion_tokens']} completion tokens")
+
+    def write_metrics(self):
+        """Write the metrics in the Prometheus text format, e.g. for the node_exporter textfile collector"""
+        lines = ["# HELP vlm_eval_stage_seconds Time spent per pipeline stage",
+                 "# TYPE vlm_eval_stage_seconds summary"]
+        with self.lock:
+            stage_durations = {name: np.array(durations) for name, durations in self.stage_durations.items()}
+            counters = dict(self.counters)
+            self.last_metrics_write = time.monotonic()
+        for name, durations in stage_durations.items():
+            for quantile in (0.5, 0.95, 0.99):
+                lines.append(f'vlm_eval_stage_seconds{{stage="{name}",quantile="{quantile}"}} '
+                             f'{np.quantile(durations, quantile):.6f}')
+            lines.append(f'vlm_eval_stage_seconds_sum{{stage="{name}"}} {durations.sum():.6f}')
+            lines.append(f'vlm_eval_stage_seconds_count{{stage="{name}"}} {len(durations)}')
+        for name, value in counters.items():
+            lines.append(f"# TYPE vlm_eval_{name}_total counter")
+            lines.append(f"vlm_eval_{name}_total {value}")
+
+        # Replace the file at once, so scrapers never read a partial file
+        folder = os.path.dirname(self.metrics_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_file = f"{self.metrics_file}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_file, self.metrics_file)
+
+    def close(self):
+        if self.metrics_file is not None:
+            self.write_metrics()
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
@@ -0,0 +1,382 @@
+import time
+import math
+import random
+import asyncio
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+THROTTLED, RETRYABLE, FATAL = "throttled", "retryable", "fatal"
+RETRYABLE_STATUS_CODES = {408, 409, 500, 502, 503, 504, 529}
+# Matched against the class hierarchy of an error, so the SDKs don't have to be imported here
+RETRYABLE_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "TransportError", "TimeoutException",
+                         "ClientConnectionError", "ServerDisconnectedError", "ConnectionError", "TimeoutError"}
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def get_status_code(error):
+    # openai.APIStatusError has status_code, google.genai.errors.APIError has code
+    for attribute in ("status_code", "code"):
+        status_code = getattr(error, attribute, None)
+        if isinstance(status_code, int):
+            return status_code
+    return None
+
+
+def get_retry_after(error):
+    """Seconds to wait from the Retry-After (or retry-after-ms) header of an error response, if any"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after is None:
+            return None
+        if retry_after.replace(".", "", 1).isdigit():
+            return float(retry_after)
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(error):
+    """Return THROTTLED, RETRYABLE or FATAL for an error raised by a backend request"""
+    if isinstance(error, CircuitOpenError):
+        return FATAL
+    status_code = get_status_code(error)
+    if status_code == 429:
+        return THROTTLED
+    if status_code in RETRYABLE_STATUS_CODES:
+        return RETRYABLE
+    if status_code is not None:
+        return FATAL
+    if any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__):
+        return RETRYABLE
+    return FATAL
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate_per_minute`, holding up to `burst_seconds` worth of tokens. Reservations may
+    overdraw the bucket, later callers then wait until the debt is paid back."""
+    def __init__(self, rate_per_minute, burst_seconds=10):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount=1.0) -> float:
+        """Take `amount` tokens and return the number of seconds to wait before using them"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def adjust(self, amount):
+        # Correct an earlier reservation, e.g. once the real token usage of a request is known
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit: grows by one request per round of successful requests and is multiplied by
+    `decrease_factor` (at most once per `cooldown` seconds) when the backend throttles. Usable from threads and
+    from asyncio tasks."""
+    def __init__(self, initial_limit=16, min_limit=1, max_limit=256, decrease_factor=0.5, cooldown=1.0):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+        self.waiters = deque()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                event = threading.Event()
+                self.waiters.append(event.set)
+            event.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                future = loop.create_future()
+                waiter = lambda: loop.call_soon_threadsafe(set_future_result, future)
+                self.waiters.append(waiter)
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self.lock:
+                    try:
+                        self.waiters.remove(waiter)
+                    except ValueError:
+                        # Already woken, its slot goes to the next waiter
+                        self.wake_waiters()
+                raise
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.wake_waiters()
+
+    def wake_waiters(self):
+        # Called with the lock held, woken waiters compete for the free slots again
+        free_slots = int(self.limit) - self.in_flight
+        while free_slots > 0 and self.waiters:
+            self.waiters.popleft()()
+            free_slots -= 1
+
+    def on_success(self):
+        with self.lock:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.wake_waiters()
+
+    def on_throttle(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_decrease >= self.cooldown:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self.last_decrease = now
+
+
+def set_future_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failed requests and fails fast for `reset_timeout` seconds,
+    then lets a single probe request through to decide whether to close again"""
+    def __init__(self, failure_threshold=20, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+
+    def before_request(self) -> bool:
+        """Raise CircuitOpenError while the breaker is open, return True if the request is the probe"""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.probe_in_flight:
+                raise CircuitOpenError(f"Circuit breaker open after {self.consecutive_failures} consecutive failures")
+            self.probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.probe_in_flight = False
+            if self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    def reopen(self):
+        """Fail fast for another `reset_timeout` seconds, e.g. after a throttled probe"""
+        with self.lock:
+            self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+    def end_probe(self):
+        """Called after every probe, a probe without a decision (e.g. cancelled) lets the next request probe"""
+        with self.lock:
+            self.probe_in_flight = False
+
+
+class RetryBudget:
+    """Every request adds `ratio` retries to the budget and every retry spends one, so retries stay a bounded
+    fraction of the traffic. `min_retries` are always available to get a run going."""
+    def __init__(self, ratio=0.2, min_retries=10, max_retries=100):
+        self.ratio = ratio
+        self.max_balance = max(min_retries, max_retries)
+        self.balance = float(min_retries)
+        self.lock = threading.Lock()
+
+    def record_request(self):
+        with self.lock:
+            self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def try_spend(self) -> bool:
+        with self.lock:
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            return False
+
+
+class TrafficController:
+    """Client-side traffic control shared by all requests of a backend: request and token rate limits, adaptive
+    concurrency, exponential backoff with jitter that honors Retry-After, a retry budget and a circuit breaker.
+    Throttled and transient errors are retried, fatal errors are raised right away."""
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=256, max_retries=6,
+                 base_delay=1.0, max_delay=60.0, retry_budget_ratio=0.2, failure_threshold=20, reset_timeout=30,
+                 telemetry=None):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.limiter = AdaptiveConcurrencyLimiter(initial_limit=max_concurrency, max_limit=max_concurrency)
+        self.retry_budget = RetryBudget(ratio=retry_budget_ratio)
+        self.circuit_breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0.0
+        self.telemetry = telemetry
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failed": 0}
+
+    def get_rate_limit_delay(self, estimated_tokens) -> float:
+        delays = [self.paused_until - time.monotonic()]
+        if self.request_bucket is not None:
+            delays.append(self.request_bucket.reserve(1))
+        if self.token_bucket is not None and estimated_tokens > 0:
+            delays.append(self.token_bucket.reserve(estimated_tokens))
+        delay = max(0.0, *delays)
+        self.record_wait("rate_limit_wait", delay)
+        return delay
+
+    def record_wait(self, name, seconds):
+        if self.telemetry is not None and seconds > 0:
+            self.telemetry.record_span(name, seconds)
+
+    def get_retry_delay(self, attempt, error) -> float:
+        # Full jitter exponential backoff, but never shorter than the server asked for
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            # Hold back all requests, not only this one, so a 429 storm doesn't continue
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            return max(backoff, retry_after)
+        return backoff
+
+    def handle_error(self, error, attempt, is_probe=False) -> float:
+        """Update the controller state for a failed request, return the retry delay or raise the error"""
+        error_class = classify_error(error)
+        if error_class == THROTTLED:
+            self.stats["throttled"] += 1
+            self.limiter.on_throttle()
+            if is_probe:
+                self.circuit_breaker.reopen()
+        elif error_class == RETRYABLE:
+            self.circuit_breaker.record_failure()
+        elif is_probe:
+            # A server that answers the probe with a 4xx is up, the error is one of the request
+            if get_status_code(error) is not None:
+                self.circuit_breaker.record_success()
+            else:
+                self.circuit_breaker.reopen()
+
+        if error_class == FATAL or attempt >= self.max_retries or not self.retry_budget.try_spend():
+            self.stats["failed"] += 1
+            raise error
+        self.stats["retries"] += 1
+        if self.telemetry is not None:
+            self.telemetry.record_retry()
+        delay = self.get_retry_delay(attempt, error)
+        self.record_wait("backoff", delay)
+        return delay
+
+    def handle_success(self, estimated_tokens, token_usage):
+        self.limiter.on_success()
+        self.circuit_breaker.record_success()
+        if self.token_bucket is not None and token_usage is not None:
+            self.token_bucket.adjust(token_usage - estimated_tokens)
+
+    def call(self, request_fn, estimated_tokens=0, get_token_usage=None):
+        """Run `request_fn()` under traffic control, `get_token_usage(response)` reports the real token usage"""
+        attempt = 0
+        while True:
+            is_probe = self.circuit_breaker.before_request()
+            try:
+                time.sleep(self.get_rate_limit_delay(estimated_tokens))
+                self.limiter.acquire()
+                self.stats["requests"] += 1
+                self.retry_budget.record_request()
+                try:
+                    response = request_fn()
+                except Exception as e:
+                    self.limiter.release()
+                    delay = self.handle_error(e, attempt, is_probe=is_probe)
+                except BaseException:
+                    # Cancelled requests free their slot too
+                    self.limiter.release()
+                    raise
+                else:
+                    self.limiter.release()
+                    self.handle_success(estimated_tokens, get_token_usage(response) if get_token_usage else None)
+                    return response
+            finally:
+                if is_probe:
+                    self.circuit_breaker.end_probe()
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, request_fn, estimated_tokens=0, get_token_usage=None):
+        """Async variant of `call`, `request_fn()` returns an awaitable"""
+        attempt = 0
+        while True:
+            is_probe = self.circuit_breaker.before_request()
+            try:
+                await asyncio.sleep(self.get_rate_limit_delay(estimated_tokens))
+                await self.limiter.acquire_async()
+                self.stats["requests"] += 1
+                self.retry_budget.record_request()
+                try:
+                    response = await request_fn()
+                except Exception as e:
+                    self.limiter.release()
+                    delay = self.handle_error(e, attempt, is_probe=is_probe)
+                except BaseException:
+                    # Cancelled requests free their slot too
+                    self.limiter.release()
+                    raise
+                else:
+                    self.limiter.release()
+                    self.handle_success(estimated_tokens, get_token_usage(response) if get_token_usage else None)
+                    return response
+            finally:
+                if is_probe:
+                    self.circuit_breaker.end_probe()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def print_stats(self):
+        print(f"Traffic control: {self.stats['requests']} requests, {self.stats['retries']} retries, "
+              f"{self.stats['throttled']} throttled, {self.stats['failed']} failed, "
+              f"concurrency limit {int(self.limiter.limit)}")
+
+
+def estimate_tokens(full_prompt, image_size=None) -> int:
+    """Rough input token estimate for rate limiting: ~4 characters per text token and one token per 28x28 image
+    patch, corrected with the real usage after each response"""
+    text_tokens = len(full_prompt) // 4
+    if image_size is None:
+        return text_tokens
+    return text_tokens + math.ceil(image_size[0] / 28) * math.ceil(image_size[1] / 28)
+
+
+def estimate_images_tokens(full_prompt, images) -> int:
+    """estimate_tokens of a request with several images"""
+    return estimate_tokens(full_prompt) + sum(estimate_tokens("", image.size) for image in images)
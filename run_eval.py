@@ -1,46 +1,300 @@
 import argparse
-from datasets import load_dataset
-from evaluation.forestfire_evaluation import create_predictions, eval_structured_data
+import asyncio
+import copy
+from datasets import load_dataset, Image as DatasetImage
+from evaluation.batch_jobs import LocalBatchExecutor
+from evaluation.response_cache import ResponseCache
+from evaluation.image_encoding import ImageEncoder
+from evaluation.traffic_control import TrafficController
+from evaluation.telemetry import Telemetry
+from evaluation.prediction_log import PredictionLog, get_checkpoint_filename
+from evaluation.data_pipeline import parse_shard, get_sample_count, shuffle_samples
+from evaluation.forestfire_evaluation import (create_predictions, create_predictions_async, create_predictions_batched, 
+                                              eval_structured_data, load_eval_results)
+from evaluation.streaming_metrics import MetricAccumulator, EarlyStopping
+from evaluation.cascade import CascadeVLM, AsyncCascadeVLM, EscalationRule, parse_escalate_on, print_accuracy_loss
+from evaluation.request_packing import PackedVLM
 
 
-def setup_vlm(args):
+def setup_vlm(args, response_cache=None, image_encoder=None, traffic_controller=None, telemetry=None):
     if args.backend == "google":
         from evaluation.google_api import GoogleAPI
-        vlm = GoogleAPI(model_name=args.model_name)
+        vlm = GoogleAPI(model_name=args.model_name, response_cache=response_cache, image_encoder=image_encoder,
+                        traffic_controller=traffic_controller, telemetry=telemetry)
     elif args.backend == "openai":
         from evaluation.openai_api import OpenAIAPI
-        vlm = OpenAIAPI(base_url=None, model_name=args.model_name)
+        vlm = OpenAIAPI(base_url=None, model_name=args.model_name, response_cache=response_cache,
+                        image_encoder=image_encoder, traffic_controller=traffic_controller,
+                        telemetry=telemetry)
     elif args.backend == "vllm_online":
         from evaluation.openai_api import OpenAIAPI
-        vlm = OpenAIAPI(base_url=args.vllm_url, model_name=None)
+        vlm = OpenAIAPI(base_url=args.vllm_url, model_name=None, response_cache=response_cache,
+                        image_encoder=image_encoder, traffic_controller=traffic_controller,
+                        telemetry=telemetry, health_check_interval=args.health_check_interval)
     else:
         raise ValueError("Invalid backend")
     return vlm
 
 
+def setup_async_vlm(args, response_cache=None, image_encoder=None, traffic_controller=None, telemetry=None):
+    if args.backend == "google":
+        from evaluation.google_api import AsyncGoogleAPI
+        vlm = AsyncGoogleAPI(model_name=args.model_name, response_cache=response_cache,
+                             image_encoder=image_encoder, traffic_controller=traffic_controller,
+                             telemetry=telemetry)
+    elif args.backend == "openai":
+        from evaluation.openai_api import AsyncOpenAIAPI
+        vlm = AsyncOpenAIAPI(base_url=None, model_name=args.model_name, response_cache=response_cache,
+                             image_encoder=image_encoder, traffic_controller=traffic_controller,
+                             telemetry=telemetry, max_connections=args.concurrency)
+    elif args.backend == "vllm_online":
+        from evaluation.openai_api import AsyncOpenAIAPI
+        vlm = AsyncOpenAIAPI(base_url=args.vllm_url, model_name=None, response_cache=response_cache,
+                             image_encoder=image_encoder, traffic_controller=traffic_controller,
+                             telemetry=telemetry, health_check_interval=args.health_check_interval,
+                             max_connections=args.concurrency)
+    else:
+        raise ValueError("Invalid backend")
+    return vlm
+
+
+def setup_cascade(args, vlm, use_async, response_cache=None, image_encoder=None, telemetry=None):
+    """Cascade of the backend of the CLI args and a second stage, images are escalated by the --escalate_on rule"""
+    stage_args = copy.copy(args)
+    stage_args.backend = args.cascade_backend
+    stage_args.model_name = args.cascade_model_name
+    stage_args.vllm_url = args.cascade_vllm_url
+    # Every stage has its own rate limits
+    traffic_controller = TrafficController(requests_per_minute=args.cascade_rpm, tokens_per_minute=args.cascade_tpm,
+                                           max_concurrency=args.concurrency, max_retries=args.max_retries,
+                                           telemetry=telemetry)
+    escalation_rule = EscalationRule(parse_escalate_on(args.escalate_on) if args.escalate_on else None)
+    if use_async:
+        final_stage = setup_async_vlm(stage_args, response_cache, image_encoder, traffic_controller, telemetry)
+        return AsyncCascadeVLM([vlm, final_stage], escalation_rule, stage_costs=args.stage_costs)
+    final_stage = setup_vlm(stage_args, response_cache, image_encoder, traffic_controller, telemetry)
+    return CascadeVLM([vlm, final_stage], escalation_rule, stage_costs=args.stage_costs)
+
+
+async def create_predictions_concurrently(eval_ds, vlm, args, prediction_log, prefetch, early_stopping=None):
+    try:
+        return await create_predictions_async(eval_ds, vlm, concurrency=args.concurrency, 
+                                              prediction_log=prediction_log, encode_workers=args.encode_workers,
+                                              prefetch=prefetch, max_prefetch_mb=args.max_prefetch_mb,
+                                              early_stopping=early_stopping, shard=args.shard)
+    finally:
+        await vlm.aclose()
+
+
+def print_intervals(summary, confidence):
+    print(f"\nAccuracy with {confidence * 100:g}% confidence intervals on {summary['n_samples']} samples:")
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            print(f"{key}: {value['accuracy']} [{value['interval'][0]}, {value['interval'][1]}]")
+
+
 def main():
     # Create CLI args
     parser = argparse.ArgumentParser(description='Evaluate a VLM model on a structured dataset')
     parser.add_argument('--backend', type=str, help='VLM backend', default="vllm_online")
-    parser.add_argument('--vllm_url', type=str, help='URL for vLLM', default="http://localhost:8000/v1")
+    parser.add_argument('--vllm_url', type=str, nargs="+", default=["http://localhost:8000/v1"],
+                        help='URL for vLLM, requests are load balanced over several URLs')
+    parser.add_argument('--health_check_interval', type=float, default=10,
+                        help='Seconds between health checks of the vLLM URLs')
     parser.add_argument('--model_name', type=str, help='VLM model name', default="")
+    parser.add_argument('--cache_file', type=str, default=None,
+                        help='SQLite file for cached VLM responses, responses are only cached with it')
+    parser.add_argument('--cache_max_mb', type=float, help='Maximum size of the response cache in MB', default=1024)
+    parser.add_argument('--no_cache', action='store_true', help='Bypass the response cache of --cache_file')
+    parser.add_argument('--image_format', type=str, help='Format images are encoded in (PNG, JPEG, WEBP)', 
+                        default="PNG")
+    parser.add_argument('--image_quality', type=int, help='JPEG/WebP encoding quality', default=90)
+    parser.add_argument('--max_pixels', type=int, help='Downscale images to this pixel budget before upload', 
+                        default=None)
+    parser.add_argument('--no_passthrough', action='store_true', 
+                        help='Always re-encode JPEG images instead of sending the original bytes')
+    parser.add_argument('--rpm', type=float, help='Client-side limit of requests per minute', default=None)
+    parser.add_argument('--tpm', type=float, help='Client-side limit of tokens per minute', default=None)
+    parser.add_argument('--max_retries', type=int, help='Retries of throttled or failed requests', default=6)
     parser.add_argument('--dataset_name', type=str, help='Dataset name', default="leon-se/ForestFireInsights-Eval")
     parser.add_argument('--ds_split', type=str, help='Dataset split', default="train")
     parser.add_argument('--results_folder', type=str, help='Folder to save results', default="benchmarks")
+    parser.add_argument('--concurrency', type=int, help='Maximum number of requests in flight', default=1)
+    parser.add_argument('--encode_workers', type=int, help='Processes encoding images ahead of the requests', 
+                        default=0)
+    parser.add_argument('--streaming', action='store_true', help='Stream the dataset instead of downloading it first')
+    parser.add_argument('--prefetch', type=int, help='Number of samples read and encoded ahead of the requests', 
+                        default=None)
+    parser.add_argument('--max_prefetch_mb', type=float, help='Memory cap for prefetched images in MB', default=256)
+    parser.add_argument('--batch', action='store_true', help='Create predictions with the batch API of the backend')
+    parser.add_argument('--local_batch', action='store_true', 
+                        help='Run the batch request file locally against the interactive endpoint')
+    parser.add_argument('--batch_folder', type=str, help='Folder for batch request and result files', 
+                        default="batch_jobs")
+    parser.add_argument('--checkpoint_file', type=str, default=None,
+                        help='JSONL file the predictions are streamed to (default: next to the results)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip samples that are already in the checkpoint file, they count towards early stopping')
+    parser.add_argument('--overwrite', action='store_true', help='Replace an existing checkpoint file')
+    parser.add_argument('--trace_file', type=str, help='JSONL file with the timings of every request', default=None)
+    parser.add_argument('--metrics_file', type=str, help='Prometheus text file the metrics are written to', 
+                        default=None)
+    parser.add_argument('--cascade_backend', type=str, default=None,
+                        help='Backend of a second stage that only gets the images escalated by the first stage')
+    parser.add_argument('--cascade_model_name', type=str, help='Model name of the second stage', default="")
+    parser.add_argument('--cascade_vllm_url', type=str, nargs="+", default=["http://localhost:8001/v1"],
+                        help='URL for vLLM of the second stage')
+    parser.add_argument('--cascade_rpm', type=float, help='Requests per minute limit of the second stage', 
+                        default=None)
+    parser.add_argument('--cascade_tpm', type=float, help='Tokens per minute limit of the second stage', default=None)
+    parser.add_argument('--escalate_on', type=str, nargs="+", default=None,
+                        help='FIELD=VALUE conditions for escalating an image to the second stage')
+    parser.add_argument('--stage_costs', type=float, nargs=2, default=None,
+                        help='Cost of one request of the first and second stage')
+    parser.add_argument('--stop_ci_width', type=float, default=None,
+                        help='Stop once the confidence interval of the overall score is narrower than this')
+    parser.add_argument('--reference_model', type=str, default=None,
+                        help='Stop once the model is worse than the stored results of this model')
+    parser.add_argument('--stop_min_samples', type=int, help='Samples before early stopping can stop', default=50)
+    parser.add_argument('--confidence', type=float, help='Confidence level of the intervals (0.9, 0.95, 0.99)', 
+                        default=0.95)
+    parser.add_argument('--shuffle_seed', type=int, default=None,
+                        help='Evaluate the samples in a random order, e.g. for unbiased early stopping')
+    parser.add_argument('--recover_partial', action='store_true',
+                        help='Score the valid fields of truncated or broken responses instead of none')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help='Only evaluate shard i/N (samples with index %% N == i), merge with evaluation.sharding')
+    parser.add_argument('--pack_size', type=int, help='Images per request, packed from concurrent requests', 
+                        default=1)
+    parser.add_argument('--pack_wait_ms', type=float, help='Maximum wait for the images of a pack in ms', default=50)
 
     # Parse args
     args = parser.parse_args()
+    if args.cascade_backend is not None and (args.batch or args.local_batch):
+        parser.error("Cascades are not supported with batch jobs")
+    use_early_stopping = args.stop_ci_width is not None or args.reference_model is not None
+    if use_early_stopping and (args.batch or args.local_batch):
+        parser.error("Early stopping is not supported with batch jobs")
+    if use_early_stopping and args.shard is not None:
+        parser.error("Early stopping is not supported with shards")
+    if args.pack_size > 1:
+        if args.batch or args.local_batch or args.cascade_backend is not None:
+            parser.error("Request packing is not supported with batch jobs or cascades")
+        if args.concurrency < args.pack_size:
+            parser.error("Request packing needs a --concurrency of at least --pack_size")
 
     # Setup
-    vlm = setup_vlm(args)
-    eval_ds = load_dataset(args.dataset_name, split=args.ds_split)
+    use_async = args.concurrency > 1 and not (args.batch or args.local_batch)
+    response_cache = (ResponseCache(args.cache_file, max_size_mb=args.cache_max_mb)
+                      if args.cache_file is not None and not args.no_cache else None)
+    image_encoder = ImageEncoder(args.image_format, quality=args.image_quality, max_pixels=args.max_pixels, 
+                                 passthrough=not args.no_passthrough)
+    telemetry = Telemetry(trace_file=args.trace_file, metrics_file=args.metrics_file)
+    traffic_controller = TrafficController(requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                           max_concurrency=args.concurrency, max_retries=args.max_retries,
+                                           telemetry=telemetry)
+    vlm = (setup_async_vlm(args, response_cache, image_encoder, traffic_controller, telemetry) if use_async 
+           else setup_vlm(args, response_cache, image_encoder, traffic_controller, telemetry))
+    if args.cascade_backend is not None:
+        vlm = setup_cascade(args, vlm, use_async, response_cache, image_encoder, telemetry)
+    if args.pack_size > 1:
+        vlm = PackedVLM(vlm, pack_size=args.pack_size, max_wait_ms=args.pack_wait_ms)
+    # Keep the images undecoded, the image encoder decodes them only if they can't be passed through
+    eval_ds = load_dataset(args.dataset_name, split=args.ds_split, streaming=args.streaming)
+    eval_ds = eval_ds.cast_column("image", DatasetImage(decode=False))
+    if args.shuffle_seed is not None:
+        eval_ds = shuffle_samples(eval_ds, args.shuffle_seed)
+    prefetch = args.prefetch if args.prefetch is not None else max(32, 2 * args.concurrency)
+    checkpoint_file = args.checkpoint_file or get_checkpoint_filename(args.results_folder, args.dataset_name, 
+                                                                      vlm.model_name, shard=args.shard)
+    try:
+        prediction_log = PredictionLog(checkpoint_file, resume=args.resume, overwrite=args.overwrite)
+    except FileExistsError as e:
+        parser.error(str(e))
+    checkpointed_count = len(prediction_log.records)
+    early_stopping = None
+    if use_early_stopping:
+        reference_score = None
+        if args.reference_model is not None:
+            reference_results, _, _ = load_eval_results(args.dataset_name, args.reference_model, args.results_folder)
+            reference_score = reference_results["overall_score"]
+        early_stopping = EarlyStopping(MetricAccumulator(confidence=args.confidence, 
+                                                         recover_partial=args.recover_partial),
+                                       max_ci_width=args.stop_ci_width, reference_score=reference_score,
+                                       reference_name=args.reference_model, min_samples=args.stop_min_samples)
 
     # Create predictions
-    predictions_text, ground_truth_dicts = create_predictions(eval_ds, vlm)
+    if args.batch or args.local_batch:
+        executor = LocalBatchExecutor(vlm) if args.local_batch else None
+        predictions_text, ground_truth_dicts = create_predictions_batched(eval_ds, vlm, batch_folder=args.batch_folder,
+                                                                          executor=executor, 
+                                                                          prediction_log=prediction_log,
+                                                                          prefetch=prefetch, 
+                                                                          max_prefetch_mb=args.max_prefetch_mb,
+                                                                          shard=args.shard)
+    elif not use_async:
+        predictions_text, ground_truth_dicts = create_predictions(eval_ds, vlm, prediction_log=prediction_log,
+                                                                  encode_workers=args.encode_workers, 
+                                                                  prefetch=prefetch, 
+                                                                  max_prefetch_mb=args.max_prefetch_mb,
+                                                                  early_stopping=early_stopping, shard=args.shard)
+    else:
+        predictions_text, ground_truth_dicts = asyncio.run(create_predictions_concurrently(eval_ds, vlm, args,
+                                                                                         prediction_log, prefetch,
+                                                                                         early_stopping))
+    prediction_log.close()
+    telemetry.close()
+    telemetry.print_summary()
+    traffic_controller.print_stats()
+    backends = vlm.stages if args.cascade_backend is not None else [vlm.vlm if args.pack_size > 1 else vlm]
+    for backend in backends:
+        if getattr(backend, "load_balancer", None) is not None:
+            backend.load_balancer.print_stats()
+    if args.cascade_backend is not None:
+        vlm.stages[-1].traffic_controller.print_stats()
+        vlm.print_stats()
+    if args.pack_size > 1:
+        vlm.print_stats()
+    if response_cache is not None:
+        response_cache.print_stats()
+
+    # Results of early stopped runs are not written, the checkpoint allows to continue them with --resume
+    stopped_early = early_stopping is not None and early_stopping.reason is not None
+    if stopped_early:
+        print(f"\nStopped early: {early_stopping.reason}")
+        if early_stopping.stopped_after <= checkpointed_count:
+            # The checkpoint is replayed into the metrics, so the same stop condition holds again at once
+            print("The checkpointed predictions already meet the stop condition, resume with a narrower "
+                  "--stop_ci_width or without the stop flags to evaluate more samples")
+        print_intervals(early_stopping.accumulator.summary(), args.confidence)
+
+    # Evaluate predictions, the results of a shard are only written once all shards are merged
+    results_rel = eval_structured_data(predictions_text, ground_truth_dicts, vlm.model_name, args.dataset_name, 
+                                       write_to_file=not stopped_early and args.shard is None, 
+                                       results_folder=args.results_folder, recover_partial=args.recover_partial)
+    if args.shard is not None:
+        # Without the split size the merge cannot find missing samples at the end of the dataset
+        sample_count = get_sample_count(eval_ds)
+        sample_count_arg = f" --sample_count {sample_count}" if sample_count is not None else ""
+        print(f"\nResults of shard {args.shard} only, merge all shards with:\npython -m evaluation.sharding "
+              f"--dataset_name {args.dataset_name} --model_name {vlm.model_name} --shard_count {args.shard.count} "
+              f"--results_folder {args.results_folder}{sample_count_arg}")
+        return
 
-    # Evaluate predictions
-    eval_structured_data(predictions_text, ground_truth_dicts, vlm.model_name, args.dataset_name, write_to_file=True, 
-                         results_folder=args.results_folder)
+    # The accuracy loss of a cascade is measured against stored results of the second stage alone
+    if args.cascade_backend is not None:
+        reference_name = vlm.stages[-1].model_name
+        try:
+            _, reference_predictions, reference_ground_truth_dicts = load_eval_results(args.dataset_name, 
+                                                                                       reference_name, 
+                                                                                       args.results_folder)
+        except FileNotFoundError:
+            print(f"\nNo stored results of {reference_name} on {args.dataset_name} to measure the accuracy loss")
+            return
+        reference_results = eval_structured_data(reference_predictions, reference_ground_truth_dicts, reference_name,
+                                                 args.dataset_name, write_to_file=False, 
+                                                 recover_partial=args.recover_partial)
+        print_accuracy_loss(results_rel, reference_results, reference_name)
 
 
 if __name__ == "__main__":
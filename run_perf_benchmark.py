@@ -0,0 +1,196 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+import numpy as np
+import requests
+from PIL import Image
+from templates.answer_schema import smoke_detection_schema
+from templates.prompt import smoke_detection_prompt
+from evaluation.image_encoding import ImageEncoder
+from evaluation.mock_server import LATENCY_DISTRIBUTIONS, create_random_response
+from evaluation.openai_api import OpenAIAPI, AsyncOpenAIAPI
+from evaluation.forestfire_evaluation import create_predictions, create_predictions_async
+
+
+def create_synthetic_dataset(sample_count, image_size, seed=0):
+    """In-memory dataset of JPEG images with smooth gradients and noise, similar in size to aerial photos"""
+    rng = np.random.default_rng(seed)
+    width, height = image_size
+    y, x = np.mgrid[0:height, 0:width]
+    samples = []
+    for sample_idx in range(sample_count):
+        base = (np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=-1) +
+                rng.uniform(0, 255, size=3))
+        pixels = np.clip(base % 256 + rng.normal(0, 12, size=(height, width, 3)), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="JPEG", quality=95)
+        samples.append({"image": {"bytes": buffer.getvalue(), "path": None}, "prompt": smoke_detection_prompt,
+                        "gt_dict": create_random_response(smoke_detection_schema, random.Random(sample_idx))})
+    return samples
+
+
+async def run_async_predictions(eval_ds, vlm, concurrency):
+    try:
+        return await create_predictions_async(eval_ds, vlm, concurrency=concurrency)
+    finally:
+        await vlm.aclose()
+
+
+def run_benchmark(vllm_url, eval_ds, concurrency, image_encoder) -> dict:
+    if concurrency > 1:
+        vlm = AsyncOpenAIAPI(base_url=vllm_url, image_encoder=image_encoder, max_connections=concurrency)
+    else:
+        vlm = OpenAIAPI(base_url=vllm_url, image_encoder=image_encoder)
+
+    start_time, start_cpu = time.perf_counter(), time.process_time()
+    if concurrency > 1:
+        asyncio.run(run_async_predictions(eval_ds, vlm, concurrency))
+    else:
+        create_predictions(eval_ds, vlm)
+    wall_time, cpu_time = time.perf_counter() - start_time, time.process_time() - start_cpu
+
+    # Request latencies include retries and backoff, images are encoded ahead by the prefetch loader
+    latencies = vlm.telemetry.stage_durations["request"]
+    latencies_ms = np.array(latencies) * 1000
+    payload_sizes = [len(image_encoder.encode(sample["image"]).data) for sample in eval_ds[:8]]
+    return {
+        "requests": len(latencies),
+        "requests_per_s": round(len(latencies) / wall_time, 2),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 1),
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 1),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 1),
+        "cpu_ms_per_request": round(cpu_time * 1000 / len(latencies), 2),
+        "payload_kb": round(float(np.mean(payload_sizes)) / 1024, 1),
+        "retries": vlm.traffic_controller.stats["retries"],
+    }
+
+
+def start_mock_server(args):
+    # A separate process, so the CPU time of the server is not counted for the client
+    server_process = subprocess.Popen([sys.executable, "-m", "evaluation.mock_server", "--port", str(args.port),
+                                       "--latency_ms", str(args.latency_ms),
+                                       "--latency_distribution", args.latency_distribution,
+                                       "--error_rate", str(args.error_rate), "--throttle_rate", str(args.throttle_rate),
+                                       "--seed", "0"], stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{args.port}/v1"
+    for _ in range(100):
+        if server_process.poll() is not None:
+            raise RuntimeError(f"Mock server exited with code {server_process.returncode}, is port {args.port} in use?")
+        try:
+            requests.get(f"{url}/models", timeout=1)
+            return server_process, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server_process.terminate()
+    raise RuntimeError(f"Mock server did not start on port {args.port}")
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(history_file):
+    if not os.path.exists(history_file):
+        return []
+    with open(history_file, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def print_results(records, history):
+    # Compare every configuration to its latest run in the history, so regressions stand out
+    previous_by_config = {json.dumps(record["config"], sort_keys=True): record for record in history}
+    header = ["concurrency", "image_size", "image_format", "req/s", "p50_ms", "p95_ms", "p99_ms", "cpu_ms/req",
+              "payload_kb", "retries", "vs_previous"]
+    rows = []
+    for record in records:
+        config, metrics = record["config"], record["metrics"]
+        previous = previous_by_config.get(json.dumps(config, sort_keys=True))
+        change = (f"{(metrics['requests_per_s'] / previous['metrics']['requests_per_s'] - 1) * 100:+.1f}% "
+                  f"({previous['commit']})" if previous is not None else "-")
+        rows.append([config["concurrency"], config["image_size"], config["image_format"], metrics["requests_per_s"],
+                     metrics["p50_ms"], metrics["p95_ms"], metrics["p99_ms"], metrics["cpu_ms_per_request"],
+                     metrics["payload_kb"], metrics["retries"], change])
+    widths = [max(len(str(value)) for value in column) for column in zip(header, *rows)]
+    print()
+    for row in [header] + rows:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    # Create CLI args
+    parser = argparse.ArgumentParser(description='Benchmark the client-side throughput against a mock VLM server')
+    parser.add_argument('--vllm_url', type=str, default=None,
+                        help='Benchmark against this server instead of starting the mock server')
+    parser.add_argument('--port', type=int, help='Port of the mock server', default=8011)
+    parser.add_argument('--samples', type=int, help='Requests per configuration', default=64)
+    parser.add_argument('--concurrency', type=int, nargs="+", help='Concurrency levels', default=[1, 8, 32])
+    parser.add_argument('--image_sizes', type=str, nargs="+", help='Image sizes as WIDTHxHEIGHT',
+                        default=["640x480", "1920x1080"])
+    parser.add_argument('--image_formats', type=str, nargs="+", default=["passthrough", "PNG", "JPEG"],
+                        help='Image encodings ("passthrough", "PNG", "JPEG", "WEBP")')
+    parser.add_argument('--max_pixels', type=int, help='Downscale images to this pixel budget', default=None)
+    parser.add_argument('--latency_ms', type=float, help='Mean latency of the mock server in ms', default=50)
+    parser.add_argument('--latency_distribution', type=str, choices=LATENCY_DISTRIBUTIONS, default="lognormal",
+                        help='Latency distribution of the mock server')
+    parser.add_argument('--error_rate', type=float, help='Share of requests failing with HTTP 500', default=0.0)
+    parser.add_argument('--throttle_rate', type=float, help='Share of requests throttled with HTTP 429', default=0.0)
+    parser.add_argument('--history_file', type=str, help='JSONL file the results are appended to',
+                        default="benchmarks/perf/history.jsonl")
+    parser.add_argument('--no_history', action='store_true', help='Do not append the results to the history')
+    args = parser.parse_args()
+
+    server_process = None
+    if args.vllm_url is None:
+        server_process, vllm_url = start_mock_server(args)
+        server_config = {"latency_ms": args.latency_ms, "latency_distribution": args.latency_distribution,
+                         "error_rate": args.error_rate, "throttle_rate": args.throttle_rate}
+    else:
+        vllm_url = args.vllm_url
+        server_config = {"url": args.vllm_url}
+
+    records = []
+    commit = get_commit()
+    try:
+        for image_size in args.image_sizes:
+            width, height = (int(value) for value in image_size.lower().split("x"))
+            eval_ds = create_synthetic_dataset(args.samples, (width, height))
+            for image_format in args.image_formats:
+                # "passthrough" sends the JPEG source bytes, the other formats always re-encode
+                if image_format == "passthrough":
+                    image_encoder = ImageEncoder("JPEG", max_pixels=args.max_pixels)
+                else:
+                    image_encoder = ImageEncoder(image_format, max_pixels=args.max_pixels, passthrough=False)
+                for concurrency in args.concurrency:
+                    config = {"samples": args.samples, "concurrency": concurrency, "image_size": image_size,
+                              "image_format": image_format, "max_pixels": args.max_pixels, **server_config}
+                    metrics = run_benchmark(vllm_url, eval_ds, concurrency, image_encoder)
+                    records.append({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+                                    "python": platform.python_version(), "config": config, "metrics": metrics})
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    history = read_history(args.history_file)
+    print_results(records, history)
+    if not args.no_history:
+        os.makedirs(os.path.dirname(args.history_file), exist_ok=True)
+        with open(args.history_file, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        print(f"\nResults appended to {args.history_file}")
+
+
+if __name__ == "__main__":
+    main()
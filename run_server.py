@@ -0,0 +1,79 @@
+import argparse
+from templates.answer_schema import smoke_detection_schema
+from templates.prompt import smoke_detection_prompt
+from evaluation.response_cache import ResponseCache
+from evaluation.image_encoding import ImageEncoder
+from evaluation.traffic_control import TrafficController
+from evaluation.telemetry import Telemetry
+from evaluation.inference_server import InferenceServer
+from evaluation.request_packing import PackedVLM
+from run_eval import setup_async_vlm
+
+
+def main():
+    # Create CLI args
+    parser = argparse.ArgumentParser(description='Serve smoke detection with a VLM over HTTP')
+    parser.add_argument('--backend', type=str, help='VLM backend', default="vllm_online")
+    parser.add_argument('--vllm_url', type=str, nargs="+", default=["http://localhost:8000/v1"],
+                        help='URL for vLLM, requests are load balanced over several URLs')
+    parser.add_argument('--health_check_interval', type=float, default=10,
+                        help='Seconds between health checks of the vLLM URLs')
+    parser.add_argument('--model_name', type=str, help='VLM model name', default="")
+    parser.add_argument('--cache_file', type=str, default=None,
+                        help='SQLite file for cached VLM responses, responses are only cached with it')
+    parser.add_argument('--cache_max_mb', type=float, help='Maximum size of the response cache in MB', default=1024)
+    parser.add_argument('--no_cache', action='store_true', help='Bypass the response cache of --cache_file')
+    parser.add_argument('--image_format', type=str, help='Format images are encoded in (PNG, JPEG, WEBP)', 
+                        default="PNG")
+    parser.add_argument('--image_quality', type=int, help='JPEG/WebP encoding quality', default=90)
+    parser.add_argument('--max_pixels', type=int, help='Downscale images to this pixel budget before upload', 
+                        default=None)
+    parser.add_argument('--no_passthrough', action='store_true', 
+                        help='Always re-encode JPEG images instead of sending the original bytes')
+    parser.add_argument('--rpm', type=float, help='Client-side limit of requests per minute', default=None)
+    parser.add_argument('--tpm', type=float, help='Client-side limit of tokens per minute', default=None)
+    parser.add_argument('--max_retries', type=int, help='Retries of throttled or failed requests', default=6)
+    parser.add_argument('--concurrency', type=int, help='Maximum number of VLM requests in flight', default=64)
+    parser.add_argument('--host', type=str, help='Host to bind to', default="127.0.0.1")
+    parser.add_argument('--port', type=int, help='Port to listen on', default=8090)
+    parser.add_argument('--pack_size', type=int, help='Images per request, packed from concurrent requests', 
+                        default=1)
+    parser.add_argument('--pack_wait_ms', type=float, help='Maximum wait for the images of a pack in ms', default=50)
+    parser.add_argument('--trace_file', type=str, help='JSONL file with the timings of every request', default=None)
+    parser.add_argument('--metrics_file', type=str, help='Prometheus text file the metrics are written to', 
+                        default=None)
+
+    # Parse args
+    args = parser.parse_args()
+
+    # Setup, the backend and its connections are created once and kept warm
+    response_cache = (ResponseCache(args.cache_file, max_size_mb=args.cache_max_mb)
+                      if args.cache_file is not None and not args.no_cache else None)
+    image_encoder = ImageEncoder(args.image_format, quality=args.image_quality, max_pixels=args.max_pixels, 
+                                 passthrough=not args.no_passthrough)
+    telemetry = Telemetry(trace_file=args.trace_file, metrics_file=args.metrics_file)
+    traffic_controller = TrafficController(requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                           max_concurrency=args.concurrency, max_retries=args.max_retries,
+                                           telemetry=telemetry)
+    vlm = setup_async_vlm(args, response_cache, image_encoder, traffic_controller, telemetry)
+    if args.pack_size > 1:
+        vlm = PackedVLM(vlm, pack_size=args.pack_size, max_wait_ms=args.pack_wait_ms)
+    server = InferenceServer(vlm, smoke_detection_prompt, smoke_detection_schema, host=args.host, port=args.port)
+
+    print(f"Serving {vlm.model_name} on {server.url}/v1/detect")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        telemetry.close()
+        telemetry.print_summary()
+        traffic_controller.print_stats()
+        if args.pack_size > 1:
+            vlm.print_stats()
+        if response_cache is not None:
+            response_cache.print_stats()
+
+
+if __name__ == "__main__":
+    main()
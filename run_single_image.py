@@ -1,20 +1,30 @@
+import sys
 import argparse
-from PIL import Image
+import contextlib
 import requests
-from io import BytesIO
 from templates.answer_schema import smoke_detection_schema
 from templates.prompt import smoke_detection_prompt 
+from evaluation.response_cache import ResponseCache
+from evaluation.image_encoding import ImageEncoder
+from evaluation.traffic_control import TrafficController
+from evaluation.response_parser import ResponseParser
+from evaluation.frame_stream import FrameStream, DuplicateFilter, open_frame_source, analyze_frame_stream
 
-def setup_vlm(args):
+def setup_vlm(args, response_cache=None, image_encoder=None, traffic_controller=None, telemetry=None):
     if args.backend == "google":
         from evaluation.google_api import GoogleAPI
-        vlm = GoogleAPI(model_name=args.model_name)
+        vlm = GoogleAPI(model_name=args.model_name, response_cache=response_cache, image_encoder=image_encoder,
+                        traffic_controller=traffic_controller, telemetry=telemetry)
     elif args.backend == "openai":
         from evaluation.openai_api import OpenAIAPI
-        vlm = OpenAIAPI(base_url=None, model_name=args.model_name)
+        vlm = OpenAIAPI(base_url=None, model_name=args.model_name, response_cache=response_cache,
+                        image_encoder=image_encoder, traffic_controller=traffic_controller,
+                        telemetry=telemetry)
     elif args.backend == "vllm_online":
         from evaluation.openai_api import OpenAIAPI
-        vlm = OpenAIAPI(base_url=args.vllm_url, model_name=None)
+        vlm = OpenAIAPI(base_url=args.vllm_url, model_name=None, response_cache=response_cache,
+                        image_encoder=image_encoder, traffic_controller=traffic_controller,
+                        telemetry=telemetry, health_check_interval=args.health_check_interval)
     else:
         raise ValueError("Invalid backend")
     return vlm
@@ -24,26 +34,97 @@ def main():
     # Create CLI args
     parser = argparse.ArgumentParser(description='Evaluate a VLM model on a structured dataset')
     parser.add_argument('--backend', type=str, help='VLM backend', default="vllm_online")
-    parser.add_argument('--vllm_url', type=str, help='URL for vLLM', default="http://localhost:8000/v1")
+    parser.add_argument('--vllm_url', type=str, nargs="+", default=["http://localhost:8000/v1"],
+                        help='URL for vLLM, requests are load balanced over several URLs')
+    parser.add_argument('--health_check_interval', type=float, default=10,
+                        help='Seconds between health checks of the vLLM URLs')
     parser.add_argument('--model_name', type=str, help='VLM model name', default="")
+    parser.add_argument('--cache_file', type=str, default=None,
+                        help='SQLite file for cached VLM responses, responses are only cached with it')
+    parser.add_argument('--cache_max_mb', type=float, help='Maximum size of the response cache in MB', default=1024)
+    parser.add_argument('--no_cache', action='store_true', help='Bypass the response cache of --cache_file')
+    parser.add_argument('--image_format', type=str, help='Format images are encoded in (PNG, JPEG, WEBP)', 
+                        default="PNG")
+    parser.add_argument('--image_quality', type=int, help='JPEG/WebP encoding quality', default=90)
+    parser.add_argument('--max_pixels', type=int, help='Downscale images to this pixel budget before upload', 
+                        default=None)
+    parser.add_argument('--no_passthrough', action='store_true', 
+                        help='Always re-encode JPEG images instead of sending the original bytes')
+    parser.add_argument('--rpm', type=float, help='Client-side limit of requests per minute', default=None)
+    parser.add_argument('--tpm', type=float, help='Client-side limit of tokens per minute', default=None)
+    parser.add_argument('--max_retries', type=int, help='Retries of throttled or failed requests', default=6)
     parser.add_argument('--image', type=str, help='Local path to image or image URL')
+    parser.add_argument('--stream', type=str, default=None,
+                        help='Analyze a stream of frames: video file, stream URL (e.g. RTSP), camera index or a '
+                             'directory that is watched for new images')
+    parser.add_argument('--dedup_threshold', type=int, default=6,
+                        help='Skip frames within this many bits (of 64) of the dHash of the last analyzed frame, '
+                             '-1 analyzes every frame')
+    parser.add_argument('--poll_interval', type=float, help='Seconds between polls of a watched directory', 
+                        default=0.5)
+    parser.add_argument('--no_realtime', action='store_true', 
+                        help='Read video files as fast as possible, frames arriving during a request are dropped')
+    parser.add_argument('--output_file', type=str, default=None, 
+                        help='JSONL file for the stream results (default: stdout)')
 
     # Parse args
     args = parser.parse_args()
+    if args.image is None and args.stream is None:
+        parser.error("Either --image or --stream is required")
 
     # Setup
-    vlm = setup_vlm(args)
+    response_cache = (ResponseCache(args.cache_file, max_size_mb=args.cache_max_mb)
+                      if args.cache_file is not None and not args.no_cache else None)
+    image_encoder = ImageEncoder(args.image_format, quality=args.image_quality, max_pixels=args.max_pixels, 
+                                 passthrough=not args.no_passthrough)
+    traffic_controller = TrafficController(requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                                           max_retries=args.max_retries)
 
-    # Load image
+    if args.stream is not None:
+        # Stdout only carries the JSON stream, all other messages (e.g. of the backend) go to stderr
+        output = open(args.output_file, "a") if args.output_file is not None else sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            vlm = setup_vlm(args, response_cache, image_encoder, traffic_controller)
+            run_stream(args, vlm, output)
+        return
+
+    vlm = setup_vlm(args, response_cache, image_encoder, traffic_controller)
+
+    # Load image bytes, JPEG images are sent without re-encoding
     if args.image.startswith("http"):
         response = requests.get(args.image)
-        pil_image = Image.open(BytesIO(response.content))
+        image_bytes = response.content
     else:
-        pil_image = Image.open(args.image)
+        with open(args.image, "rb") as f:
+            image_bytes = f.read()
+    image = vlm.image_encoder.encode(image_bytes)
 
     # Create prediction
-    vlm_prediction = vlm.generate_structured_response_from_pil_image(smoke_detection_prompt, pil_image, smoke_detection_schema)
+    vlm_prediction = vlm.generate_structured_response_from_pil_image(smoke_detection_prompt, image, smoke_detection_schema)
     print(vlm_prediction)
 
+    # Parse the response, valid fields of a broken response are still shown
+    prediction_dict, status = ResponseParser(smoke_detection_schema, recover_partial=True).parse_dict(vlm_prediction)
+    print(f"\nParse status: {status}")
+    for field, value in prediction_dict.items():
+        print(f"{field}: {value}")
+
+
+def run_stream(args, vlm, output):
+    frames = open_frame_source(args.stream, poll_interval=args.poll_interval, realtime=not args.no_realtime)
+    duplicate_filter = DuplicateFilter(args.dedup_threshold) if args.dedup_threshold >= 0 else None
+    frame_stream = FrameStream(frames, duplicate_filter)
+    response_parser = ResponseParser(smoke_detection_schema, recover_partial=True)
+    try:
+        analyze_frame_stream(frame_stream, vlm, response_parser, smoke_detection_prompt, smoke_detection_schema, 
+                             output=output)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.output_file is not None:
+            output.close()
+        print(frame_stream.summary(), file=sys.stderr)
+
+
 if __name__ == "__main__":
     main()
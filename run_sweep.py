@@ -0,0 +1,181 @@
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datasets import load_dataset, Image as DatasetImage
+from evaluation.response_cache import ResponseCache
+from evaluation.image_encoding import ImageEncoder
+from evaluation.traffic_control import TrafficController
+from evaluation.telemetry import Telemetry
+from evaluation.prediction_log import PredictionLog, check_checkpoint, get_checkpoint_filename
+from evaluation.data_pipeline import PrefetchLoader, SampleFanOut, iter_samples
+from evaluation.forestfire_evaluation import create_predictions_async, eval_structured_data
+from run_eval import setup_async_vlm
+
+# Settings of a model in the sweep config, the same as the CLI args of run_eval.py
+MODEL_DEFAULTS = {"backend": "vllm_online", "model_name": "", "vllm_url": ["http://localhost:8000/v1"],
+                  "health_check_interval": 10, "concurrency": 16, "rpm": None, "tpm": None, "max_retries": 6}
+# Settings shared by all models, images are encoded once for all of them
+SWEEP_DEFAULTS = {"datasets": [], "models": [], "ds_split": "train", "results_folder": "benchmarks",
+                  "image_format": "PNG", "image_quality": 90, "max_pixels": None, "passthrough": True,
+                  "prefetch": 64, "max_prefetch_mb": 512, "encode_workers": 0}
+
+
+def read_sweep_config(filename) -> dict:
+    with open(filename, "r") as f:
+        config = {**SWEEP_DEFAULTS, **json.load(f)}
+    if not config["datasets"] or not config["models"]:
+        raise ValueError(f"The sweep config {filename} needs at least one dataset and one model")
+    config["models"] = [argparse.Namespace(**{**MODEL_DEFAULTS, **model_config}) for model_config in config["models"]]
+    for model_args in config["models"]:
+        if isinstance(model_args.vllm_url, str):
+            model_args.vllm_url = [model_args.vllm_url]
+    return config
+
+
+def create_summary_row(dataset_name, model_name, dataset_seconds=None, error="") -> dict:
+    return {"dataset": dataset_name, "model": model_name, "overall_score": None, "seconds": None,
+            "dataset_seconds": dataset_seconds, "error": error}
+
+
+def setup_models(config, image_encoder, response_cache=None) -> tuple[list, list[dict]]:
+    """Return the backends of the models and summary rows of the models that could not be set up (e.g. their
+    endpoint is down during model discovery). Failed models are removed from config["models"]."""
+    vlms, failed_rows = [], []
+    for model_args in list(config["models"]):
+        # Every model has its own rate limits and telemetry
+        telemetry = Telemetry()
+        traffic_controller = TrafficController(requests_per_minute=model_args.rpm, tokens_per_minute=model_args.tpm,
+                                               max_concurrency=model_args.concurrency,
+                                               max_retries=model_args.max_retries, telemetry=telemetry)
+        try:
+            vlms.append(setup_async_vlm(model_args, response_cache, image_encoder, traffic_controller, telemetry))
+        except Exception as e:
+            print(f"Skipping {model_args.model_name or model_args.vllm_url[0]}, its setup failed: {e}")
+            config["models"].remove(model_args)
+            failed_rows += [create_summary_row(dataset_name, model_args.model_name or model_args.vllm_url[0],
+                                               error=f"{type(e).__name__}: {e}")
+                            for dataset_name in config["datasets"]]
+    return vlms, failed_rows
+
+
+async def run_model(eval_ds, vlm, model_args, loader, prediction_log, progress_position) -> dict:
+    start_time = time.perf_counter()
+    try:
+        predictions_text, ground_truth_dicts = await create_predictions_async(
+            eval_ds, vlm, concurrency=model_args.concurrency, prediction_log=prediction_log, loader=loader,
+            progress_position=progress_position)
+    finally:
+        prediction_log.close()
+    return {"model": vlm.model_name, "predictions_text": predictions_text, "ground_truth_dicts": ground_truth_dicts,
+            "seconds": time.perf_counter() - start_time}
+
+
+async def run_dataset(config, dataset_name, vlms, image_encoder, resume=False, overwrite=False) -> list[dict]:
+    """Create the predictions of all models on a dataset at once, every image is read and encoded only once"""
+    eval_ds = load_dataset(dataset_name, split=config["ds_split"])
+    eval_ds = eval_ds.cast_column("image", DatasetImage(decode=False))
+    prediction_logs = [PredictionLog(get_checkpoint_filename(config["results_folder"], dataset_name, vlm.model_name),
+                                     resume=resume, overwrite=overwrite) for vlm in vlms]
+    # Samples that are checkpointed for every model are not read at all
+    skip_indices = set.intersection(*(set(prediction_log.records) for prediction_log in prediction_logs))
+    loader = PrefetchLoader(iter_samples(eval_ds, skip_indices=skip_indices), image_encoder,
+                            prefetch=config["prefetch"], max_prefetch_mb=config["max_prefetch_mb"],
+                            encode_workers=config["encode_workers"])
+    fan_out = SampleFanOut(loader, len(vlms), window=config["prefetch"])
+
+    print(f"\nDataset: {dataset_name}, {len(eval_ds)} samples, {len(vlms)} models\n")
+    tasks = [run_model(eval_ds, vlm, model_args, fan_out.view(consumer_idx), prediction_log, consumer_idx)
+             for consumer_idx, (vlm, model_args, prediction_log) in
+             enumerate(zip(vlms, config["models"], prediction_logs))]
+    # A failed model (e.g. an unavailable endpoint) leaves the fan-out, the other models go on
+    model_runs = await asyncio.gather(*tasks, return_exceptions=True)
+    for model_run in model_runs:
+        if isinstance(model_run, BaseException) and not isinstance(model_run, Exception):
+            raise model_run
+    return model_runs
+
+
+async def run_sweep(config, vlms, image_encoder, resume=False, overwrite=False) -> list[dict]:
+    rows = []
+    # Every worker of every model waits for samples in a thread, the default pool would be too small
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=sum(model_args.concurrency for model_args in config["models"]) + 4))
+    try:
+        for dataset_name in config["datasets"]:
+            start_time = time.perf_counter()
+            model_runs = await run_dataset(config, dataset_name, vlms, image_encoder, resume=resume,
+                                           overwrite=overwrite)
+            dataset_seconds = time.perf_counter() - start_time
+            for vlm, model_run in zip(vlms, model_runs):
+                row = create_summary_row(dataset_name, vlm.model_name, round(dataset_seconds, 1))
+                if isinstance(model_run, Exception):
+                    # The checkpoint keeps the finished samples, --resume continues the model
+                    row["error"] = f"{type(model_run).__name__}: {model_run}"
+                else:
+                    results_rel = eval_structured_data(model_run["predictions_text"], model_run["ground_truth_dicts"],
+                                                       model_run["model"], dataset_name, write_to_file=True,
+                                                       results_folder=config["results_folder"])
+                    row["overall_score"] = results_rel["overall_score"]
+                    row["seconds"] = round(model_run["seconds"], 1)
+                rows.append(row)
+    finally:
+        for vlm in vlms:
+            await vlm.aclose()
+    return rows
+
+
+def print_sweep_summary(rows):
+    header = list(rows[0].keys())
+    table = [header] + [[row[column] for column in header] for row in rows]
+    widths = [max(len(str(value)) for value in column) for column in zip(*table)]
+    failed_count = sum(1 for row in rows if row["error"])
+    print(f"\nSweep summary ({failed_count} failed):" if failed_count else "\nSweep summary:")
+    for row in table:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    # Create CLI args
+    parser = argparse.ArgumentParser(description='Evaluate several VLM models on several datasets at once')
+    parser.add_argument('config', type=str, help='JSON file with the datasets and models of the sweep')
+    parser.add_argument('--cache_file', type=str, default=None,
+                        help='SQLite file for cached VLM responses, responses are only cached with it')
+    parser.add_argument('--cache_max_mb', type=float, help='Maximum size of the response cache in MB', default=1024)
+    parser.add_argument('--no_cache', action='store_true', help='Bypass the response cache of --cache_file')
+    parser.add_argument('--resume', action='store_true', help='Skip samples that are already in the checkpoint files')
+    parser.add_argument('--overwrite', action='store_true', help='Replace existing checkpoint files')
+
+    # Parse args
+    args = parser.parse_args()
+
+    # Setup
+    config = read_sweep_config(args.config)
+    response_cache = (ResponseCache(args.cache_file, max_size_mb=args.cache_max_mb)
+                      if args.cache_file is not None and not args.no_cache else None)
+    image_encoder = ImageEncoder(config["image_format"], quality=config["image_quality"],
+                                 max_pixels=config["max_pixels"], passthrough=config["passthrough"])
+    vlms, failed_rows = setup_models(config, image_encoder, response_cache)
+    # Existing checkpoints are found before the first dataset, not in the middle of the sweep
+    try:
+        for dataset_name in config["datasets"]:
+            for vlm in vlms:
+                check_checkpoint(get_checkpoint_filename(config["results_folder"], dataset_name, vlm.model_name),
+                                 resume=args.resume, overwrite=args.overwrite)
+    except FileExistsError as e:
+        parser.error(str(e))
+
+    rows = asyncio.run(run_sweep(config, vlms, image_encoder, resume=args.resume, overwrite=args.overwrite)) if vlms \
+        else []
+    rows = sorted(rows + failed_rows, key=lambda row: config["datasets"].index(row["dataset"]))
+    print_sweep_summary(rows)
+    for vlm in vlms:
+        print(f"\n{vlm.model_name}:")
+        vlm.traffic_controller.print_stats()
+    if response_cache is not None:
+        response_cache.print_stats()
+
+
+if __name__ == "__main__":
+    main()